@@ -3,8 +3,8 @@ import random
 from typing import List, Any, Union, Tuple
 
 import torch
-import torchvision.transforms as transforms
 from kubeml import KubeModel, KubeDataset
+from kubeml import transforms as T
 from torch.optim import SGD
 import torch.nn.functional as F
 from torchvision.models.resnet import resnet34
@@ -14,31 +14,17 @@ class Cifar10Dataset(KubeDataset):
     def __init__(self):
         super(Cifar10Dataset, self).__init__("cifar10")
 
-        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                              std=[0.229, 0.224, 0.225])
-        self.train_transf = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.RandomHorizontalFlip(),
-            transforms.RandomCrop(32, 4),
-            transforms.ToTensor(),
-            self.normalize
-        ])
-
-        self.val_transf = transforms.Compose([
-            transforms.ToTensor(),
-            self.normalize
-        ])
-
-    def __getitem__(self, index):
-        x = self.data[index]
-        y = self.labels[index]
-
-        # depending on the mode of the dataset apply some or the other
-        # transformations
+        self.mean = [0.485, 0.456, 0.406]
+        self.std = [0.229, 0.224, 0.225]
+
+    def transform_batch(self, data, labels):
+        # the whole minibatch is transformed at once, during training
+        # it is flipped and cropped before being normalized
+        x = T.to_tensor(data)
         if self.is_training():
-            return self.train_transf(x), y.astype('int64')
-        else:
-            return self.val_transf(x), y.astype('int64')
+            x = T.random_crop(T.random_horizontal_flip(x), 32, padding=4)
+
+        return T.normalize(x, self.mean, self.std), labels.long()
 
     def __len__(self):
         return len(self.data)
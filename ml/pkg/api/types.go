@@ -105,8 +105,28 @@ type (
 
 	// DatasetSummary describes the contents a kubeml dataset
 	DatasetSummary struct {
-		Name         string `json:"name"`
-		TrainSetSize int64  `json:"train_set_size"`
-		TestSetSize  int64  `json:"test_set_size"`
+		Name         string           `json:"name"`
+		TrainSetSize int64            `json:"train_set_size"`
+		TestSetSize  int64            `json:"test_set_size"`
+		Metadata     *DatasetMetadata `json:"metadata,omitempty"`
+	}
+
+	// DatasetMetadata is the document saved by the storage service
+	// with the layout of the subsets of a dataset
+	DatasetMetadata struct {
+		SubsetSize int64                  `bson:"subset_size" json:"subset_size"`
+		Codec      string                 `bson:"codec" json:"codec"`
+		Transform  map[string]interface{} `bson:"transform" json:"transform,omitempty"`
+		Train      CollectionMetadata     `bson:"train" json:"train"`
+		Test       CollectionMetadata     `bson:"test" json:"test"`
+	}
+
+	// CollectionMetadata describes the train or test set of a dataset
+	CollectionMetadata struct {
+		Samples    int64   `bson:"samples" json:"samples"`
+		Subsets    int64   `bson:"subsets" json:"subsets"`
+		Shape      []int64 `bson:"shape" json:"shape"`
+		Dtype      string  `bson:"dtype" json:"dtype"`
+		LabelDtype string  `bson:"label_dtype" json:"label_dtype"`
 	}
 )
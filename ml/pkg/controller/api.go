@@ -23,6 +23,8 @@ func (c *Controller) getHandler() http.Handler {
 	// dataset proxy and methods
 	r.HandleFunc("/dataset/{name}", c.getDataset).Methods("GET")
 	r.HandleFunc("/dataset/{name}", c.storageServiceProxy).Methods("POST", "DELETE")
+	r.HandleFunc("/dataset/{name}/status", c.storageServiceProxy).Methods("GET")
+	r.PathPrefix("/dataset/{name}/upload").HandlerFunc(c.storageServiceProxy).Methods("GET", "POST", "PUT", "DELETE")
 	r.HandleFunc("/dataset", c.listDatasets).Methods("GET")
 
 	// get current tasks
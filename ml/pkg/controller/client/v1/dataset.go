@@ -10,9 +10,15 @@ import (
 	"io/ioutil"
 	"mime/multipart"
 	"net/http"
+	"net/url"
 	"os"
+	"time"
 )
 
+// pollUploadInterval is the time between the queries of the
+// progress of an upload saved in the background by the storage service
+const pollUploadInterval = 2 * time.Second
+
 var (
 	filenames = []string{"x-train", "y-train", "x-test", "y-test"}
 )
@@ -25,6 +31,15 @@ type (
 		Datasets() DatasetInterface
 	}
 
+	// uploadStatus is the progress of an upload reported by the storage service
+	uploadStatus struct {
+		State          string  `json:"state"`
+		SubsetsTotal   int     `json:"subsets_total"`
+		SubsetsWritten int     `json:"subsets_written"`
+		MbPerSec       float64 `json:"mb_per_sec"`
+		Error          *string `json:"error"`
+	}
+
 	// DatasetInterface has methods to work with dataset resources
 	DatasetInterface interface {
 		Create(name, trainData, trainLabels, testData, testLabels string) error
@@ -102,9 +117,68 @@ func (d *datasets) Create(name, trainData, trainLabels, testData, testLabels str
 	}
 
 	fmt.Println(result["result"])
+
+	// the dataset is saved in the background, wait until it
+	// can be used for training before returning
+	if uploadId, ok := result["upload_id"]; ok {
+		return d.waitUpload(name, uploadId)
+	}
 	return nil
 }
 
+// waitUpload polls the status of an upload until it is done or failed
+func (d *datasets) waitUpload(name, uploadId string) error {
+	statusUrl := fmt.Sprintf("%s/dataset/%s/status?upload_id=%s", d.controllerUrl, name, url.QueryEscape(uploadId))
+
+	for {
+		status, err := d.uploadStatus(statusUrl)
+		if err != nil {
+			return err
+		}
+
+		switch status.State {
+		case "done":
+			fmt.Println("Dataset", name, "uploaded")
+			return nil
+		case "failed":
+			reason := "unknown error"
+			if status.Error != nil {
+				reason = *status.Error
+			}
+			return errors.New(fmt.Sprintf("Upload of dataset %s failed: %s", name, reason))
+		}
+
+		fmt.Printf("Upload %s: %s, %d/%d subsets written, %.2f MB/s\n",
+			uploadId, status.State, status.SubsetsWritten, status.SubsetsTotal, status.MbPerSec)
+		time.Sleep(pollUploadInterval)
+	}
+}
+
+func (d *datasets) uploadStatus(statusUrl string) (*uploadStatus, error) {
+	resp, err := d.httpClient.Get(statusUrl)
+	if err != nil {
+		return nil, errors.Wrap(err, "could not get the status of the upload")
+	}
+	defer resp.Body.Close()
+
+	body, err := ioutil.ReadAll(resp.Body)
+	if err != nil {
+		return nil, errors.Wrap(err, "could not read response body")
+	}
+
+	if resp.StatusCode != http.StatusOK {
+		var result map[string]string
+		_ = json.Unmarshal(body, &result)
+		return nil, errors.New(fmt.Sprintf("Could not get the status of the upload: %s", result["error"]))
+	}
+
+	var status uploadStatus
+	if err := json.Unmarshal(body, &status); err != nil {
+		return nil, errors.Wrap(err, "could not decode body")
+	}
+	return &status, nil
+}
+
 func (d *datasets) Delete(name string) error {
 	url := d.controllerUrl + "/dataset/" + name
 
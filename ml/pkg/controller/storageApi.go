@@ -8,6 +8,7 @@ import (
 	"github.com/nwangfw/kubeml/ml/pkg/util"
 	"github.com/gorilla/mux"
 	"go.mongodb.org/mongo-driver/bson"
+	"go.mongodb.org/mongo-driver/mongo"
 	"go.mongodb.org/mongo-driver/mongo/options"
 	"go.uber.org/zap"
 	"net/http"
@@ -20,6 +21,7 @@ import (
 const defaultBatchSize int64 = 64
 const CollectionTrain = "train"
 const CollectionTest = "test"
+const CollectionMetadata = "metadata"
 
 // defaultDatabases shows the admin or non-dataset databases that we will
 // omit when returning the list of datasets
@@ -88,25 +90,33 @@ func (c *Controller) getDataset(w http.ResponseWriter, r *http.Request) {
 				Name: dataset.Name,
 			}
 
-			// get the train and test collections and their size
-			trainCollection := c.mongoClient.Database(dataset.Name).Collection(CollectionTrain)
-			count, err := trainCollection.EstimatedDocumentCount(context.Background(), nil)
-			if err != nil {
-				c.logger.Error("error counting documents of collection",
-					zap.String("dataset", dataset.Name),
-					zap.String("collection", CollectionTrain))
-			} else {
-				summary.TrainSetSize = ((count * defaultBatchSize) / 100) * 100
-			}
-
-			testCollection := c.mongoClient.Database(dataset.Name).Collection(CollectionTest)
-			count, err = testCollection.EstimatedDocumentCount(context.Background(), nil)
-			if err != nil {
-				c.logger.Error("error counting documents of collection",
-					zap.String("dataset", dataset.Name),
-					zap.String("collection", CollectionTest))
+			// take the sizes from the metadata, datasets uploaded without it
+			// are estimated from the number of documents in the collections
+			if meta, ok := c.getMetadata(dataset.Name); ok {
+				summary.TrainSetSize = meta.Train.Samples
+				summary.TestSetSize = meta.Test.Samples
+				summary.Metadata = meta
 			} else {
-				summary.TestSetSize = ((count * defaultBatchSize) / 100) * 100
+				// get the train and test collections and their size
+				trainCollection := c.mongoClient.Database(dataset.Name).Collection(CollectionTrain)
+				count, err := trainCollection.EstimatedDocumentCount(context.Background(), nil)
+				if err != nil {
+					c.logger.Error("error counting documents of collection",
+						zap.String("dataset", dataset.Name),
+						zap.String("collection", CollectionTrain))
+				} else {
+					summary.TrainSetSize = ((count * defaultBatchSize) / 100) * 100
+				}
+
+				testCollection := c.mongoClient.Database(dataset.Name).Collection(CollectionTest)
+				count, err = testCollection.EstimatedDocumentCount(context.Background(), nil)
+				if err != nil {
+					c.logger.Error("error counting documents of collection",
+						zap.String("dataset", dataset.Name),
+						zap.String("collection", CollectionTest))
+				} else {
+					summary.TestSetSize = ((count * defaultBatchSize) / 100) * 100
+				}
 			}
 
 			resp, err := json.Marshal(summary)
@@ -150,6 +160,13 @@ func (c *Controller) listDatasets(w http.ResponseWriter, r *http.Request) {
 				Name: dataset.Name,
 			}
 
+			if meta, ok := c.getMetadata(dataset.Name); ok {
+				summary.TrainSetSize = meta.Train.Samples
+				summary.TestSetSize = meta.Test.Samples
+				datasets = append(datasets, summary)
+				continue
+			}
+
 			// get the train and test collections and their size
 			trainCollection := c.mongoClient.Database(dataset.Name).Collection(CollectionTrain)
 			count, err := trainCollection.EstimatedDocumentCount(context.Background(), nil)
@@ -187,3 +204,20 @@ func (c *Controller) listDatasets(w http.ResponseWriter, r *http.Request) {
 	w.Write(resp)
 
 }
+
+// getMetadata reads the metadata document of a dataset, returns false
+// if the dataset was uploaded before the storage service saved it
+func (c *Controller) getMetadata(dataset string) (*api.DatasetMetadata, bool) {
+	var meta api.DatasetMetadata
+	err := c.mongoClient.Database(dataset).Collection(CollectionMetadata).
+		FindOne(context.Background(), bson.M{"_id": "dataset"}).Decode(&meta)
+	if err != nil {
+		if err != mongo.ErrNoDocuments {
+			c.logger.Error("error reading dataset metadata",
+				zap.String("dataset", dataset),
+				zap.Error(err))
+		}
+		return nil, false
+	}
+	return &meta, true
+}
@@ -29,7 +29,9 @@ var (
 		Use:   "create",
 		Short: "Create a new dataset in KubeML",
 		Long: `Given the paths to the dataset files (train data and labels, test data and labels),
-upload the files to KubeMl so they can be used in training tasks. Files must be either .npy or .pkl files`,
+upload the files to KubeMl so they can be used in training tasks. Files must be either .npy or .pkl files.
+The .pkl files are loaded in memory by the storage service and limited in size, use .npy files for big datasets.
+The command waits until the dataset is saved and ready to be used for training`,
 		RunE: createDataset,
 	}
 
@@ -0,0 +1,138 @@
+package model
+
+import (
+	"encoding/binary"
+	"fmt"
+	"math"
+)
+
+// Encoding of the deltas published by the functions in delta mode (see serverlessdl/delta.py).
+// Each layer is a header followed by the int32 indices (only if sparse) and the values.
+// The header holds the kind of encoding, the type of the values and the number of values,
+// packed little endian without padding
+const (
+	deltaHeaderSize = 10
+
+	deltaKindDense  = 0
+	deltaKindSparse = 1
+
+	deltaFloat32 = 0
+	deltaFloat16 = 1
+	deltaInt64   = 2
+)
+
+// decodeFloatDelta decodes the delta of a float32 layer of the given number of elements
+// into a dense slice
+func decodeFloatDelta(blob []byte, length int) ([]float32, error) {
+	kind, valueType, count, offset, err := parseDeltaHeader(blob, length)
+	if err != nil {
+		return nil, err
+	}
+
+	var indices []byte
+	if kind == deltaKindSparse {
+		if len(blob) < offset+4*count {
+			return nil, fmt.Errorf("delta too short for %d indices", count)
+		}
+		indices = blob[offset : offset+4*count]
+		offset += 4 * count
+	}
+
+	var itemSize int
+	switch valueType {
+	case deltaFloat32:
+		itemSize = 4
+	case deltaFloat16:
+		itemSize = 2
+	default:
+		return nil, fmt.Errorf("unexpected value type %d in the delta of a float layer", valueType)
+	}
+	if len(blob) != offset+itemSize*count {
+		return nil, fmt.Errorf("delta has %d bytes, expected %d", len(blob), offset+itemSize*count)
+	}
+
+	values := blob[offset:]
+	delta := make([]float32, length)
+	for i := 0; i < count; i++ {
+		pos := i
+		if indices != nil {
+			pos = int(int32(binary.LittleEndian.Uint32(indices[4*i:])))
+			if pos < 0 || pos >= length {
+				return nil, fmt.Errorf("delta index %d out of range", pos)
+			}
+		}
+
+		if valueType == deltaFloat32 {
+			delta[pos] = math.Float32frombits(binary.LittleEndian.Uint32(values[4*i:]))
+		} else {
+			delta[pos] = halfToFloat32(binary.LittleEndian.Uint16(values[2*i:]))
+		}
+	}
+
+	return delta, nil
+}
+
+// decodeIntDelta decodes the delta of an int64 layer, which is always sent dense
+func decodeIntDelta(blob []byte, length int) ([]int64, error) {
+	kind, valueType, count, offset, err := parseDeltaHeader(blob, length)
+	if err != nil {
+		return nil, err
+	}
+	if kind != deltaKindDense || valueType != deltaInt64 || count != length {
+		return nil, fmt.Errorf("unexpected encoding of the delta of an int layer")
+	}
+	if len(blob) != offset+8*count {
+		return nil, fmt.Errorf("delta has %d bytes, expected %d", len(blob), offset+8*count)
+	}
+
+	delta := make([]int64, length)
+	for i := range delta {
+		delta[i] = int64(binary.LittleEndian.Uint64(blob[offset+8*i:]))
+	}
+	return delta, nil
+}
+
+func parseDeltaHeader(blob []byte, length int) (kind, valueType byte, count, offset int, err error) {
+	if len(blob) < deltaHeaderSize {
+		return 0, 0, 0, 0, fmt.Errorf("delta of %d bytes has no header", len(blob))
+	}
+
+	kind, valueType = blob[0], blob[1]
+	n := binary.LittleEndian.Uint64(blob[2:deltaHeaderSize])
+	if n > uint64(length) {
+		return 0, 0, 0, 0, fmt.Errorf("delta has %d values, layer has %d", n, length)
+	}
+	if kind != deltaKindDense && kind != deltaKindSparse {
+		return 0, 0, 0, 0, fmt.Errorf("unknown delta encoding %d", kind)
+	}
+	if kind == deltaKindDense && int(n) != length {
+		return 0, 0, 0, 0, fmt.Errorf("dense delta has %d values, layer has %d", n, length)
+	}
+
+	return kind, valueType, int(n), deltaHeaderSize, nil
+}
+
+// halfToFloat32 converts an IEEE 754 half precision float to float32
+func halfToFloat32(h uint16) float32 {
+	sign := uint32(h>>15) << 31
+	exp := uint32(h>>10) & 0x1f
+	mant := uint32(h) & 0x3ff
+
+	switch {
+	case exp == 0x1f:
+		// inf or nan
+		return math.Float32frombits(sign | 0xff<<23 | mant<<13)
+	case exp != 0:
+		return math.Float32frombits(sign | (exp+127-15)<<23 | mant<<13)
+	case mant == 0:
+		return math.Float32frombits(sign)
+	default:
+		// subnormal half, normal in float32
+		e := uint32(127 - 15 + 1)
+		for mant&0x400 == 0 {
+			mant <<= 1
+			e--
+		}
+		return math.Float32frombits(sign | e<<23 | (mant&0x3ff)<<13)
+	}
+}
@@ -0,0 +1,148 @@
+package model
+
+import (
+	"encoding/hex"
+	"reflect"
+	"testing"
+
+	"gorgonia.org/tensor"
+)
+
+// The blobs are produced by serverlessdl.delta.encode_delta
+func mustDecodeHex(t *testing.T, s string) []byte {
+	t.Helper()
+	b, err := hex.DecodeString(s)
+	if err != nil {
+		t.Fatal(err)
+	}
+	return b
+}
+
+func sparse(length int, values map[int]float32) []float32 {
+	out := make([]float32, length)
+	for i, v := range values {
+		out[i] = v
+	}
+	return out
+}
+
+func TestDecodeFloatDelta(t *testing.T) {
+	cases := []struct {
+		name     string
+		blob     string
+		expected []float32
+	}{
+		{
+			// encode_delta(torch.tensor([0.5, -1.25, 3.0, 0.0, -0.125, 2.5]), DeltaConfig())
+			name:     "dense float32",
+			blob:     "000006000000000000000000003f0000a0bf0000404000000000000000be00002040",
+			expected: []float32{0.5, -1.25, 3.0, 0.0, -0.125, 2.5},
+		},
+		{
+			// 16 entries with -2.5 at 3, 0.25 at 7 and 4.0 at 11, DeltaConfig('topk', ratio=0.125)
+			name:     "top-k float32",
+			blob:     "010002000000000000000b0000000300000000008040000020c0",
+			expected: sparse(16, map[int]float32{3: -2.5, 11: 4.0}),
+		},
+		{
+			// 16 entries with 0.75 at 0, 0.01 at 5, -1.5 at 9 and 1e-6 at 15,
+			// DeltaConfig('threshold', threshold=0.5, fp16=True)
+			name:     "threshold float16",
+			blob:     "010102000000000000000000000009000000003a00be",
+			expected: sparse(16, map[int]float32{0: 0.75, 9: -1.5}),
+		},
+		{
+			// encode_delta(torch.tensor([1e-6, -3e-5, 65504.0, 0.333]), DeltaConfig(fp16=True)),
+			// the first two are subnormal halfs
+			name:     "dense float16",
+			blob:     "000104000000000000001100f781ff7b5435",
+			expected: []float32{1.0132789611816406e-06, -2.9981136322021484e-05, 65504.0, 0.3330078125},
+		},
+	}
+
+	for _, c := range cases {
+		t.Run(c.name, func(t *testing.T) {
+			delta, err := decodeFloatDelta(mustDecodeHex(t, c.blob), len(c.expected))
+			if err != nil {
+				t.Fatal(err)
+			}
+			if !reflect.DeepEqual(delta, c.expected) {
+				t.Fatalf("decoded %v, expected %v", delta, c.expected)
+			}
+		})
+	}
+}
+
+func TestDecodeIntDelta(t *testing.T) {
+	// encode_delta(torch.tensor([3, -5, 7, 0]), DeltaConfig('topk', fp16=True)), int layers are always dense
+	blob := mustDecodeHex(t, "000204000000000000000300000000000000fbffffffffffffff07000000000000000000000000000000")
+	delta, err := decodeIntDelta(blob, 4)
+	if err != nil {
+		t.Fatal(err)
+	}
+	if expected := []int64{3, -5, 7, 0}; !reflect.DeepEqual(delta, expected) {
+		t.Fatalf("decoded %v, expected %v", delta, expected)
+	}
+}
+
+func TestDecodeDeltaErrors(t *testing.T) {
+	dense := mustDecodeHex(t, "000006000000000000000000003f0000a0bf0000404000000000000000be00002040")
+	topk := mustDecodeHex(t, "010002000000000000000b0000000300000000008040000020c0")
+	ints := mustDecodeHex(t, "000204000000000000000300000000000000fbffffffffffffff07000000000000000000000000000000")
+
+	cases := []struct {
+		name   string
+		decode func() error
+	}{
+		{"no header", func() error { _, err := decodeFloatDelta(dense[:5], 6); return err }},
+		{"truncated values", func() error { _, err := decodeFloatDelta(dense[:len(dense)-1], 6); return err }},
+		{"dense length mismatch", func() error { _, err := decodeFloatDelta(dense, 7); return err }},
+		{"index out of range", func() error { _, err := decodeFloatDelta(topk, 8); return err }},
+		{"int delta of a float layer", func() error { _, err := decodeFloatDelta(ints, 4); return err }},
+		{"float delta of an int layer", func() error { _, err := decodeIntDelta(dense, 6); return err }},
+	}
+
+	for _, c := range cases {
+		if err := c.decode(); err == nil {
+			t.Errorf("%s: expected an error", c.name)
+		}
+	}
+}
+
+func TestApplyDelta(t *testing.T) {
+	ref := &Layer{
+		Name:    "fc.weight",
+		Dtype:   "float32",
+		Weights: tensor.New(tensor.WithShape(2, 3), tensor.WithBacking([]float32{1, 2, 3, 4, 5, 6})),
+	}
+	layer, err := applyDelta(ref, mustDecodeHex(t, "000006000000000000000000003f0000a0bf0000404000000000000000be00002040"))
+	if err != nil {
+		t.Fatal(err)
+	}
+
+	if expected := []float32{1.5, 0.75, 6, 4, 4.875, 8.5}; !reflect.DeepEqual(layer.Weights.Data(), expected) {
+		t.Fatalf("layer %v, expected %v", layer.Weights.Data(), expected)
+	}
+	if !layer.Weights.Shape().Eq(ref.Weights.Shape()) || layer.Name != ref.Name {
+		t.Fatalf("layer %s of shape %v, expected %s of shape %v",
+			layer.Name, layer.Weights.Shape(), ref.Name, ref.Weights.Shape())
+	}
+	// the reference is kept for the deltas of the other functions
+	if expected := []float32{1, 2, 3, 4, 5, 6}; !reflect.DeepEqual(ref.Weights.Data(), expected) {
+		t.Fatalf("reference changed to %v", ref.Weights.Data())
+	}
+
+	counter := &Layer{
+		Name:    "bn.num_batches_tracked",
+		Dtype:   "int64",
+		Weights: tensor.New(tensor.WithShape(4), tensor.WithBacking([]int64{10, 10, 10, 10})),
+	}
+	layer, err = applyDelta(counter, mustDecodeHex(t,
+		"000204000000000000000300000000000000fbffffffffffffff07000000000000000000000000000000"))
+	if err != nil {
+		t.Fatal(err)
+	}
+	if expected := []int64{13, 5, 17, 10}; !reflect.DeepEqual(layer.Weights.Data(), expected) {
+		t.Fatalf("layer %v, expected %v", layer.Weights.Data(), expected)
+	}
+}
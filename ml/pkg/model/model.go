@@ -34,6 +34,10 @@ type (
 		// layer has a bias and a weight
 		StateDict map[string]*Layer
 
+		// reference holds the layers of the reference model the functions
+		// started the iteration from, used to apply the deltas they publish
+		reference map[string]*Layer
+
 		// layerNames holds the names of the layers
 		// which will be used to build the model for the
 		// first time
@@ -116,6 +120,12 @@ func (m *Model) Build() error {
 
 // Clear wipes the statedict of the model
 func (m *Model) Clear() {
+	m.mu.Lock()
+	defer m.mu.Unlock()
+
+	// the state dict holds the last built or averaged model, which
+	// is the reference model of the next iteration
+	m.reference = m.StateDict
 	m.StateDict = make(map[string]*Layer)
 	m.logger.Debug("Wiped model state")
 }
@@ -150,6 +160,14 @@ func (m *Model) Save() error {
 		}
 	}
 
+	// bump the version of the reference model in the same transaction,
+	// functions use it to know whether their cached model is still valid.
+	// A single function caches the model it publishes with the next version,
+	// so every save must increase the version exactly once
+	if _, err := redisClient.DoOrSend("INCR", redis.Args{getVersionKey(m.jobId)}, nil); err != nil {
+		return errors.Wrap(err, "could not update model version")
+	}
+
 	// execute all commands as a batch and empty response buffer
 	_, err := redisClient.ActiveConn.Do("EXEC")
 	if err != nil {
@@ -252,12 +270,24 @@ func (m *Model) Update(funcId int) {
 	m.logger.Debug("Updating model layers",
 		zap.Int("funcId", funcId))
 
+	delta, err := m.publishedDelta(funcId)
+	if err != nil {
+		m.logger.Error("could not check the model delta",
+			zap.Error(err),
+			zap.Int("funcId", funcId))
+		return
+	}
+
 	redisClient := util.GetRedisAIClient(m.redisPool, true)
 	defer redisClient.Close()
 
 	// load the function layers
 	for _, layer := range m.layerNames {
-		err := m.fetchLayer(redisClient, layer, funcId)
+		if delta {
+			_, err = redisClient.DoOrSend("GET", redis.Args{getDeltaKey(layer, m.jobId, funcId)}, nil)
+		} else {
+			err = m.fetchLayer(redisClient, layer, funcId)
+		}
 		if err != nil {
 			m.logger.Error("could not fetch layer",
 				zap.Error(err),
@@ -275,7 +305,12 @@ func (m *Model) Update(funcId int) {
 	defer m.mu.Unlock()
 
 	for _, layerName := range m.layerNames {
-		layer, err := m.buildLayer(redisClient, layerName)
+		var layer *Layer
+		if delta {
+			layer, err = m.buildDeltaLayer(redisClient, layerName)
+		} else {
+			layer, err = m.buildLayer(redisClient, layerName)
+		}
 		if err != nil {
 			m.logger.Error("Could not build layer from database",
 				zap.Error(err),
@@ -301,3 +336,61 @@ func (m *Model) Update(funcId int) {
 		zap.Int("funcId", funcId))
 
 }
+
+// publishedDelta returns whether the function published the delta of its model with the
+// reference model instead of the whole model. Functions in delta mode publish the
+// deltas of all the layers, so only the first one is checked
+func (m *Model) publishedDelta(funcId int) (bool, error) {
+	if len(m.layerNames) == 0 {
+		return false, nil
+	}
+
+	conn := m.redisPool.Get()
+	defer conn.Close()
+	return redis.Bool(conn.Do("EXISTS", getDeltaKey(m.layerNames[0], m.jobId, funcId)))
+}
+
+// buildDeltaLayer reads the pipelined delta of a layer and returns the layer
+// of the function, the reference layer plus the decoded delta
+func (m *Model) buildDeltaLayer(redisClient *redisai.Client, name string) (*Layer, error) {
+	blob, err := redis.Bytes(redisClient.Receive())
+	if err != nil {
+		return nil, err
+	}
+
+	ref, exists := m.reference[name]
+	if !exists {
+		return nil, errors.Errorf("no reference for layer %s", name)
+	}
+	return applyDelta(ref, blob)
+}
+
+// applyDelta returns a new layer with the encoded delta added to the reference layer
+func applyDelta(ref *Layer, blob []byte) (*Layer, error) {
+	switch values := ref.Weights.Data().(type) {
+	case []float32:
+		delta, err := decodeFloatDelta(blob, len(values))
+		if err != nil {
+			return nil, errors.Wrapf(err, "could not decode delta of layer %s", ref.Name)
+		}
+		for i, v := range values {
+			delta[i] += v
+		}
+		t := tensor.New(tensor.WithShape(ref.Weights.Shape().Clone()...), tensor.WithBacking(delta))
+		return &Layer{Name: ref.Name, Dtype: ref.Dtype, Weights: t}, nil
+
+	case []int64:
+		delta, err := decodeIntDelta(blob, len(values))
+		if err != nil {
+			return nil, errors.Wrapf(err, "could not decode delta of layer %s", ref.Name)
+		}
+		for i, v := range values {
+			delta[i] += v
+		}
+		t := tensor.New(tensor.WithShape(ref.Weights.Shape().Clone()...), tensor.WithBacking(delta))
+		return &Layer{Name: ref.Name, Dtype: ref.Dtype, Weights: t}, nil
+
+	default:
+		return nil, errors.Errorf("unknown datatype of layer %s", ref.Name)
+	}
+}
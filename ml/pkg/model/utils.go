@@ -156,3 +156,14 @@ func getWeightKeys(layerName string, jobId string, funcId int) (string) {
 
 	return weightName
 }
+
+// getVersionKey returns the key holding the version of the reference model of a job,
+// which is increased every time the reference model is published
+func getVersionKey(jobId string) string {
+	return fmt.Sprintf("%s:version", jobId)
+}
+
+// getDeltaKey returns the key of the delta of a layer published by a function in delta mode
+func getDeltaKey(layerName string, jobId string, funcId int) string {
+	return fmt.Sprintf("%s:%s/%d:delta", jobId, layerName, funcId)
+}
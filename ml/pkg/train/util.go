@@ -78,20 +78,31 @@ func parseLayerNames(resp *http.Response) ([]string, error) {
 }
 
 // getAverageLoss iterates through the function results gotten from several
-// training functions and returns the average loss and the ids of the functions that completed
+// training functions and returns the average loss and the ids of the functions that completed.
+//
+// The loss of each function is weighted by the number of batches it trained, since
+// with work stealing the functions train different numbers of batches. Functions
+// that don't report it are given the same weight
 func getAverageLoss(respChan chan *FunctionResults) (float64, []int) {
 	var funcs []int
-	var loss float64
+	var loss, mean, total float64
+	weighted := true
 
 	// close the channel so it can be iterated over
 	close(respChan)
 	for response := range respChan {
-		loss += response.results["loss"]
+		iterations, ok := response.results["iterations"]
+		weighted = weighted && ok
+		loss += response.results["loss"] * iterations
+		mean += response.results["loss"]
+		total += iterations
 		funcs = append(funcs, response.funcId)
 	}
 
-	avgLoss := loss / float64(len(funcs))
-	return avgLoss, funcs
+	if !weighted || total == 0 {
+		return mean / float64(len(funcs)), funcs
+	}
+	return loss / total, funcs
 }
 
 // getValidationMetrics analyzes the results of validation functions containing
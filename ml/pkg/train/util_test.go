@@ -0,0 +1,50 @@
+package train
+
+import (
+	"math"
+	"reflect"
+	"testing"
+)
+
+func resultsChan(results ...map[string]float64) chan *FunctionResults {
+	respChan := make(chan *FunctionResults, len(results))
+	for i, r := range results {
+		respChan <- &FunctionResults{funcId: i, results: r}
+	}
+	return respChan
+}
+
+func TestAverageLossWeightedByIterations(t *testing.T) {
+	// with work stealing the functions train different numbers of batches
+	loss, funcs := getAverageLoss(resultsChan(
+		map[string]float64{"loss": 1, "iterations": 30},
+		map[string]float64{"loss": 4, "iterations": 10},
+		map[string]float64{"loss": 2, "iterations": 0},
+	))
+
+	if want := (1*30 + 4*10) / 40.0; math.Abs(loss-want) > 1e-12 {
+		t.Errorf("loss = %v, want %v", loss, want)
+	}
+	if !reflect.DeepEqual(funcs, []int{0, 1, 2}) {
+		t.Errorf("funcs = %v", funcs)
+	}
+}
+
+func TestAverageLossWithoutIterations(t *testing.T) {
+	// functions that don't report the iterations get the plain mean
+	loss, _ := getAverageLoss(resultsChan(
+		map[string]float64{"loss": 1, "iterations": 30},
+		map[string]float64{"loss": 4},
+	))
+	if loss != 2.5 {
+		t.Errorf("loss = %v, want 2.5", loss)
+	}
+
+	loss, _ = getAverageLoss(resultsChan(
+		map[string]float64{"loss": 1, "iterations": 0},
+		map[string]float64{"loss": 3, "iterations": 0},
+	))
+	if loss != 2 {
+		t.Errorf("loss = %v, want 2", loss)
+	}
+}
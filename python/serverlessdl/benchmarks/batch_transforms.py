@@ -0,0 +1,85 @@
+"""
+Benchmark of the per sample and batched augmentation paths of KubeDataset.
+
+Iterates an epoch of synthetic CIFAR sized data with the usual training
+augmentation (random crop with padding, horizontal flip and normalization),
+applied per sample with torchvision in __getitem__ or to whole minibatches
+with transform_batch and serverlessdl.transforms. Reports samples/s.
+
+    python benchmarks/batch_transforms.py --samples 10000 --batch-size 128
+"""
+import argparse
+import time
+
+import numpy as np
+import torchvision.transforms as transforms
+
+from serverlessdl import transforms as T
+from serverlessdl.dataset import KubeDataset
+from serverlessdl.loader import train_loader
+
+MEAN, STD = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+
+class _Dataset(KubeDataset):
+    # the benchmark sets the data directly, skip connecting to the storage
+    def __init__(self):
+        self.dataset = 'benchmark'
+        self._mode = None
+
+    def __len__(self):
+        return len(self.data)
+
+
+class PerSample(_Dataset):
+    transform = transforms.Compose([
+        transforms.ToPILImage(),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomCrop(32, 4),
+        transforms.ToTensor(),
+        transforms.Normalize(MEAN, STD),
+    ])
+
+    def __getitem__(self, index):
+        return self.transform(self.data[index]), self.labels[index].astype('int64')
+
+
+class Batched(_Dataset):
+
+    def transform_batch(self, data, labels):
+        x = T.random_crop(T.to_tensor(data), 32, 4)
+        return T.normalize(T.random_horizontal_flip(x), MEAN, STD), labels
+
+
+def run(dataset: _Dataset, data: np.ndarray, labels: np.ndarray, batch_size: int, num_workers: int, epochs: int):
+    # the first epoch starts the workers
+    times = []
+    for _ in range(epochs + 1):
+        start = time.perf_counter()
+        for x, y in train_loader(dataset, data, labels, batch_size, num_workers):
+            pass
+        times.append(time.perf_counter() - start)
+
+    elapsed = float(np.median(times[1:]))
+    print(f'{type(dataset).__name__:<10} workers={num_workers} samples/s={len(data) / elapsed:10.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 255, (args.samples, 32, 32, 3), dtype=np.uint8)
+    labels = rng.integers(0, 10, args.samples)
+
+    for num_workers in args.workers:
+        for dataset in [PerSample(), Batched()]:
+            run(dataset, data, labels, args.batch_size, num_workers, args.epochs)
+
+
+if __name__ == '__main__':
+    main()
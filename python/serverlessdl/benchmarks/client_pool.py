@@ -0,0 +1,85 @@
+"""
+Micro-benchmark of the connection setup paid by every invocation of a function.
+
+Simulates the round trips of an invocation that trains a small network (reading
+the version and the layers of the reference model and publishing the trained
+ones) with a new redis client per invocation that is closed at the end, as the
+functions did before, and with the pooled client shared by the process. Reports
+the median latency of an invocation.
+
+Needs a real redis server, since the stand-in has no connections to set up.
+
+    python benchmarks/client_pool.py --host localhost --network lenet --invocations 200
+"""
+import argparse
+import statistics
+import time
+from typing import Callable, List
+
+import numpy as np
+import redis
+
+from serverlessdl import clients
+
+import models
+
+
+def invocation(client: redis.Redis, keys: List[str], blobs: List[bytes]):
+    client.get('bench:version')
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+    pipe.execute()
+
+    pipe = client.pipeline(transaction=False)
+    for key, blob in zip(keys, blobs):
+        pipe.set(key, blob)
+    pipe.execute()
+    client.incr('bench:version')
+
+
+def new_client(host: str, port: int) -> Callable[[], redis.Redis]:
+    def connect():
+        return redis.Redis(host=host, port=port)
+    return connect
+
+
+def pooled_client(host: str, port: int) -> Callable[[], redis.Redis]:
+    clients.REDIS_URL, clients.REDIS_PORT = host, port
+    return clients.redis_client
+
+
+def run(name: str, connect: Callable[[], redis.Redis], close: bool,
+        keys: List[str], blobs: List[bytes], invocations: int):
+    times = []
+    for _ in range(invocations):
+        start = time.perf_counter()
+        client = connect()
+        invocation(client, keys, blobs)
+        if close:
+            client.close()
+            client.connection_pool.disconnect()
+        times.append(time.perf_counter() - start)
+
+    print(f'{name:<8} median={statistics.median(times) * 1e3:8.3f} ms  '
+          f'p95={np.percentile(times, 95) * 1e3:8.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--network', default='lenet')
+    parser.add_argument('--invocations', type=int, default=200)
+    args = parser.parse_args()
+
+    state = models.build(args.network).state_dict()
+    keys = [f'bench:{layer}' for layer in state]
+    blobs = [t.detach().cpu().numpy().tobytes() for t in state.values()]
+
+    run('new', new_client(args.host, args.port), True, keys, blobs, args.invocations)
+    run('pooled', pooled_client(args.host, args.port), False, keys, blobs, args.invocations)
+
+
+if __name__ == '__main__':
+    main()
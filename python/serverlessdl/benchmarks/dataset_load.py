@@ -0,0 +1,87 @@
+"""
+Benchmark of the assembly of the dataset subsets loaded by the functions.
+
+Compares growing the arrays with vstack/hstack for every subset (the previous
+behaviour) with decoding every subset into a preallocated array, on synthetic
+MNIST and CIFAR sized subsets. Reports the time and the peak memory allocated.
+
+    python benchmarks/dataset_load.py --samples 50000
+"""
+import argparse
+import pickle
+import time
+import tracemalloc
+from typing import Callable, List
+
+import numpy as np
+
+from serverlessdl.dataset import assemble_subsets
+from serverlessdl.util import STORAGE_SUBSET_SIZE
+
+SHAPES = {
+    'mnist': (28, 28),
+    'cifar': (32, 32, 3),
+}
+
+
+def make_subsets(shape, samples: int, subset_size: int) -> List[dict]:
+    """Creates the documents of the subsets as saved by the storage service"""
+    rng = np.random.default_rng(0)
+    docs = []
+    for i, start in enumerate(range(0, samples, subset_size)):
+        n = min(subset_size, samples - start)
+        docs.append({
+            '_id': i,
+            'data': pickle.dumps(rng.integers(0, 255, (n, *shape), dtype=np.uint8), pickle.HIGHEST_PROTOCOL),
+            'labels': pickle.dumps(rng.integers(0, 10, n), pickle.HIGHEST_PROTOCOL),
+        })
+    return docs
+
+
+def stack_subsets(docs: List[dict], num_subsets: int):
+    data, labels = None, None
+    for batch in docs:
+        d = pickle.loads(batch['data'])
+        l = pickle.loads(batch['labels'])
+        if data is None:
+            data, labels = d, l.flatten()
+        else:
+            data = np.vstack([data, d])
+            labels = np.hstack([labels, l.flatten()])
+    return data, labels.flatten()
+
+
+def preallocated_subsets(docs: List[dict], num_subsets: int):
+    return assemble_subsets(iter(docs), num_subsets)
+
+
+def run(name: str, docs: List[dict], method: Callable, repeat: int):
+    times, peak = [], 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        data, labels = method(docs, len(docs))
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    elapsed = float(np.median(times))
+    print(f'{name:<6} {method.__name__:<22} samples={len(data):<7} MB={data.nbytes / 1e6:8.2f} '
+          f'time={elapsed * 1e3:9.2f}ms peak/data={peak / data.nbytes:5.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=10000, help='samples in the loaded shard')
+    parser.add_argument('--subset-size', type=int, default=STORAGE_SUBSET_SIZE)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for name, shape in SHAPES.items():
+        docs = make_subsets(shape, args.samples, args.subset_size)
+        for method in [stack_subsets, preallocated_subsets]:
+            run(name, docs, method, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
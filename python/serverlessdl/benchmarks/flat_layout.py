@@ -0,0 +1,129 @@
+"""
+Round trip check and benchmark of the flat model layout.
+
+For each network it:
+- checks that packing and unpacking a state dict gives back the same tensors, with
+  the same types, also through the storage with the reference reader and writer
+- checks that averaging the flat buffers of several models, as the parameter server
+  does with any float32 layer, gives the average of the state dicts
+- compares saving and loading the model with the per-layer and the flat layouts
+
+    python benchmarks/flat_layout.py --rtt 0.5
+"""
+import argparse
+import time
+from typing import Dict
+
+import numpy as np
+import torch
+
+from serverlessdl.flat import flat_key, FlatIndex, index_key, read_model, write_model
+from serverlessdl.transfer import fetch_tensors, publish_tensors, tensor_to_numpy
+
+import models
+from standin import LocalRedisAI
+
+
+def randomize(net: torch.nn.Module, seed: int) -> Dict[str, torch.Tensor]:
+    """Returns a state dict of the network with random values in all the entries"""
+    g = torch.Generator().manual_seed(seed)
+    state = {}
+    for name, t in net.state_dict().items():
+        if t.is_floating_point():
+            state[name] = torch.randn(t.shape, generator=g)
+        else:
+            state[name] = torch.randint(0, 1000, t.shape, generator=g, dtype=t.dtype)
+    return state
+
+
+def check_equal(expected: Dict[str, torch.Tensor], actual: Dict[str, torch.Tensor]):
+    assert list(expected) == list(actual), 'layer names differ'
+    for name in expected:
+        assert expected[name].dtype == actual[name].dtype, f'{name} type differs'
+        assert torch.equal(expected[name], actual[name]), f'{name} values differ'
+
+
+def check(client, name: str):
+    net = models.build(name)
+    state = randomize(net, 0)
+    index = FlatIndex.from_state_dict(state)
+
+    # index serialization and in memory round trip
+    assert FlatIndex.loads(index.dumps()) == index
+    check_equal(state, index.unpack(index.pack(state)))
+
+    # round trip through the storage, with and without a known index
+    # and reusing the pack buffer
+    buffer = write_model(client, 'check', state)
+    check_equal(state, read_model(client, 'check'))
+    write_model(client, 'check', state, func_id=0, index=index, out=buffer)
+    check_equal(state, read_model(client, 'check', func_id=0, index=index))
+    keys = [flat_key('check', i, func_id) for i in range(len(index.segments)) for func_id in (-1, 0)]
+    client.delete(*keys, index_key('check'))
+
+    # averaging the flat buffers matches averaging the layers,
+    # integer buffers are rounded back to their type
+    other = randomize(net, 1)
+    avg = index.pack(state)
+    avg += index.pack(other)
+    avg /= 2
+    unpacked = index.unpack(avg)
+    for layer in index.layers:
+        a, b = state[layer.name], other[layer.name]
+        if a.is_floating_point():
+            assert torch.allclose(unpacked[layer.name], (a + b) / 2, atol=1e-6), layer.name
+        else:
+            assert torch.equal(unpacked[layer.name], ((a + b) / 2).round().long()), layer.name
+
+    print(f'{name:<10} round trip ok, layers={len(index.layers)} elements={index.numel}')
+
+
+def bench(client, name: str, repeat: int):
+    state = models.build(name).state_dict()
+    index = FlatIndex.from_state_dict(state)
+    keys = [f'bench:{layer}' for layer in state]
+    total_bytes = index.numel * 4
+
+    def save_layers():
+        publish_tensors(client, keys, [tensor_to_numpy(t) for t in state.values()])
+
+    def load_layers():
+        return {k: torch.from_numpy(w) for k, w in zip(state, fetch_tensors(client, keys))}
+
+    buffer = None
+
+    def save_flat():
+        nonlocal buffer
+        buffer = write_model(client, 'bench', state, func_id=0, index=index, out=buffer)
+
+    def load_flat():
+        return read_model(client, 'bench', func_id=0, index=index)
+
+    for method in [save_layers, load_layers, save_flat, load_flat]:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            method()
+            times.append(time.perf_counter() - start)
+        elapsed = float(np.median(times))
+        print(f'{name:<10} {method.__name__:<12} time={elapsed * 1e3:9.2f}ms '
+              f'MB/s={total_bytes / 1e6 / elapsed:9.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rtt', type=float, default=0.5, help='stand-in round trip latency in ms')
+    parser.add_argument('--bandwidth', type=float, default=1000, help='stand-in bandwidth in MB/s')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--models', nargs='+', default=models.MODELS, choices=models.MODELS)
+    args = parser.parse_args()
+
+    client = LocalRedisAI(rtt=args.rtt / 1e3, bandwidth=args.bandwidth * 1e6)
+    for name in args.models:
+        check(client, name)
+    for name in args.models:
+        bench(client, name, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
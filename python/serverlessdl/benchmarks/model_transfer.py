@@ -0,0 +1,99 @@
+"""
+Micro-benchmark of the transfer of the model weights between the functions
+and the tensor storage.
+
+For each network it measures publishing and loading the state dict with one
+request per layer (the previous behaviour) and with the pipelined bulk
+transfers used by the KubeModel, reporting layers/s and MB/s.
+
+By default runs against an in-process stand-in of RedisAI that simulates
+the latency of the round trips, use --host to benchmark a real RedisAI.
+
+    python benchmarks/model_transfer.py --rtt 0.5 --repeat 5
+"""
+import argparse
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+import redisai as rai
+import torch
+
+from serverlessdl.transfer import fetch_tensors, publish_tensors, tensor_to_numpy, PIPELINE_CHUNK_BYTES
+
+import models
+from standin import LocalRedisAI
+
+
+def fetch_sequential(client, keys: List[str], sizes: List[int]) -> List[np.ndarray]:
+    return [client.tensorget(k) for k in keys]
+
+
+def fetch_pipelined(client, keys: List[str], sizes: List[int]) -> List[np.ndarray]:
+    return fetch_tensors(client, keys, sizes, PIPELINE_CHUNK_BYTES)
+
+
+def fetch_single_pipeline(client, keys: List[str], sizes: List[int]) -> List[np.ndarray]:
+    return fetch_tensors(client, keys, sizes, None)
+
+
+def save_sequential(client, keys: List[str], state: Dict[str, torch.Tensor]):
+    for key, t in zip(keys, state.values()):
+        client.tensorset(key, t.cpu().detach().numpy(), dtype='float32')
+
+
+def save_pipelined(client, keys: List[str], state: Dict[str, torch.Tensor]):
+    publish_tensors(client, keys, [tensor_to_numpy(t) for t in state.values()], PIPELINE_CHUNK_BYTES)
+
+
+def run(client, name: str, method: Callable, repeat: int):
+    net = models.build(name)
+    state = net.state_dict()
+
+    keys = [f'bench:{layer}' for layer in state]
+    sizes = [t.numel() * t.element_size() for t in state.values()]
+    save_pipelined(client, keys, state)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if method in SAVE_METHODS:
+            method(client, keys, state)
+        else:
+            weights = method(client, keys, sizes)
+            assert len(weights) == len(keys)
+        times.append(time.perf_counter() - start)
+
+    elapsed = float(np.median(times))
+    total_bytes = sum(sizes)
+    print(f'{name:<10} {method.__name__:<22} layers={len(keys):<4} '
+          f'MB={total_bytes / 1e6:8.2f} time={elapsed * 1e3:9.2f}ms '
+          f'layers/s={len(keys) / elapsed:10.1f} MB/s={total_bytes / 1e6 / elapsed:9.1f}')
+
+
+SAVE_METHODS = [save_sequential, save_pipelined]
+FETCH_METHODS = [fetch_sequential, fetch_pipelined, fetch_single_pipeline]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', help='RedisAI host, if not given the local stand-in is used')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--rtt', type=float, default=0.5, help='stand-in round trip latency in ms')
+    parser.add_argument('--bandwidth', type=float, default=1000, help='stand-in bandwidth in MB/s')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--models', nargs='+', default=models.MODELS, choices=models.MODELS)
+    args = parser.parse_args()
+
+    if args.host:
+        client = rai.Client(host=args.host, port=args.port)
+    else:
+        client = LocalRedisAI(rtt=args.rtt / 1e3, bandwidth=args.bandwidth * 1e6)
+
+    for name in args.models:
+        for method in SAVE_METHODS + FETCH_METHODS:
+            run(client, name, method, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
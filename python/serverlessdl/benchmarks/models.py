@@ -0,0 +1,42 @@
+"""Networks used by the benchmarks, the same ones used in the KubeML experiments"""
+import torch.nn as nn
+
+
+class LeNet(nn.Module):
+    """LeNet as defined in the MNIST experiment function"""
+
+    def __init__(self):
+        super().__init__()
+        self.conv1 = nn.Conv2d(1, 6, 5)
+        self.pool1 = nn.MaxPool2d(2)
+        self.conv2 = nn.Conv2d(6, 16, 5)
+        self.pool2 = nn.MaxPool2d(2)
+        self.fc1 = nn.Linear(256, 120)
+        self.fc2 = nn.Linear(120, 84)
+        self.fc3 = nn.Linear(84, 10)
+        self.relu = nn.ReLU()
+
+    def forward(self, x):
+        y = self.pool1(self.relu(self.conv1(x)))
+        y = self.pool2(self.relu(self.conv2(y)))
+        y = y.view(y.shape[0], -1)
+        y = self.relu(self.fc1(y))
+        y = self.relu(self.fc2(y))
+        return self.relu(self.fc3(y))
+
+
+def build(name: str) -> nn.Module:
+    """Returns the network with the given name (lenet, resnet34 or vgg11)"""
+    if name == 'lenet':
+        return LeNet()
+
+    from torchvision.models import resnet34, vgg11
+    if name == 'resnet34':
+        return resnet34()
+    elif name == 'vgg11':
+        return vgg11()
+
+    raise ValueError(f'Unknown network {name}')
+
+
+MODELS = ['lenet', 'resnet34', 'vgg11']
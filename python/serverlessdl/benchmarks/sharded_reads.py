@@ -0,0 +1,61 @@
+"""
+Benchmark of the parallel reads of the dataset subsets from the storage.
+
+Reads a range of subsets of a dataset uploaded to the storage service with one
+cursor and with the range split in an increasing number of shards read in
+parallel, reporting the time and MB/s of each.
+
+Needs a real mongo holding a dataset uploaded with its metadata.
+
+    python benchmarks/sharded_reads.py --host localhost --port 27017 --dataset cifar10 --shards 1 2 4 8
+"""
+import argparse
+import time
+
+import numpy as np
+from pymongo import MongoClient
+
+from serverlessdl import dataset
+
+
+def read_shards(col, subsets, metadata: dict, subset_size: int, shards: int):
+    """Reads the subsets in the given number of shards the way the functions do"""
+    layout = dataset._layout(metadata, subsets, subset_size)
+    data, labels = dataset._allocate(metadata, layout[-1][2] if layout else 0)
+    dataset._read_runs(col, layout, subset_size, shards, data, labels)
+    return data, labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--collection', default='train', choices=['train', 'test'])
+    parser.add_argument('--subsets', type=int, default=None, help='subsets read, all by default')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    db = MongoClient(args.host, args.port)[args.dataset]
+    metadata = db[dataset.METADATA_COLLECTION].find_one({'_id': dataset.METADATA_ID})
+    if metadata is None:
+        raise SystemExit(f'Dataset {args.dataset} has no metadata, upload it again')
+
+    collection = metadata[args.collection]
+    subsets = range(0, args.subsets or collection['subsets'])
+
+    for shards in args.shards:
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            data, labels = read_shards(db[args.collection], subsets, collection, metadata['subset_size'], shards)
+            times.append(time.perf_counter() - start)
+
+        elapsed = float(np.median(times))
+        print(f'shards={shards:<3} samples={len(data):<7} time={elapsed * 1e3:9.2f}ms '
+              f'MB/s={data.nbytes / elapsed / 1e6:8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Simulator of the assignment of the dataset subsets to the functions across epochs.
+
+Compares the contiguous split used by default with the epoch shuffles of
+shuffle_subsets for several localities, reporting for each one:
+
+- hit rate: fraction of the subsets read after the first epoch that were already in
+  the cache of the node running the function
+- turnover: fraction of the subsets of a function that it didn't have the epoch before
+- together: fraction of the pairs of subsets trained by the same function in an epoch
+  that are again trained together in the next one, lower means better shuffled
+
+Function i runs on node i % nodes, or with probability --migrate on a random node, and
+every node keeps an LRU cache of --cache-fraction of the dataset.
+
+    python benchmarks/shuffle_sim.py --functions 8 --nodes 4 --epochs 20
+"""
+import argparse
+from collections import OrderedDict
+from typing import Callable, List
+
+import numpy as np
+
+from serverlessdl.util import shuffle_subsets, split_minibatches
+
+Assignment = Callable[[int], List[List[int]]]
+
+
+def simulate(assign: Assignment, num_subsets: int, functions: int, nodes: int, epochs: int,
+             capacity: int, migrate: float, seed: int):
+    rng = np.random.RandomState(seed)
+    caches = [OrderedDict() for _ in range(nodes)]
+    hits, reads, turnover, together = 0, 0, [], []
+    previous = None
+
+    for epoch in range(epochs):
+        assigned = assign(epoch)
+        owner = np.empty(num_subsets, dtype=np.int64)
+
+        for f, subsets in enumerate(assigned):
+            owner[subsets] = f
+            node = rng.randint(nodes) if rng.rand() < migrate else f % nodes
+            cache = caches[node]
+            for s in subsets:
+                if epoch > 0:
+                    hits += s in cache
+                    reads += 1
+                cache[s] = True
+                cache.move_to_end(s)
+                if len(cache) > capacity:
+                    cache.popitem(last=False)
+
+        if previous is not None:
+            turnover.append(np.mean([np.mean(previous[subsets] != f)
+                                     for f, subsets in enumerate(assigned) if len(subsets)]))
+            counts = np.zeros((functions, functions))
+            np.add.at(counts, (previous, owner), 1)
+            sizes = counts.sum(axis=1)
+            together.append((counts * (counts - 1)).sum() / (sizes * (sizes - 1)).sum())
+        previous = owner
+
+    return hits / max(reads, 1), float(np.mean(turnover)), float(np.mean(together))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subsets', type=int, default=1000)
+    parser.add_argument('--functions', type=int, default=8)
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--block-size', type=int, default=4)
+    parser.add_argument('--localities', type=float, nargs='+', default=[0, 0.5, 0.8, 1])
+    parser.add_argument('--cache-fraction', type=float, default=0.5, help='node cache size over the dataset')
+    parser.add_argument('--migrate', type=float, default=0.1, help='probability of a function changing node')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    capacity = int(args.subsets * args.cache_fraction)
+    runs = [('contiguous', lambda epoch: [list(r) for r in split_minibatches(range(args.subsets), args.functions)])]
+    for locality in args.localities:
+        runs.append((f'shuffle {locality:.2f}',
+                     lambda epoch, locality=locality: shuffle_subsets(args.subsets, args.functions, epoch, args.seed,
+                                                                      args.block_size, locality)))
+
+    for name, assign in runs:
+        hit_rate, turnover, together = simulate(assign, args.subsets, args.functions, args.nodes, args.epochs,
+                                                capacity, args.migrate, args.seed)
+        print(f'{name:<14} hit rate={hit_rate:6.3f} turnover={turnover:6.3f} together={together:6.3f}')
+
+
+if __name__ == '__main__':
+    main()
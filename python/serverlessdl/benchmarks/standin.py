@@ -0,0 +1,171 @@
+"""
+In-process stand-in for the RedisAI server used by the benchmarks.
+
+It keeps the tensors as raw bytes like RedisAI does and charges every
+round trip with a fixed latency plus the time needed to move the payload
+through a link of the given bandwidth, so pipelined and non pipelined
+access patterns can be compared without a running cluster.
+"""
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+_DTYPES = {'FLOAT': 'float32', 'DOUBLE': 'float64', 'INT64': 'int64'}
+
+
+def _encode(value) -> bytes:
+    """Encodes the values as redis does before sending them"""
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+
+class LocalRedisAI:
+
+    def __init__(self, rtt: float = 0.0005, bandwidth: float = 1e9):
+        """
+        :param rtt: latency in seconds charged to every round trip
+        :param bandwidth: bytes per second of the simulated link
+        """
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self._store: Dict[str, Tuple[str, Tuple[int, ...], bytes]] = {}
+        self._kv: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def _round_trip(self, nbytes: int):
+        time.sleep(self.rtt + nbytes / self.bandwidth)
+
+    def _tensorset(self, key: str, tensor: np.ndarray, dtype: str = None) -> int:
+        if dtype is not None:
+            tensor = tensor.astype(dtype, copy=False)
+        self._store[key] = (tensor.dtype.str, tensor.shape, tensor.tobytes())
+        return tensor.nbytes
+
+    def _incr(self, key: str) -> int:
+        # the functions of a job share the server, so counters are updated atomically
+        with self._lock:
+            value = int(self._kv.get(key, b'0')) + 1
+            self._kv[key] = _encode(str(value))
+        return value
+
+    def _tensorget(self, key: str) -> np.ndarray:
+        dtype, shape, blob = self._store[key]
+        # copy the blob to simulate the buffer received from the socket
+        return np.frombuffer(bytes(blob), dtype=dtype).reshape(shape)
+
+    def tensorset(self, key: str, tensor: np.ndarray, shape=None, dtype: str = None) -> str:
+        self._round_trip(self._tensorset(key, tensor, dtype))
+        return 'OK'
+
+    def tensorget(self, key: str, *args, **kwargs) -> np.ndarray:
+        t = self._tensorget(key)
+        self._round_trip(t.nbytes)
+        return t
+
+    def set(self, key: str, value: bytes):
+        self._kv[key] = _encode(value)
+        self._round_trip(len(self._kv[key]))
+        return True
+
+    def get(self, key: str) -> bytes:
+        value = self._kv.get(key)
+        self._round_trip(len(value) if value is not None else 0)
+        return value
+
+    def incr(self, key: str) -> int:
+        self._round_trip(0)
+        return self._incr(key)
+
+    def expire(self, key: str, seconds: int) -> bool:
+        # keys never expire in the stand-in
+        self._round_trip(0)
+        return key in self._kv or key in self._store
+
+    def exists(self, *keys: str) -> int:
+        self._round_trip(0)
+        return sum(k in self._kv or k in self._store for k in keys)
+
+    def delete(self, *keys: str) -> int:
+        self._round_trip(0)
+        return sum(self._kv.pop(k, None) is not None or self._store.pop(k, None) is not None
+                   for k in keys)
+
+    def pipeline(self, transaction: bool = True) -> 'LocalPipeline':
+        return LocalPipeline(self)
+
+    def close(self):
+        pass
+
+
+class LocalPipeline:
+    """Buffers the commands and executes them in a single simulated round trip"""
+
+    def __init__(self, server: LocalRedisAI):
+        self._server = server
+        self._commands: List[Tuple] = []
+
+    def tensorset(self, key: str, tensor: np.ndarray, shape=None, dtype: str = None):
+        self._commands.append(('tensorset', key, tensor, dtype))
+        return self
+
+    def tensorget(self, key: str, *args, **kwargs):
+        self._commands.append(('tensorget', key))
+        return self
+
+    def execute_command(self, command: str, key: str, *args):
+        # only raw AI.TENSORSET commands with a BLOB are supported
+        assert command == 'AI.TENSORSET' and args[-2] == 'BLOB'
+        dtype, shape, blob = args[0], args[1:-2], args[-1]
+        tensor = np.frombuffer(blob, dtype=_DTYPES[dtype]).reshape(shape)
+        self._commands.append(('tensorset', key, tensor, None))
+        return self
+
+    def set(self, key: str, value: bytes):
+        self._commands.append(('set', key, value))
+        return self
+
+    def get(self, key: str):
+        self._commands.append(('get', key))
+        return self
+
+    def incr(self, key: str):
+        self._commands.append(('incr', key))
+        return self
+
+    def expire(self, key: str, seconds: int):
+        self._commands.append(('expire', key))
+        return self
+
+    def exists(self, *keys: str):
+        self._commands.append(('exists', *keys))
+        return self
+
+    def execute(self) -> List:
+        results, nbytes = [], 0
+        for command, key, *args in self._commands:
+            if command == 'tensorset':
+                nbytes += self._server._tensorset(key, *args)
+                results.append('OK')
+            elif command == 'tensorget':
+                t = self._server._tensorget(key)
+                nbytes += t.nbytes
+                results.append(t)
+            elif command == 'set':
+                self._server._kv[key] = _encode(args[0])
+                nbytes += len(self._server._kv[key])
+                results.append(True)
+            elif command == 'get':
+                value = self._server._kv.get(key)
+                nbytes += len(value) if value is not None else 0
+                results.append(value)
+            elif command == 'incr':
+                results.append(self._server._incr(key))
+            elif command == 'expire':
+                results.append(key in self._server._kv or key in self._server._store)
+            elif command == 'exists':
+                results.append(sum(k in self._server._kv or k in self._server._store for k in (key, *args)))
+
+        self._commands = []
+        self._server._round_trip(nbytes)
+        return results
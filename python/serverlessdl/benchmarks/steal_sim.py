@@ -0,0 +1,101 @@
+"""
+Simulator of the work stealing between the functions of an interval.
+
+Every function trains its planned chunks of each interval at its own speed, and the
+interval ends when the slowest one finishes. With stealing the functions that finish
+early claim the chunks not yet started by the others, paying --load ms to read each
+stolen chunk from the storage. Reports the mean time of an interval and the fraction
+of the chunks that were stolen.
+
+The functions run at --speed batches/s, --slow of them --slowdown times slower, and each
+interval adds some noise to the speed of every function.
+
+    python benchmarks/steal_sim.py --functions 8 --slow 1 --slowdown 2 --chunk-batches 4 8 16
+"""
+import argparse
+import heapq
+
+import numpy as np
+
+from serverlessdl.util import plan_partitions, PARTITION_PAD
+
+
+def simulate(steps, speeds: np.ndarray, chunk_batches: int, load: float, steal: bool):
+    """
+    Simulates an interval, returns its time and the number of chunks stolen
+
+    :param steps: batches planned for each function
+    :param speeds: batches per second of each function
+    :param chunk_batches: batches per chunk
+    :param load: seconds to read a stolen chunk
+    :param steal: whether the functions steal chunks
+    """
+    n = len(steps)
+    if not steal:
+        return float(np.max(np.asarray(steps) / speeds)), 0
+
+    chunks = [[min(chunk_batches, s - c) for c in range(0, s, chunk_batches)] for s in steps]
+    claimed = [0] * n
+    stolen = 0
+
+    # every function claims the next chunk when it is free, its own first
+    free = [(0.0, f) for f in range(n)]
+    end = 0.0
+    while free:
+        now, f = heapq.heappop(free)
+        owner = next((o for o in [(f + i) % n for i in range(n)] if claimed[o] < len(chunks[o])), None)
+        if owner is None:
+            end = max(end, now)
+            continue
+        batches = chunks[owner][claimed[owner]]
+        claimed[owner] += 1
+        cost = batches / speeds[f]
+        if owner != f:
+            cost += load
+            stolen += 1
+        heapq.heappush(free, (now + cost, f))
+
+    return end, stolen
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=50000)
+    parser.add_argument('--functions', type=int, default=8)
+    parser.add_argument('--K', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--speed', type=float, default=20, help='batches per second of a function')
+    parser.add_argument('--slow', type=int, default=1, help='number of slow functions')
+    parser.add_argument('--slowdown', type=float, default=2)
+    parser.add_argument('--noise', type=float, default=0.1, help='deviation of the speed in each interval')
+    parser.add_argument('--load', type=float, default=50, help='ms to read a stolen chunk')
+    parser.add_argument('--chunk-batches', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # the functions are planned the same samples, so the differences come from their speed
+    plan = plan_partitions(args.samples, args.functions, args.K, args.batch_size, mode=PARTITION_PAD)
+    print(plan)
+    steps = [plan.steps(f) for f in range(args.functions)]
+
+    base = np.full(args.functions, args.speed, dtype=np.float64)
+    base[:args.slow] /= args.slowdown
+
+    runs = [('no stealing', False, 1)] + [(f'stealing {c}', True, c) for c in args.chunk_batches]
+    for name, steal, chunk_batches in runs:
+        rng = np.random.RandomState(args.seed)
+        times, stolen, total = [], 0, 0
+        for interval in range(len(steps[0])):
+            speeds = base * np.maximum(0.1, 1 + args.noise * rng.randn(args.functions))
+            interval_steps = [s[interval] for s in steps]
+            t, s = simulate(interval_steps, speeds, chunk_batches, args.load / 1e3, steal)
+            times.append(t)
+            stolen += s
+            total += sum(-(-i // chunk_batches) for i in interval_steps)
+
+        print(f'{name:<14} interval={np.mean(times):7.3f}s epoch={np.sum(times):8.2f}s '
+              f'stolen={stolen / total if steal else 0:6.3f}')
+
+
+if __name__ == '__main__':
+    main()
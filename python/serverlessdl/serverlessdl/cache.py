@@ -0,0 +1,215 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import redis
+import torch
+
+from .flat import FlatIndex
+
+# Bounds of the optimizer state cache kept by each function process
+OPTIMIZER_CACHE_BYTES = int(os.environ.get('OPTIMIZER_CACHE_BYTES', 512 * 1024 * 1024))
+OPTIMIZER_CACHE_ENTRIES = int(os.environ.get('OPTIMIZER_CACHE_ENTRIES', 8))
+
+# Seconds between the checks of the finished jobs while the process keeps serving the same job
+OPTIMIZER_CACHE_CHECK_SECONDS = int(os.environ.get('OPTIMIZER_CACHE_CHECK_SECONDS', 60))
+
+
+def version_key(job_id: str) -> str:
+    """
+    Returns the key holding the version of the reference model of a job. The version
+    is increased by every writer of the reference model (the init function and the
+    parameter server after each merge)
+    """
+    return f'{job_id}:version'
+
+
+def parse_version(value) -> Optional[int]:
+    """Parses the version read from redis, None if the job has no version"""
+    return int(value) if value is not None else None
+
+
+class ModelCache:
+    """
+    ModelCache keeps in the process the last reference model loaded by the function,
+    tagged with the job and the version of the model.
+
+    Fission keeps the environment process warm between invocations, so when the
+    reference model has not changed since it was last loaded by this process the
+    function can skip fetching it from the storage. The weights are kept in a single
+    preallocated float32 buffer that is reused by the following models of the same or
+    smaller size, so warm pods don't reallocate it on every invocation.
+    """
+
+    def __init__(self):
+        self.job_id = None
+        self.version = None
+        self._buffer = None
+        self._state = None
+
+    def get(self, job_id: str, version: Optional[int]) -> Optional[Dict[str, torch.Tensor]]:
+        """
+        Returns the cached state dict if it matches the job and version, None otherwise
+
+        :param job_id: id of the job
+        :param version: version of the reference model in the storage
+        """
+        if version is None or self._state is None:
+            return None
+        if self.job_id != job_id or self.version != version:
+            return None
+
+        logging.debug(f'Model cache hit for job {job_id}, version {version}')
+        return self._state
+
+    def put(self, job_id: str, version: Optional[int], state: Dict[str, torch.Tensor]):
+        """
+        Saves a copy of the state dict in the cache
+
+        :param job_id: id of the job
+        :param version: version of the model, if None the cache is cleared
+        :param state: the state dict
+        """
+        if version is None:
+            self.clear()
+            return
+
+        index = FlatIndex.from_state_dict(state)
+        if self._buffer is None or len(self._buffer) < index.numel:
+            logging.debug(f'Allocating model cache buffer of {index.numel} elements')
+            self._buffer = np.empty(index.numel, dtype=np.float32)
+
+        buffer = self._buffer[:index.numel]
+        index.pack(state, out=buffer)
+        self._state = index.unpack(buffer)
+        self.job_id, self.version = job_id, version
+
+    def clear(self):
+        """Drops the cached model, the buffer is kept to be reused"""
+        self.job_id, self.version, self._state = None, None, None
+
+
+# cache shared by all the invocations served by this process
+model_cache = ModelCache()
+
+
+def optimizer_version_key(job_id: str, func_id: int) -> str:
+    """
+    Returns the key holding the version of the optimizer state saved by a function, which
+    identifies the epoch and iteration at the end of which the state was saved
+    """
+    return f'{job_id}:optimizer:{func_id}:version'
+
+
+class OptimizerCache:
+    """
+    OptimizerCache keeps in the process the encoded optimizer states saved by the
+    functions served by it, tagged with the version of the state.
+
+    When a warm pod serves the same function of a job again, the state can be taken
+    from memory as long as the version saved in the storage matches the cached one. If another
+    pod served the function in between, the versions differ and the state is read from the storage.
+
+    The cache is bounded in entries and bytes, evicting the least recently used states, and the
+    states of the jobs that finished are dropped when the process starts serving another job
+    or periodically while it serves the same one.
+    """
+
+    def __init__(self, max_bytes: int = OPTIMIZER_CACHE_BYTES, max_entries: int = OPTIMIZER_CACHE_ENTRIES,
+                 check_seconds: float = OPTIMIZER_CACHE_CHECK_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.check_seconds = check_seconds
+        self.nbytes = 0
+        self._entries: 'OrderedDict[Tuple[str, int], Tuple[str, bytes]]' = OrderedDict()
+
+        # job served and time of the last check of the finished jobs
+        self._checked_job = None
+        self._checked_at = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, job_id: str, func_id: int, version: Optional[str]) -> Optional[bytes]:
+        """
+        Returns the encoded state if the cached version matches the given one
+
+        :param job_id: id of the job
+        :param func_id: id of the function
+        :param version: version of the state in the storage
+        :return: the encoded state or None if missing or stale
+        """
+        entry = self._entries.get((job_id, func_id))
+        if entry is None or version is None or entry[0] != version:
+            return None
+
+        self._entries.move_to_end((job_id, func_id))
+        logging.debug(f'Optimizer cache hit for job {job_id}, function {func_id}, version {version}')
+        return entry[1]
+
+    def put(self, job_id: str, func_id: int, version: str, blob: bytes):
+        """
+        Caches the encoded state of a function, evicting the least recently
+        used states if the cache is full. States bigger than the cache are not kept
+
+        :param job_id: id of the job
+        :param func_id: id of the function
+        :param version: version of the state
+        :param blob: the encoded state
+        """
+        self.remove(job_id, func_id)
+        if len(blob) > self.max_bytes:
+            return
+
+        self._entries[(job_id, func_id)] = (version, blob)
+        self.nbytes += len(blob)
+
+        while self.nbytes > self.max_bytes or len(self._entries) > self.max_entries:
+            (old_job, old_func), _ = next(iter(self._entries.items()))
+            logging.debug(f'Evicting optimizer state of job {old_job}, function {old_func}')
+            self.remove(old_job, old_func)
+
+    def remove(self, job_id: str, func_id: int):
+        """Drops the state of a function if present"""
+        entry = self._entries.pop((job_id, func_id), None)
+        if entry is not None:
+            self.nbytes -= len(entry[1])
+
+    def evict_job(self, job_id: str):
+        """Drops the states of all the functions of a job"""
+        for key in [k for k in self._entries if k[0] == job_id]:
+            self.remove(*key)
+
+    def evict_finished_jobs(self, client: redis.Redis, current_job: str):
+        """
+        Drops the states of the jobs that finished. When a job ends the parameter server
+        clears all its keys, including the version of its reference model. The storage is only
+        checked when the served job changes or check_seconds passed since the last check
+
+        :param client: redis client
+        :param current_job: job being served, which is not checked
+        """
+        now = time.monotonic()
+        if current_job == self._checked_job and now - self._checked_at < self.check_seconds:
+            return
+        self._checked_job, self._checked_at = current_job, now
+
+        jobs = sorted({job_id for job_id, _ in self._entries if job_id != current_job})
+        if not jobs:
+            return
+
+        pipe = client.pipeline(transaction=False)
+        for job_id in jobs:
+            pipe.exists(version_key(job_id))
+
+        for job_id, exists in zip(jobs, pipe.execute()):
+            if not exists:
+                logging.debug(f'Job {job_id} finished, evicting its optimizer states')
+                self.evict_job(job_id)
+
+
+# optimizer states of the functions served by this process
+optimizer_cache = OptimizerCache()
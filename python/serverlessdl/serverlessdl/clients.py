@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+import redis
+import redisai as rai
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure
+
+# Load from environment the values from the REDIS and MONGO IP and PORT
+try:
+    REDIS_URL = os.environ['REDIS_URL']
+    REDIS_PORT = os.environ['REDIS_PORT']
+    logging.debug(f'Found configuration for redis {REDIS_URL}:{REDIS_PORT}')
+except KeyError:
+    logging.debug("Could not find redis configuration in env, using defaults")
+    REDIS_URL = "redisai.kubeml"
+    REDIS_PORT = 6379
+
+try:
+    MONGO_URL = os.environ['MONGO_IP']
+    MONGO_PORT = os.environ['MONGO_PORT']
+    logging.debug(f'Found configuration for storage {MONGO_URL}:{MONGO_PORT}')
+except KeyError:
+    logging.debug("Could not find mongo configuration in env, using defaults")
+    MONGO_URL = "mongodb.kubeml"
+    MONGO_PORT = 27017
+
+# Max connections kept open by each function process to redis and mongo
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 8))
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 8))
+
+# Seconds after which an idle redis connection is checked before being used,
+# and period of the checks of the mongo servers
+HEALTH_CHECK_SECONDS = int(os.environ.get('HEALTH_CHECK_SECONDS', 30))
+
+# Seconds waited for a free redis connection when all of them are in use
+REDIS_POOL_TIMEOUT = int(os.environ.get('REDIS_POOL_TIMEOUT', 20))
+
+# Clients shared by the invocations served by this process. Fission keeps the
+# environment process warm between invocations, so the connections are reused
+# instead of being opened and closed by every function
+_lock = threading.Lock()
+_redis: Optional[rai.Client] = None
+_mongo: Optional[MongoClient] = None
+
+
+def redis_client() -> rai.Client:
+    """
+    Returns the redis client of the process, backed by a pool of connections
+    that are health checked when they have been idle and reopened if broken
+    """
+    global _redis
+    with _lock:
+        if _redis is None:
+            logging.debug(f'Creating redis connection pool to {REDIS_URL}:{REDIS_PORT}')
+            pool = redis.BlockingConnectionPool(host=REDIS_URL, port=int(REDIS_PORT),
+                                                max_connections=REDIS_MAX_CONNECTIONS,
+                                                timeout=REDIS_POOL_TIMEOUT,
+                                                health_check_interval=HEALTH_CHECK_SECONDS,
+                                                socket_keepalive=True,
+                                                retry_on_timeout=True)
+            _redis = rai.Client(connection_pool=pool)
+        return _redis
+
+
+def mongo_client() -> MongoClient:
+    """
+    Returns the mongo client of the process. The client keeps its own pool of
+    connections and monitors the servers, reconnecting when they are back
+    """
+    global _mongo
+    with _lock:
+        if _mongo is None:
+            logging.debug(f'Creating mongo client to {MONGO_URL}:{MONGO_PORT}')
+            _mongo = MongoClient(MONGO_URL, int(MONGO_PORT),
+                                 maxPoolSize=MONGO_MAX_POOL_SIZE,
+                                 heartbeatFrequencyMS=HEALTH_CHECK_SECONDS * 1000)
+        return _mongo
+
+
+def reset_after_fork():
+    """
+    Drops the clients inherited by a forked process without closing them. Their
+    connections are shared with the parent process, so the child opens its own
+    ones if it needs to access the storage
+    """
+    global _lock, _redis, _mongo
+    _lock = threading.Lock()
+    _redis, _mongo = None, None
+
+
+def reset_redis(e: Exception):
+    """
+    Drops the redis client after a connection error, so the next invocation
+    starts from a new pool. The connections still in use are released when
+    the threads using them finish
+
+    :param e: the error raised by the client
+    """
+    global _redis
+    if isinstance(e, (redis.ConnectionError, redis.TimeoutError)):
+        logging.warning(f'Resetting redis connection pool after error: {e}')
+        with _lock:
+            _redis = None
+
+
+def reset_mongo(e: Exception):
+    """
+    Closes the mongo client after a connection error, so the next invocation
+    starts from a new client
+
+    :param e: the error raised by the client
+    """
+    global _mongo
+    if isinstance(e, ConnectionFailure):
+        logging.warning(f'Resetting mongo client after error: {e}')
+        with _lock:
+            client, _mongo = _mongo, None
+        if client is not None:
+            client.close()
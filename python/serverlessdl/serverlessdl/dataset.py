@@ -1,24 +1,208 @@
-import pickle
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 import numpy as np
 import torch.utils.data as data
 from flask import request
-from pymongo import MongoClient
 from pymongo.errors import PyMongoError
 
+from .clients import mongo_client, reset_mongo
+from .encoding import decode_array
 from .exceptions import *
+from .subset_cache import metadata_version, subset_cache
 from .util import *
 
-# Load from environment the values from th MONGO IP and PORT
-try:
-    MONGO_URL = os.environ['MONGO_IP']
-    MONGO_PORT = os.environ['MONGO_PORT']
-    logging.debug(f'Found configuration for storage {MONGO_URL}:{MONGO_PORT}')
-except KeyError:
-    logging.debug("Could not find mongo configuration in env, using defaults")
-    MONGO_URL = "mongodb.kubeml"
-    MONGO_PORT = 27017
+# Collection and id of the metadata document saved by the storage service
+METADATA_COLLECTION = 'metadata'
+METADATA_ID = 'dataset'
+
+# Seconds the metadata of a dataset is kept by the function process, so warm
+# invocations don't query it again. It is refreshed after that in case the
+# dataset is deleted and uploaded again with the same name
+METADATA_CACHE_SECONDS = int(os.environ.get('METADATA_CACHE_SECONDS', 300))
+
+# metadata of the datasets read by this process with the time it was read
+_metadata_cache: Dict[str, Tuple[float, dict]] = {}
+
+# Shards the subsets loaded by a function are split in to read them in parallel,
+# each with its own cursor, and documents fetched by each round trip of the cursors
+READ_SHARDS = int(os.environ.get('READ_SHARDS', 4))
+READ_BATCH_SIZE = int(os.environ.get('READ_BATCH_SIZE', 16))
+
+# threads reading the shards by number of shards, shared by the invocations served by this process
+_read_executors: Dict[int, ThreadPoolExecutor] = {}
+_read_executors_lock = threading.Lock()
+
+
+def _read_executor(shards: int) -> ThreadPoolExecutor:
+    """Returns the threads reading the given number of shards, so
+    every shard of a read gets its own thread however many are used"""
+    shards = max(1, shards)
+    with _read_executors_lock:
+        executor = _read_executors.get(shards)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=shards, thread_name_prefix=f'kubeml-read-{shards}')
+            _read_executors[shards] = executor
+        return executor
+
+
+def _get_metadata(database) -> Optional[dict]:
+    """
+    Returns the metadata document of a dataset from the process cache or
+    the storage, None if the dataset has no metadata
+
+    :param database: the database of the dataset
+    """
+    cached = _metadata_cache.get(database.name)
+    if cached is not None and time.monotonic() - cached[0] < METADATA_CACHE_SECONDS:
+        return cached[1]
+
+    metadata = database[METADATA_COLLECTION].find_one({'_id': METADATA_ID})
+    if metadata is not None and metadata.get('ready', True):
+        _metadata_cache[database.name] = (time.monotonic(), metadata)
+    return metadata
+
+
+def assemble_subsets(batches: Iterable[dict], num_subsets: int,
+                     subset_size: int = STORAGE_SUBSET_SIZE,
+                     out: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decodes the subsets of a dataset into a single array of features and labels.
+
+    The output arrays are allocated once with the capacity of all the subsets, based
+    on the shape of the first one, and each subset is decoded directly into its slice, so
+    the memory used is about the size of the data loaded. Subsets saved in the raw format
+    are copied from the bytes of the document into the slice without intermediate arrays.
+
+    :param batches: the documents of the subsets
+    :param num_subsets: number of subsets that will be loaded
+    :param subset_size: expected number of samples per subset
+    :param out: arrays of features and labels to decode the subsets into instead of allocating
+        new ones, used if the type and shape of the samples match
+    :return: the numpy arrays holding the features and labels of the data
+    """
+    data, labels, n = None, None, 0
+    for batch in batches:
+
+        # load the data and the labels as numpy arrays
+        # flatten the labels so instead of i.e (64,1) they're (64,)
+        d = decode_array(batch['data'])
+        l = decode_array(batch['labels']).reshape(-1)
+
+        if data is None and out is not None and _fits(out[0], d) and _fits(out[1], l):
+            data, labels = out
+        elif data is None:
+            capacity = num_subsets * max(subset_size, len(d))
+            data = np.empty((capacity, *d.shape[1:]), dtype=d.dtype)
+            labels = np.empty(capacity, dtype=l.dtype)
+
+        # subsets bigger than expected, grow the arrays
+        if n + len(d) > len(data):
+            capacity = max(2 * len(data), n + len(d))
+            data = _grow(data, capacity)
+            labels = _grow(labels, capacity)
+
+        data[n:n + len(d)] = d
+        labels[n:n + len(l)] = l
+        n += len(d)
+
+    if data is None:
+        return np.empty(0), np.empty(0, dtype=np.int64)
+
+    return data[:n], labels[:n]
+
+
+def _samples(metadata: dict, subsets: range, subset_size: int) -> int:
+    """Returns the number of samples in the given subsets of a collection"""
+    return max(0, min(subsets.stop * subset_size, metadata['samples']) - subsets.start * subset_size)
+
+
+def _runs(ids: Iterable[int]) -> List[range]:
+    """Groups the ids in ranges of consecutive ids, keeping their order"""
+    runs = []
+    for i in ids:
+        if runs and runs[-1].stop == i:
+            runs[-1] = range(runs[-1].start, i + 1)
+        else:
+            runs.append(range(i, i + 1))
+    return runs
+
+
+def _layout(metadata: dict, subsets: Sequence[int], subset_size: int) -> List[Tuple[range, int, int]]:
+    """Groups the subsets in runs of consecutive ids along with the slice of the output they fill"""
+    layout, pos = [], 0
+    for run in _runs(subsets):
+        n = _samples(metadata, run, subset_size)
+        layout.append((run, pos, pos + n))
+        pos += n
+    return layout
+
+
+def _allocate(metadata: dict, n: int,
+              out: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the arrays n samples are decoded into, views of out if they fit"""
+    shape = (n, *metadata['shape'])
+    dtype, label_dtype = np.dtype(metadata['dtype']), np.dtype(metadata['label_dtype'])
+
+    if out is not None:
+        features, targets = out
+        if features.dtype == dtype and features.shape[1:] == shape[1:] and len(features) >= n \
+                and targets.dtype == label_dtype and len(targets) >= n:
+            return features[:n], targets[:n]
+
+    return np.empty(shape, dtype=dtype), np.empty(n, dtype=label_dtype)
+
+
+def _read_runs(col, layout: List[Tuple[range, int, int]], subset_size: int, shards: int,
+               data: np.ndarray, labels: np.ndarray):
+    """Reads the runs of subsets into their slices of the output, split in about the given shards"""
+    total = sum(len(run) for run, _, _ in layout)
+    executor = _read_executor(shards)
+    futures, expected = [], 0
+    for run, start, end in layout:
+        parts = min(len(run), max(1, round(shards * len(run) / total)))
+        bounds = np.linspace(run.start, run.stop, parts + 1).astype(int)
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if hi > lo:
+                pos = start + (lo - run.start) * subset_size
+                futures.append(executor.submit(_read_shard, col, range(lo, hi), pos, subset_size, data, labels))
+        expected += end - start
+
+    # wait for all the shards before raising so none keeps writing to the output
+    wait(futures)
+    read = sum(f.result() for f in futures)
+    if read != expected:
+        raise StorageError(ValueError(f'Expected {expected} samples from {col.name}, read {read}'))
+
+
+def _read_shard(col, ids: range, pos: int, subset_size: int, data: np.ndarray, labels: np.ndarray) -> int:
+    cursor = col.find({'_id': {'$gte': ids.start, '$lt': ids.stop}},
+                      projection={'data': True, 'labels': True},
+                      batch_size=READ_BATCH_SIZE)
+
+    read = 0
+    for batch in cursor:
+        d = decode_array(batch['data'])
+        l = decode_array(batch['labels']).reshape(-1)
+        start = pos + (batch['_id'] - ids.start) * subset_size
+        data[start:start + len(d)] = d
+        labels[start:start + len(l)] = l
+        read += len(d)
+    return read
+
+
+def _fits(arr: np.ndarray, subset: np.ndarray) -> bool:
+    return arr.dtype == subset.dtype and arr.shape[1:] == subset.shape[1:]
+
+
+def _grow(arr: np.ndarray, capacity: int) -> np.ndarray:
+    out = np.empty((capacity, *arr.shape[1:]), dtype=arr.dtype)
+    out[:len(arr)] = arr
+    return out
 
 
 class _KubeArgs:
@@ -88,42 +272,63 @@ class KubeDataset(data.Dataset, ABC):
     loaded from the database
     """
 
-    def __init__(self, dataset: str):
+    def __init__(self, dataset: str, read_shards: int = READ_SHARDS):
         """
         Init reads the data from the database given the dataset name
 
         :arg dataset Name of the dataset in the KubeML storage service
+        :arg read_shards Number of shards in which the subsets are read in parallel
         """
 
         self.dataset = dataset
+        self.read_shards = read_shards
         self._mode = None
-        self._client = MongoClient(MONGO_URL, MONGO_PORT)
+        self._client = mongo_client()
         self._database = self._client[dataset]
         self._args = None
 
         # data and labels of the dataset
         self.data, self.labels = None, None
+        self.metadata = None
+        self.subset_size = STORAGE_SUBSET_SIZE
+        self.preprocessing = None
 
-        # Check first if the dataset that the user gave as input
-        # is available in the configured storage service
+        # Set the range of minibatches that this function will train on and the ones
+        # that will be used for validation from the metadata of the dataset, which is
+        # cached by the process. Datasets uploaded before the storage saved their metadata
+        # have subsets of the default size and must be checked and counted
         try:
-            dbs = set(self._client.list_database_names())
-            if self.dataset not in dbs:
-                logging.error(f"Dataset not in the storage service. "
-                              f"Dataset = {dataset},"
-                              f"Available = {dbs}")
-                self._client.close()
-                raise DatasetNotFoundError
+            self.metadata = _get_metadata(self._database)
+            if self.metadata is None:
+                dbs = set(self._client.list_database_names())
+                if self.dataset not in dbs:
+                    logging.error(f"Dataset not in the storage service. "
+                                  f"Dataset = {dataset},"
+                                  f"Available = {dbs}")
+                    raise DatasetNotFoundError
+
+                self.num_docs = self._database["train"].estimated_document_count()
+                self.num_val_docs = self._database["test"].estimated_document_count()
+                self.num_samples = self._count_legacy_samples()
+
+            elif not self.metadata.get('ready', True):
+                # the metadata is saved without the collections until the upload completes
+                logging.error(f"Dataset {dataset} is still being uploaded")
+                raise DatasetNotReadyError
+
+            else:
+                self.subset_size = self.metadata['subset_size']
+                self.preprocessing = self.metadata.get('transform')
+                self.num_docs = self.metadata['train']['subsets']
+                self.num_val_docs = self.metadata['test']['subsets']
+                self.num_samples = self.metadata['train']['samples']
 
         except PyMongoError as e:
-            self._client.close()
+            reset_mongo(e)
             raise StorageError(e)
 
-        # Set the range of minibatches that this function will train on and the ones
-        # that will be used for validation
-        self.num_docs = self._database["train"].count_documents({})
-        self.num_val_docs = self._database["test"].count_documents({})
-        logging.debug(f"Num docs: {self.num_docs}, Num val docs: {self.num_val_docs}")
+        logging.debug(f"Num docs: {self.num_docs}, Num val docs: {self.num_val_docs}, "
+                      f"subset size: {self.subset_size}")
 
     def _eval(self):
         """
@@ -147,23 +352,98 @@ class KubeDataset(data.Dataset, ABC):
         """
         return self._mode == 'train'
 
-    def _load_train_data(self, start: int, end: int):
+    def is_preprocessed(self) -> bool:
         """
-        For K averaging the data needs to be refreshed with the next K batches
-        after every synchronization step, this is triggered by the KubeModel before
-        starting another iteration
+        Sees if the samples were preprocessed by the storage service at upload. The
+        preprocessing applied (layout, type, mean and std) is given by the preprocessing
+        property. Preprocessed samples are usually fed to the network without a per sample
+        conversion, in which case the dataset doesn't need to define __getitem__. Samples
+        stored as float16 are cast to float32 when building the minibatches
 
-        :param start: first subset to be loaded
-        :param end: last subset to be loaded
+        :return: True if the samples were preprocessed, false otherwise
         """
-        # load the minibatches given by the network
-        minibatches = range(start, end)
-        logging.debug(f"Loading minibatches {minibatches}")
-        self.data, self.labels = self.__load_data(minibatches)
+        return self.preprocessing is not None
+
+    def transform_batch(self, data: torch.Tensor, labels: torch.Tensor):
+        """
+        Hook to transform whole minibatches instead of single samples. If a dataset overrides it,
+        the minibatches are built by indexing the data with the indices of the whole batch instead
+        of calling __getitem__ for each sample, and the features and labels are passed to this method
+        as tensors, so vectorized transforms (see serverlessdl.transforms) can be applied to all the
+        samples at once
+
+        :param data: the features of the minibatch
+        :param labels: the labels of the minibatch
+        :return: the minibatch passed to the train and validate methods of the model
+        """
+        return data, labels
 
-        # put the dataset in train mode
+    def _is_batched(self) -> bool:
+        """Whether the dataset overrides transform_batch or has no per sample __getitem__"""
+        return type(self).transform_batch is not KubeDataset.transform_batch \
+            or type(self).__getitem__ is data.Dataset.__getitem__
+
+    def _get_batch(self, indices: List[int]):
+        """
+        Builds the minibatch with the given indices and transforms it. Samples stored as
+        float16 to halve the transfers are cast to float32, the type of the networks
+        """
+        batch = torch.from_numpy(self.data[indices])
+        if batch.dtype == torch.float16:
+            batch = batch.float()
+        return self.transform_batch(batch, torch.from_numpy(self.labels[indices]))
+
+    def _count_legacy_samples(self) -> int:
+        """
+        Counts the train samples of a dataset uploaded without metadata, in which
+        all the subsets but the last one hold the default number of samples
+        """
+        if self.num_docs == 0:
+            return 0
+        last = self._database["train"].find_one({'_id': self.num_docs - 1}, projection={'labels': True})
+        if last is None:
+            raise StorageError(ValueError(f'Subset {self.num_docs - 1} of {self.dataset} not found'))
+        return (self.num_docs - 1) * self.subset_size + len(decode_array(last['labels']).reshape(-1))
+
+    def _fetch_train_subsets(self, subsets: Sequence[int],
+                             out: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Fetches the given train subsets, which don't need to be consecutive,
+        without setting them as the data of the dataset
+
+        :param subsets: ids of the subsets to be loaded
+        :param out: arrays to decode the data into if they fit, see assemble_subsets
+        :return: the features and labels of the subsets
+        """
+        logging.debug(f"Loading minibatches {subsets}")
+        return self.__load_data(subsets, out=out)
+
+    def _set_train_data(self, data: np.ndarray, labels: np.ndarray):
+        """
+        Sets the data used for training and puts the dataset in train mode
+
+        :param data: the features
+        :param labels: the labels
+        """
+        self.data, self.labels = data, labels
         self._train()
 
+    def _estimate_bytes(self, num_subsets: int) -> Optional[int]:
+        """
+        Estimates the memory used by the given number of train subsets from the
+        metadata of the dataset
+
+        :param num_subsets: number of subsets
+        :return: the estimated bytes, None if the dataset has no metadata
+        """
+        if self.metadata is None:
+            return None
+
+        train = self.metadata['train']
+        sample = int(np.prod(train['shape'], dtype=np.int64)) * np.dtype(train['dtype']).itemsize
+        label = np.dtype(train['label_dtype']).itemsize
+        return num_subsets * self.subset_size * (sample + label)
+
     def _load_validation_data(self, start: int, end: int):
         """
         Loads the validation data given the subsets assigned to this functions
@@ -178,50 +458,92 @@ class KubeDataset(data.Dataset, ABC):
         # put the dataset in validation mode
         self._eval()
 
-    def _close(self):
-        self._client.close()
-
-    def __load_data(self, minibatches: range, validation=False):
+    def __load_data(self, minibatches: Sequence[int], validation=False, out=None):
         """
         Load the data needed to perform the train or validation tasks.
 
         Based on the minibatches, load the validation or train subsets that are
         within the limits of the given range
 
-        :param minibatches: start and stop ids of the subsets that we must load
+        :param minibatches: ids of the subsets that we must load, a range or a list
         :param validation: whether to load the validation data instead of the train data
+        :param out: arrays to decode the data into if they fit
         :return: the numpy arrays holding the features and labels of the data
         """
 
+        start = datetime.now()
+
+        # datasets with metadata are read in parallel shards, the
+        # ones uploaded without it are read with a single cursor
+        shards = self.read_shards if self.metadata is not None else 1
         try:
             # based on the validation flag load the data from a different collection
             collection = 'test' if validation else 'train'
-            batches = self._database[collection].find({
-                '_id': {
-                    '$gte': minibatches.start,
-                    '$lte': minibatches.stop - 1}
-            })
+            if self.metadata is not None:
+                data, labels = self.__read_subsets(collection, minibatches, shards, out)
+            else:
+                if isinstance(minibatches, range):
+                    query = {'$gte': minibatches.start, '$lte': minibatches.stop - 1}
+                else:
+                    query = {'$in': list(minibatches)}
+                batches = self._database[collection].find({'_id': query}).sort('_id', 1)
+                data, labels = assemble_subsets(batches, len(minibatches), self.subset_size, out)
+
         except PyMongoError as e:
-            self._client.close()
+            reset_mongo(e)
             raise StorageError(e)
 
-        data, labels = None, None
-        for batch in batches:
-
-            # load the data and the labels as numpy arrays
-            # flatten the labels so instead of i.e (64,1) they're (64,)
-            # thus we can call hstack on them           
-            d = pickle.loads(batch['data'])
-            l = pickle.loads(batch['labels'])
+        logging.debug(f"Read {len(minibatches)} {collection} subsets in {min(shards, len(minibatches))} "
+                      f"shards, Read Time, {datetime.now() - start}")
+        return data, labels
 
-
-            if data is None:
-                data, labels = d, l.flatten()
+    def __read_subsets(self, collection: str, minibatches: Sequence[int], shards: int, out=None):
+        """
+        Reads the subsets in parallel shards into a single output. If the node cache is
+        enabled the subsets are taken from it, and the missing ones read from the storage
+        are then saved in the cache for the following epochs
+
+        :param collection: train or test
+        :param minibatches: the subsets to load
+        :param shards: number of shards the subsets are read in
+        :param out: arrays to decode the data into if they fit
+        :return: the numpy arrays holding the features and labels of the data
+        """
+        metadata = self.metadata[collection]
+        layout = _layout(metadata, minibatches, self.subset_size)
+        data, labels = _allocate(metadata, layout[-1][2] if layout else 0, out)
+        version = metadata_version(self.metadata) if subset_cache.enabled else None
+
+        missing = []
+        for run, start, _ in layout:
+            for i in run:
+                first = start + (i - run.start) * self.subset_size
+                last = first + _samples(metadata, range(i, i + 1), self.subset_size)
+                cached = subset_cache.get(self.dataset, version, collection, i, last - first) if version else None
+                if cached is None:
+                    missing.append((i, first, last))
+                    continue
+                data[first:last] = cached[0]
+                labels[first:last] = cached[1]
+
+        if version is not None:
+            logging.debug(f"Dataset cache hits: {len(minibatches) - len(missing)}, misses: {len(missing)}")
+
+        # group the missing subsets back in runs that fill consecutive slices of the output
+        runs = []
+        for i, first, last in missing:
+            if runs and runs[-1][0].stop == i and runs[-1][2] == first:
+                runs[-1] = (range(runs[-1][0].start, i + 1), runs[-1][1], last)
             else:
-                data = np.vstack([data, d])
-                labels = np.hstack([labels, l.flatten()])
+                runs.append((range(i, i + 1), first, last))
+        _read_runs(self._database[collection], runs, self.subset_size, shards, data, labels)
+
+        if version is not None and missing:
+            for i, first, last in missing:
+                subset_cache.put(self.dataset, version, collection, i, data[first:last], labels[first:last])
+            subset_cache.evict()
 
-        return data, labels.flatten()
+        return data, labels
 
     @abstractmethod
     def __len__(self):
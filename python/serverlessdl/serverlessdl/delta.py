@@ -0,0 +1,210 @@
+import struct
+import threading
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+# Sparsification applied to the deltas before publishing them
+# - dense: the whole delta is sent
+# - topk: only the ratio of the entries with the largest magnitude are sent
+# - threshold: only the entries whose magnitude is above the threshold are sent
+SPARSIFY_DENSE = 'dense'
+SPARSIFY_TOPK = 'topk'
+SPARSIFY_THRESHOLD = 'threshold'
+SPARSIFY_MODES = [SPARSIFY_DENSE, SPARSIFY_TOPK, SPARSIFY_THRESHOLD]
+
+# Each encoded layer is a header followed by the indices (only if sparse)
+# and the values. The header holds the kind of encoding, the type of the values
+# and the number of values
+_HEADER = struct.Struct('<BBQ')
+_KIND_DENSE, _KIND_SPARSE = 0, 1
+_VALUE_TYPES = [np.dtype('float32'), np.dtype('float16'), np.dtype('int64')]
+_INDEX_TYPE = np.dtype('int32')
+
+
+class DeltaConfig:
+    """
+    Options of the delta publish mode. In this mode the functions publish the difference
+    between the model they trained and the reference model they loaded at the start
+    of the iteration instead of the whole model.
+    """
+
+    def __init__(self,
+                 sparsify: str = SPARSIFY_DENSE,
+                 ratio: float = 0.01,
+                 threshold: float = 1e-3,
+                 fp16: bool = False,
+                 error_feedback: bool = True):
+        """
+        :param sparsify: one of dense, topk or threshold
+        :param ratio: fraction of the entries of each layer sent with topk
+        :param threshold: min magnitude of the entries sent with threshold
+        :param fp16: send the values as float16
+        :param error_feedback: keep the part of the delta that was not sent (dropped entries and
+            rounding errors) and add it to the delta of the next iteration
+        """
+        if sparsify not in SPARSIFY_MODES:
+            raise ValueError(f'Sparsify mode {sparsify} not recognized, must be one of {SPARSIFY_MODES}')
+        if not 0 < ratio <= 1:
+            raise ValueError(f'Top-k ratio must be in (0, 1], got {ratio}')
+
+        self.sparsify = sparsify
+        self.ratio = ratio
+        self.threshold = threshold
+        self.fp16 = fp16
+        self.error_feedback = error_feedback
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, DeltaConfig) and vars(self) == vars(other)
+
+
+def encode_delta(delta: torch.Tensor, config: DeltaConfig) -> Tuple[bytes, torch.Tensor]:
+    """
+    Encodes the delta of a layer according to the config
+
+    :param delta: difference between the new and the reference weights
+    :param config: the delta options
+    :return: the encoded delta and the delta as it will be decoded by the receiver
+    """
+    flat = delta.detach().reshape(-1)
+
+    # integer buffers are always sent exactly
+    if not flat.is_floating_point():
+        return _pack(_KIND_DENSE, None, flat.to(torch.int64).numpy()), delta
+
+    flat = flat.to(torch.float32)
+    value_type = np.float16 if config.fp16 else np.float32
+
+    indices = None
+    if config.sparsify == SPARSIFY_TOPK:
+        k = max(1, int(flat.numel() * config.ratio))
+        indices = torch.topk(flat.abs(), k, sorted=False).indices
+    elif config.sparsify == SPARSIFY_THRESHOLD:
+        indices = torch.nonzero(flat.abs() >= config.threshold, as_tuple=False).reshape(-1)
+
+    # if too many entries are sent the sparse format
+    # would be bigger than the dense one
+    item_size = np.dtype(value_type).itemsize
+    if indices is not None and len(indices) * (item_size + _INDEX_TYPE.itemsize) >= flat.numel() * item_size:
+        indices = None
+
+    if indices is None:
+        values = flat.numpy().astype(value_type)
+        blob = _pack(_KIND_DENSE, None, values)
+        sent = torch.from_numpy(values.astype(np.float32))
+    else:
+        values = flat[indices].numpy().astype(value_type)
+        blob = _pack(_KIND_SPARSE, indices.numpy().astype(_INDEX_TYPE), values)
+        sent = torch.zeros_like(flat)
+        sent[indices] = torch.from_numpy(values.astype(np.float32))
+
+    return blob, sent.view(delta.shape)
+
+
+def decode_delta(blob: bytes, shape: Sequence[int]) -> torch.Tensor:
+    """
+    Decodes a delta encoded with encode_delta into a dense tensor. Floating point
+    deltas are returned as float32 and integer ones as int64
+
+    :param blob: the encoded delta
+    :param shape: shape of the layer
+    :return: the dense delta
+    """
+    kind, value_type, count = _HEADER.unpack_from(blob)
+    value_type = _VALUE_TYPES[value_type]
+    offset = _HEADER.size
+
+    indices = None
+    if kind == _KIND_SPARSE:
+        indices = np.frombuffer(blob, dtype=_INDEX_TYPE, count=count, offset=offset)
+        offset += indices.nbytes
+    values = np.frombuffer(blob, dtype=value_type, count=count, offset=offset)
+    values = values.astype(np.int64 if value_type.kind == 'i' else np.float32)
+
+    if indices is None:
+        return torch.from_numpy(values).view(tuple(shape))
+
+    dense = torch.zeros(int(np.prod(shape, dtype=np.int64)), dtype=torch.float32)
+    dense[torch.from_numpy(indices.astype(np.int64))] = torch.from_numpy(values)
+    return dense.view(tuple(shape))
+
+
+def _pack(kind: int, indices: Optional[np.ndarray], values: np.ndarray) -> bytes:
+    header = _HEADER.pack(kind, _VALUE_TYPES.index(values.dtype), len(values))
+    if indices is None:
+        return header + values.tobytes()
+    return header + indices.tobytes() + values.tobytes()
+
+
+class DeltaEncoder:
+    """
+    DeltaEncoder encodes the deltas of the state dicts published by a function and
+    keeps the error feedback residuals between iterations
+    """
+
+    def __init__(self, config: DeltaConfig):
+        self.config = config
+        self.residuals: Dict[str, torch.Tensor] = {}
+
+    def encode(self, state: Dict[str, torch.Tensor],
+               reference: Dict[str, torch.Tensor]) -> Dict[str, bytes]:
+        """
+        Encodes the difference between the state dict and the reference one
+
+        :param state: the state dict after training
+        :param reference: the state dict loaded at the start of the iteration
+        :return: the encoded delta of each layer
+        """
+        encoded = {}
+        with torch.no_grad():
+            for name, t in state.items():
+                ref = reference[name]
+                delta = t.detach().cpu() - ref.to(t.dtype)
+                if self.config.error_feedback and name in self.residuals:
+                    delta += self.residuals[name]
+
+                encoded[name], sent = encode_delta(delta, self.config)
+
+                if self.config.error_feedback and delta.is_floating_point():
+                    self.residuals[name] = delta.float() - sent
+
+        return encoded
+
+    def reset(self):
+        """Drops the error feedback residuals"""
+        self.residuals = {}
+
+
+# Encoders of the functions served by this process. The KubeModel is built again in
+# every invocation, so the error feedback residuals are kept here between invocations
+_encoders_lock = threading.Lock()
+_encoders: Dict[Tuple[str, int], DeltaEncoder] = {}
+
+
+def delta_encoder(job_id: str, func_id: int, config: DeltaConfig) -> DeltaEncoder:
+    """
+    Returns the encoder of a function of a job, which keeps its residuals across the
+    invocations served by the process. The encoders of other jobs are dropped
+
+    :param job_id: id of the job
+    :param func_id: id of the function
+    :param config: the delta options, the residuals are dropped if they change
+    :return: the encoder
+    """
+    with _encoders_lock:
+        for key in [key for key in _encoders if key[0] != job_id]:
+            del _encoders[key]
+
+        encoder = _encoders.get((job_id, func_id))
+        if encoder is None or encoder.config != config:
+            encoder = _encoders[(job_id, func_id)] = DeltaEncoder(config)
+        return encoder
+
+
+def delta_key(job_id: str, name: str, func_id: int) -> str:
+    """
+    Returns the key of the delta of a layer published by a function. The parameter
+    server checks whether it exists to merge the function in delta mode
+    """
+    return f'{job_id}:{name}/{func_id}:delta'
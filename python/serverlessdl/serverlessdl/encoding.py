@@ -0,0 +1,75 @@
+import pickle
+from typing import Any, Dict
+
+import numpy as np
+
+# Optional compression libraries, only needed to read datasets
+# uploaded with the corresponding compression
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encodings of the arrays of a subset in the storage. Arrays are saved as
+# a document with the type, the shape and the raw bytes, optionally compressed.
+# Datasets uploaded by older versions of the storage service hold pickled arrays.
+# The storage service encodes them with its own copy of these definitions
+CODEC_RAW = 'raw'
+CODEC_LZ4 = 'lz4'
+CODEC_ZSTD = 'zstd'
+CODECS = [CODEC_RAW, CODEC_LZ4, CODEC_ZSTD]
+
+
+def encode_array(arr: np.ndarray, codec: str = CODEC_RAW) -> Dict[str, Any]:
+    """
+    Encodes an array as saved by the storage service
+
+    :param arr: the array
+    :param codec: compression of the bytes, one of raw, lz4 or zstd
+    :return: the document holding the array
+    """
+    arr = np.ascontiguousarray(arr)
+    payload = arr.tobytes()
+
+    if codec == CODEC_LZ4:
+        payload = _require(lz4_frame, 'lz4').compress(payload)
+    elif codec == CODEC_ZSTD:
+        payload = _require(zstandard, 'zstandard').ZstdCompressor().compress(payload)
+    elif codec != CODEC_RAW:
+        raise ValueError(f'Codec {codec} not recognized, must be one of {CODECS}')
+
+    return {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'codec': codec, 'bytes': payload}
+
+
+def decode_array(value) -> np.ndarray:
+    """
+    Decodes an array saved in a subset of a dataset. Uncompressed arrays are returned
+    as a read only view of the bytes in the document, so they can be copied straight into
+    their destination
+
+    :param value: the encoded document, or the pickled array of the old format
+    :return: the array
+    """
+    if not isinstance(value, dict):
+        return np.asarray(pickle.loads(value))
+
+    payload, codec = value['bytes'], value['codec']
+    if codec == CODEC_LZ4:
+        payload = _require(lz4_frame, 'lz4').decompress(payload)
+    elif codec == CODEC_ZSTD:
+        payload = _require(zstandard, 'zstandard').ZstdDecompressor().decompress(payload)
+    elif codec != CODEC_RAW:
+        raise ValueError(f'Codec {codec} not recognized, must be one of {CODECS}')
+
+    return np.frombuffer(payload, dtype=np.dtype(value['dtype'])).reshape(value['shape'])
+
+
+def _require(module, name: str):
+    if module is None:
+        raise ImportError(f'The dataset is compressed with {name}, install it to read it')
+    return module
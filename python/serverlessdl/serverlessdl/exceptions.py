@@ -46,3 +46,9 @@ class InvalidArgsError(KubeMLException):
     def __init__(self, e: Exception):
         super(InvalidArgsError, self) \
             .__init__(f"Error parsing function arguments: {str(e)}", 500)
+
+
+class DatasetNotReadyError(KubeMLException):
+    def __init__(self):
+        super(DatasetNotReadyError, self) \
+            .__init__("Dataset is still being uploaded", 409)
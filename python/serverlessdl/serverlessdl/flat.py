@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import warnings
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import redisai as rai
+import torch
+
+from .transfer import fetch_tensors, publish_tensors
+
+# Storage layouts of the model in the tensor storage.
+# - layers: one tensor per state dict entry, {job_id}:{name} and {job_id}:{name}/{func_id}
+# - flat: the whole state dict in a flat float32 buffer, saved in segments {job_id}:__flat__:{i} (and
+#   {job_id}:__flat__:{i}/{func_id}) plus an index of the layers saved in {job_id}:__flat__:index
+LAYOUT_LAYERS = 'layers'
+LAYOUT_FLAT = 'flat'
+LAYOUTS = [LAYOUT_LAYERS, LAYOUT_FLAT]
+
+# Prefix of the layers holding the segments of the flat model. These are the layer names returned
+# to the parameter server at init, so it merges the segments as any other float32 layer
+FLAT_LAYER = '__flat__'
+
+# Max bytes of a segment of the flat model, each one is sent as a single redis argument
+# so it must stay under the proto-max-bulk-len of the server, 512MB by default
+FLAT_SEGMENT_BYTES = int(os.environ.get('FLAT_SEGMENT_BYTES', 256 * 1024 * 1024))
+
+
+class FlatLayer(NamedTuple):
+    """Position of a state dict entry inside the flat buffer. Offset and size are in elements"""
+    name: str
+    offset: int
+    shape: Tuple[int, ...]
+    dtype: str
+
+    @property
+    def numel(self) -> int:
+        return int(np.prod(self.shape, dtype=np.int64))
+
+
+class FlatIndex:
+    """
+    FlatIndex describes how the entries of a state dict are laid out in a single
+    contiguous float32 buffer. Layers are placed one after the other in the order of
+    the state dict. Layers of other types (i.e the int64 num_batches_tracked of the batch norm)
+    are stored as float32 and cast back to their type when unpacking. The buffer is saved
+    in consecutive segments of up to segment_size elements.
+    """
+
+    def __init__(self, layers: List[FlatLayer], segment_size: int = FLAT_SEGMENT_BYTES // 4):
+        if segment_size <= 0:
+            raise ValueError(f'Segments of the flat model must hold at least one element, got {segment_size}')
+        self.layers = layers
+        self.numel = layers[-1].offset + layers[-1].numel if layers else 0
+        self.segment_size = segment_size
+
+    @classmethod
+    def from_state_dict(cls, state: Dict[str, torch.Tensor],
+                        segment_size: int = FLAT_SEGMENT_BYTES // 4) -> 'FlatIndex':
+        """
+        Builds the index of the given state dict
+
+        :param state: the state dict of the network
+        :param segment_size: max elements of each segment of the buffer saved in the storage
+        :return: the index of the flat layout
+        """
+        layers, offset = [], 0
+        for name, t in state.items():
+            layer = FlatLayer(name, offset, tuple(t.shape), str(t.dtype).replace('torch.', ''))
+            layers.append(layer)
+            offset += layer.numel
+        return cls(layers, segment_size)
+
+    @property
+    def segments(self) -> List[range]:
+        """The ranges of elements of the buffer saved in each segment"""
+        return [range(start, min(start + self.segment_size, self.numel))
+                for start in range(0, max(self.numel, 1), self.segment_size)]
+
+    @property
+    def segment_names(self) -> List[str]:
+        """The names of the layers holding the segments, merged by the parameter server"""
+        return [f'{FLAT_LAYER}:{i}' for i in range(len(self.segments))]
+
+    def dumps(self) -> str:
+        """Serializes the index as compact json, with the layers as a list of [name, offset, shape, dtype]"""
+        return json.dumps({'layers': [[l.name, l.offset, list(l.shape), l.dtype] for l in self.layers],
+                           'segment_size': self.segment_size},
+                          separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, s: str) -> 'FlatIndex':
+        """Parses an index serialized with dumps"""
+        index = json.loads(s)
+        return cls([FlatLayer(name, offset, tuple(shape), dtype)
+                    for name, offset, shape, dtype in index['layers']], index['segment_size'])
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FlatIndex) and self.layers == other.layers \
+               and self.segment_size == other.segment_size
+
+    def pack(self, state: Dict[str, torch.Tensor], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Copies the state dict to a flat float32 buffer
+
+        :param state: the state dict of the network, must match the index
+        :param out: preallocated buffer of numel float32 elements to reuse
+        :return: the flat buffer
+        """
+        if out is None:
+            out = np.empty(self.numel, dtype=np.float32)
+
+        dest = torch.from_numpy(out)
+        with torch.no_grad():
+            for layer in self.layers:
+                t = state[layer.name]
+                dest[layer.offset:layer.offset + layer.numel].copy_(t.detach().reshape(-1))
+
+        return out
+
+    def unpack(self, buffer) -> Dict[str, torch.Tensor]:
+        """
+        Builds the state dict from a flat buffer. The float32 layers are views of the
+        buffer, no copy is done
+
+        :param buffer: object exposing the buffer protocol (bytes, numpy array) with the float32 values
+        :return: the state dict
+        """
+        flat = _as_tensor(buffer)
+        if flat.numel() != self.numel:
+            raise ValueError(f'Flat buffer has {flat.numel()} elements, index expects {self.numel}')
+
+        state = {}
+        for layer in self.layers:
+            t = flat[layer.offset:layer.offset + layer.numel].view(layer.shape)
+            dtype = getattr(torch, layer.dtype)
+            if dtype != torch.float32:
+                # the merged integer buffers might be the average of several functions
+                t = t.round().to(dtype) if not dtype.is_floating_point else t.to(dtype)
+            state[layer.name] = t
+
+        return state
+
+
+def _as_tensor(buffer) -> torch.Tensor:
+    """Returns a float32 tensor that shares the memory with the buffer"""
+    # the buffers returned by redis are read only, the views are only
+    # read when loading the state dict so silence the torch warning
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        if hasattr(torch, 'frombuffer'):
+            return torch.frombuffer(buffer, dtype=torch.float32)
+        return torch.from_numpy(np.frombuffer(buffer, dtype=np.float32))
+
+
+def flat_key(job_id: str, segment: int, func_id: int = -1) -> str:
+    """
+    Returns the key of a segment of the flat model, the reference model if func_id
+    is -1 or the model published by a function otherwise
+    """
+    key = f'{job_id}:{FLAT_LAYER}:{segment}'
+    return key if func_id < 0 else f'{key}/{func_id}'
+
+
+def index_key(job_id: str) -> str:
+    """Returns the key of the index of the flat model of a job"""
+    return f'{job_id}:{FLAT_LAYER}:index'
+
+
+def write_model(client: rai.Client, job_id: str, state: Dict[str, torch.Tensor],
+                func_id: int = -1, index: Optional[FlatIndex] = None,
+                out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Writes a state dict to the storage in the flat layout. When writing the reference
+    model (func_id -1) the index is saved as well.
+
+    :param client: redisai client
+    :param job_id: id of the job
+    :param state: the state dict
+    :param func_id: id of the function publishing the model, -1 for the reference model
+    :param index: index of the state dict, built if not given
+    :param out: preallocated buffer to pack the model into
+    :return: the packed buffer
+    """
+    index = index or FlatIndex.from_state_dict(state)
+    buffer = index.pack(state, out)
+
+    segments = index.segments
+    publish_tensors(client, [flat_key(job_id, i, func_id) for i in range(len(segments))],
+                    [buffer[r.start:r.stop] for r in segments], chunk_bytes=index.segment_size * 4)
+    if func_id < 0:
+        client.set(index_key(job_id), index.dumps())
+
+    logging.debug(f'Wrote flat model of {index.numel} elements in {len(segments)} segments')
+    return buffer
+
+
+def read_model(client: rai.Client, job_id: str, func_id: int = -1,
+               index: Optional[FlatIndex] = None) -> Dict[str, torch.Tensor]:
+    """
+    Reads a state dict saved in the flat layout. If the index is not given
+    it is read from the storage as well.
+
+    :param client: redisai client
+    :param job_id: id of the job
+    :param func_id: id of the function that published the model, -1 for the reference model
+    :param index: index of the state dict
+    :return: the state dict, a view of the buffer read if the model has a single segment
+    """
+    if index is None:
+        index = FlatIndex.loads(client.get(index_key(job_id)))
+
+    segments = index.segments
+    buffers = fetch_tensors(client, [flat_key(job_id, i, func_id) for i in range(len(segments))],
+                            [len(r) * 4 for r in segments], chunk_bytes=index.segment_size * 4)
+    return index.unpack(buffers[0] if len(buffers) == 1 else np.concatenate(buffers))
@@ -0,0 +1,200 @@
+import logging
+import mmap
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, Sampler, get_worker_info
+
+from .clients import reset_after_fork
+
+# Attributes of a KubeDataset set by the function for each invocation, the rest
+# of them are the configuration of the dataset seen by the workers of a pool
+_INVOCATION_ATTRIBUTES = {'data', 'labels', '_mode', '_args', '_client', '_database'}
+
+
+def _shared_empty(shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    """Allocates an array in anonymous shared memory, which the forked workers keep seeing"""
+    count = int(np.prod(shape, dtype=np.int64))
+    buffer = mmap.mmap(-1, max(1, count * np.dtype(dtype).itemsize))
+    return np.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+
+class _BatchedDataset(Dataset):
+    """Exposes a KubeDataset that transforms whole minibatches, each item is a batch of indices"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        return self.dataset._get_batch(indices)
+
+
+class _RowSampler(Sampler):
+    """
+    Samples the given rows of the dataset, or all of them if None. The rows can be
+    changed between epochs of the loader, so loaders with persistent workers
+    train on the rows of each interval
+    """
+
+    def __init__(self, dataset, shuffle: bool, rows: Optional[np.ndarray] = None):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.rows = rows
+
+    def __iter__(self):
+        n = len(self)
+        order = torch.randperm(n).tolist() if self.shuffle else range(n)
+        if self.rows is None:
+            return iter(order)
+        return (int(self.rows[i]) for i in order)
+
+    def __len__(self):
+        return len(self.dataset) if self.rows is None else len(self.rows)
+
+
+def make_loader(dataset, batch_size: int, shuffle: bool = False, rows: Optional[np.ndarray] = None,
+                **kwargs) -> DataLoader:
+    """
+    Creates the loader of a KubeDataset. If the dataset transforms whole minibatches the
+    sampler yields the indices of each batch, which are fetched and transformed at once
+
+    :param dataset: the KubeDataset
+    :param batch_size: size of the batch
+    :param shuffle: whether to shuffle the samples
+    :param rows: rows of the data to train on, all of them if None
+    :param kwargs: other arguments of the DataLoader
+    :return: the data loader
+    """
+    sampler = _RowSampler(dataset, shuffle, rows)
+    if not dataset._is_batched():
+        return DataLoader(dataset, batch_size=batch_size, sampler=sampler, **kwargs)
+
+    return DataLoader(_BatchedDataset(dataset), batch_size=None,
+                      sampler=BatchSampler(sampler, batch_size, drop_last=False), **kwargs)
+
+
+def _dataset_key(dataset) -> tuple:
+    """
+    Identifies the configuration of a dataset. The workers of a pool keep the dataset of the
+    invocation that started it, so they are reused by the datasets of the following invocations
+    only if they are configured the same way
+    """
+    return tuple(sorted((name, repr(value)) for name, value in vars(dataset).items()
+                        if name not in _INVOCATION_ATTRIBUTES))
+
+
+def _worker_init(worker_id: int):
+    """
+    Drops the storage clients the worker inherits from the function process, the
+    connections are shared with the parent and can't be used by both processes
+    """
+    reset_after_fork()
+    dataset = get_worker_info().dataset
+    if isinstance(dataset, _BatchedDataset):
+        dataset = dataset.dataset
+    dataset._client, dataset._database = None, None
+
+
+def _row_sampler(loader: DataLoader) -> _RowSampler:
+    sampler = loader.sampler
+    return sampler.sampler if isinstance(sampler, BatchSampler) else sampler
+
+
+class _WorkerPool:
+    """
+    A DataLoader with persistent workers and the shared memory arrays read by them.
+
+    The workers are forked with the dataset pointing to the shared arrays, so the data of
+    each interval is copied into them and the workers read it without being restarted.
+    The workers keep the dataset object of the invocation that started the pool, only its
+    data and labels are updated afterwards, so the pool is only reused by datasets with
+    the same configuration. The storage clients are dropped in the forked workers.
+    """
+
+    def __init__(self, key: tuple, dataset, data: np.ndarray, labels: np.ndarray, capacity: int,
+                 batch_size: int, num_workers: int, pin_memory: bool, prefetch_factor: int):
+        self.key = key
+        self.capacity = capacity
+        self.data = _shared_empty((capacity,) + data.shape[1:], data.dtype)
+        self.labels = _shared_empty((capacity,) + labels.shape[1:], labels.dtype)
+
+        self.dataset = dataset
+        self.dataset._set_train_data(self.data, self.labels)
+        self.loader = make_loader(dataset, batch_size, shuffle=True,
+                                  num_workers=num_workers,
+                                  persistent_workers=True,
+                                  worker_init_fn=_worker_init,
+                                  pin_memory=pin_memory,
+                                  prefetch_factor=prefetch_factor)
+
+    def load(self, dataset, data: np.ndarray, labels: np.ndarray, rows: Optional[np.ndarray]) -> DataLoader:
+        n = len(data)
+        self.data[:n] = data
+        self.labels[:n] = labels
+        _row_sampler(self.loader).rows = rows
+
+        # the sampler of the loader takes the length of the interval from the dataset of
+        # the pool, the one of the invocation gets the same views for the user code
+        self.dataset._set_train_data(self.data[:n], self.labels[:n])
+        dataset._set_train_data(self.data[:n], self.labels[:n])
+        return self.loader
+
+
+# worker pool shared by the invocations served by this process
+_pool: Optional[_WorkerPool] = None
+
+
+def train_loader(dataset, data: np.ndarray, labels: np.ndarray, batch_size: int,
+                 num_workers: int = 0, pin_memory: bool = False, prefetch_factor: int = 2,
+                 rows: Optional[np.ndarray] = None, capacity: int = 0) -> DataLoader:
+    """
+    Returns the loader of the training data of an interval. With workers, the pool is kept
+    alive across the intervals and the invocations served by the process as long as the
+    configuration of the dataset, the batch size and the shape of the data don't change and
+    the data fits in the pool, and only the data the workers read is swapped
+
+    :param dataset: the KubeDataset of the invocation
+    :param data: the features of the interval
+    :param labels: the labels of the interval
+    :param batch_size: size of the batch
+    :param num_workers: number of worker processes, if 0 the data is loaded in the main process
+    :param pin_memory: copy the batches to pinned memory
+    :param prefetch_factor: batches loaded in advance by each worker
+    :param rows: rows of the data to train on, all of them if None
+    :param capacity: rows allocated if a pool is started, so data bigger than
+        this one loaded later on doesn't restart the workers
+    :return: the data loader
+    """
+    global _pool
+
+    if num_workers == 0:
+        dataset._set_train_data(data, labels)
+        return make_loader(dataset, batch_size, shuffle=True, rows=rows, pin_memory=pin_memory)
+
+    key = (type(dataset), _dataset_key(dataset), batch_size, num_workers, pin_memory, prefetch_factor,
+           data.dtype, data.shape[1:], labels.dtype, labels.shape[1:])
+    if _pool is None or _pool.key != key or _pool.capacity < len(data):
+        logging.debug(f'Starting data loader pool with {num_workers} workers')
+        # drop the old pool first so its workers are shut down
+        _pool = None
+        _pool = _WorkerPool(key, dataset, data, labels, max(len(data), capacity),
+                            batch_size, num_workers, pin_memory, prefetch_factor)
+
+    return _pool.load(dataset, data, labels, rows)
+
+
+def sample_rows(loader: DataLoader, rows: Optional[np.ndarray]) -> DataLoader:
+    """
+    Changes the rows sampled by a loader returned by train_loader, which keeps
+    reading the same data without copying it again
+
+    :param loader: the loader
+    :param rows: rows of the data to train on, all of them if None
+    :return: the loader
+    """
+    _row_sampler(loader).rows = rows
+    return loader
@@ -1,37 +1,102 @@
 from abc import ABC
 from collections import defaultdict
-from typing import Dict, Tuple, Any, Union, Callable, Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple, Any, Union, Callable, Iterable, List, Sequence
 
 import flask
 import numpy as np
 import pickle
-import redisai as rai
 import requests
+import zlib
 from flask import request, jsonify, current_app
 from redis.exceptions import RedisError
-from torch.utils.data import DataLoader
 from datetime import datetime
 
+from .clients import redis_client, reset_redis
+from .cache import model_cache, optimizer_cache, optimizer_version_key, parse_version, version_key
 from .dataset import _KubeArgs, KubeDataset
+from .delta import DeltaConfig, delta_encoder, delta_key
 from .exceptions import *
+from .optim import decode_optimizer_state, encode_optimizer_state, lazy_load
+from .prefetch import IntervalPrefetcher, PREFETCH_MEMORY_BYTES
+from .steal import WorkQueue
+from .flat import FlatIndex, LAYOUT_FLAT, LAYOUT_LAYERS, LAYOUTS, read_model, write_model
+from .loader import make_loader, sample_rows, train_loader
+from .transfer import fetch_tensors, publish_tensors, tensor_to_numpy, PIPELINE_CHUNK_BYTES
 from .util import *
 import os
 
-# Load from environment the values from th MONGO IP and PORT
-try:
-    REDIS_URL = os.environ['REDIS_URL']
-    REDIS_PORT = os.environ['REDIS_PORT']
-    logging.debug(f'Found configuration for redis {REDIS_URL}:{REDIS_PORT}')
-except KeyError:
-    logging.debug("Could not find redis configuration in env, using defaults")
-    REDIS_URL = "redisai.kubeml"
-    REDIS_PORT = 6379
-
 
 class KubeModel(ABC):
 
-    def __init__(self, network: nn.Module, dataset: KubeDataset, gpu=False):
-        """Init the KubeModel, device can be either gpu or cpu"""
+    def __init__(self, network: nn.Module, dataset: KubeDataset, gpu=False,
+                 pipeline_chunk_bytes: int = PIPELINE_CHUNK_BYTES,
+                 layout: str = LAYOUT_LAYERS,
+                 delta: DeltaConfig = None,
+                 cache_model: bool = True,
+                 optimizer_save_every: int = 1,
+                 lazy_optimizer_load: bool = True,
+                 prefetch_memory_bytes: int = PREFETCH_MEMORY_BYTES,
+                 async_commit: bool = False,
+                 num_workers: int = 0,
+                 pin_memory: bool = None,
+                 prefetch_factor: int = 2,
+                 shuffle: bool = False,
+                 shuffle_block_size: int = 4,
+                 shuffle_locality: float = 0.5,
+                 partition: str = PARTITION_NONE,
+                 steal: bool = False,
+                 steal_batches: int = 8):
+        """Init the KubeModel, device can be either gpu or cpu
+
+        :param pipeline_chunk_bytes: max bytes fetched from or saved to the tensor storage in a single
+            pipelined round trip. If None or 0 the whole model is transferred in one round trip
+        :param layout: how the model is saved in the tensor storage, either one tensor per layer ('layers')
+            or the whole model in a single flat float32 tensor ('flat')
+        :param delta: if given, at the end of each iteration the function publishes the encoded
+            difference with the reference model instead of the whole model, which the parameter
+            server adds to its reference model. The error feedback residuals are kept by the process.
+            Only supported with the layers layout
+        :param cache_model: keep the last loaded reference model in the process and skip fetching
+            it again while its version in the storage does not change
+        :param optimizer_save_every: save the optimizer state every this number of iterations. The state
+            is always saved at the end of the last iteration of the function
+        :param lazy_optimizer_load: load the saved optimizer state right before the first optimizer step
+            instead of at the start of the first iteration
+        :param prefetch_memory_bytes: memory budget for the training data of the current and next
+            iterations. The data of the next iteration is fetched in the background while the current
+            one trains if both fit in the budget. If 0 the data is loaded at the start of each iteration
+        :param async_commit: at the end of each iteration copy the weights to a snapshot and publish them
+            and notify the train job in the background, while the data of the next iteration is prepared.
+            The next iteration still waits for the merge before loading the reference model. Each
+            invocation commits in its own thread, since a commit blocks until all the functions of
+            the job finish the iteration
+        :param num_workers: number of worker processes loading the training batches. The workers are
+            kept alive across iterations and invocations, so the transforms of the dataset run outside
+            the main process without paying the start of the workers in each iteration
+        :param pin_memory: copy the batches to pinned memory, by default only when training on the gpu
+        :param prefetch_factor: number of batches loaded in advance by each worker
+        :param shuffle: assign different subsets to each function every epoch instead of always the
+            same contiguous part of the dataset, see shuffle_subsets
+        :param shuffle_block_size: number of consecutive subsets shuffled together
+        :param shuffle_locality: fraction of its subsets each function keeps from the previous epoch,
+            which are likely in the cache of its node
+        :param partition: how the samples are split between the functions. By default ('none') each function
+            trains on all the samples of its subsets, otherwise the samples are split evenly and the functions
+            are given the same number of them, either repeating samples in the functions with fewer ('pad')
+            or dropping the last samples of the functions with more ('drop'), see plan_partitions
+        :param steal: split the samples of each function in an interval in chunks claimed from a shared
+            queue in redis, so the functions that finish early train the chunks not yet started by the
+            slower ones instead of waiting for them at the end of the interval
+        :param steal_batches: number of batches of each chunk claimed when stealing
+        """
+        if layout not in LAYOUTS:
+            raise KubeMLException(f"Layout {layout} not recognized, must be one of {LAYOUTS}", 400)
+        if partition not in PARTITION_MODES:
+            raise KubeMLException(f"Partition {partition} not recognized, must be one of {PARTITION_MODES}", 400)
+        if delta is not None and layout == LAYOUT_FLAT:
+            # the parameter server merges the deltas layer by layer, the flat layout has a single tensor
+            raise KubeMLException(f"Delta mode is not supported with the {LAYOUT_FLAT} layout", 400)
 
         # if device is set to gpu, get the correct gpu if
         # for the
@@ -50,8 +115,60 @@ class KubeModel(ABC):
         self.optimizer = None
         self.epoch = None
 
-        # initialize redis connection
-        self._redis_client = rai.Client(host=REDIS_URL, port=REDIS_PORT)
+        # transfer options for the model weights
+        self.pipeline_chunk_bytes = pipeline_chunk_bytes
+        self.layout = layout
+
+        # index and reusable buffer used with the flat layout
+        self._flat_index = None
+        self._flat_buffer = None
+
+        # options and reference model of the iteration used in delta mode
+        self._delta = delta
+        self._reference_state = None
+
+        # version of the last reference model loaded, used by the model cache
+        self.cache_model = cache_model
+        self._model_version = None
+
+        # optimizer state persistence options. The optimizer state is kept in memory
+        # between the iterations of an invocation, so it is only loaded in the first one
+        self.optimizer_save_every = max(1, optimizer_save_every)
+        self.lazy_optimizer_load = lazy_optimizer_load
+        self._optimizer_loaded = False
+        self._optimizer_pending = False
+
+        # index of the current iteration within the invocation
+        self._interval = 0
+        self._last_interval = True
+
+        # budget for prefetching the data of the next iteration
+        self.prefetch_memory_bytes = prefetch_memory_bytes
+
+        # thread of the invocation publishing the models, the pending background
+        # commit of the last iteration and the reusable buffers holding the published weights
+        self.async_commit = async_commit
+        self._commit_executor = None
+        self._commit = None
+        self._snapshot = {}
+
+        # data loader options of the training batches
+        self.num_workers = num_workers
+        self.pin_memory = gpu if pin_memory is None else pin_memory
+        self.prefetch_factor = prefetch_factor
+
+        # assignment of the subsets to the functions across epochs
+        self.shuffle = shuffle
+        self.shuffle_block_size = shuffle_block_size
+        self.shuffle_locality = shuffle_locality
+        self.partition = partition
+
+        # work stealing between the functions of an interval
+        self.steal = steal
+        self.steal_batches = max(1, steal_batches)
+
+        # redis connection shared by the invocations served by the process
+        self._redis_client = redis_client()
 
     # allow to call the network from the kubemodel
     def __call__(self, *args, **kwargs):
@@ -106,6 +223,8 @@ class KubeModel(ABC):
         """
         optimizer = self.configure_optimizers()
         self.optimizer = optimizer
+        self._optimizer_loaded = False
+        self._optimizer_pending = False
         self.logger.debug(f"Configure optimizer at epoch: {self.epoch}")
 
 
@@ -117,14 +236,13 @@ class KubeModel(ABC):
         """
         job_id = self.args._job_id
         func_id = self.args._func_id
-        if os.path.isfile(f'/output/{job_id}:opt:{func_id}.pkl'):
-            self.logger.debug(f'loading optimizer file from host, path: /output/{job_id}:opt:{func_id}.pkl')
-            with open(f'/output/{job_id}:opt:{func_id}.pkl', 'rb') as f:
+        if os.path.isfile(f'/output/{job_id}:opt:{func_id}.bin'):
+            self.logger.debug(f'loading optimizer file from host, path: /output/{job_id}:opt:{func_id}.bin')
+            with open(f'/output/{job_id}:opt:{func_id}.bin', 'rb') as f:
                 self.logger.debug(f'loading optimizer file, epoch: {self.epoch}')
-                state = pickle.load(f)
+                state = decode_optimizer_state(f.read())
                 self.optimizer.load_state_dict(state)
                 self.logger.debug('optimizer file loaded')
-                print('optimizer file loaded') 
 
     def _reset_optimizer_state(self):
         """
@@ -145,11 +263,10 @@ class KubeModel(ABC):
         func_id = self.args._func_id
         self.logger.debug('saving optimizer file to host')
 
-        with open(f'/output/{job_id}:opt:{func_id}.pkl', 'wb') as f:
-            self.logger.debug(f'saving optimizer file to path: /output/{job_id}:opt:{func_id}.pkl , epoch: {self.epoch}')
-            pickle.dump(self.optimizer.state_dict(), f)
+        with open(f'/output/{job_id}:opt:{func_id}.bin', 'wb') as f:
+            self.logger.debug(f'saving optimizer file to path: /output/{job_id}:opt:{func_id}.bin , epoch: {self.epoch}')
+            f.write(encode_optimizer_state(self.optimizer.state_dict()))
             self.logger.debug('optimizer file saved')
-        print('optimizer file saved')   
 
     def _save_file_test(self):
         """
@@ -181,9 +298,11 @@ class KubeModel(ABC):
                 self.logger.debug(f'file loaded, value: {state}')
                 print('file loaded')    
 
-    def _save_optimizer_redis(self):
+    def _save_optimizer_redis(self, interval: int = None):
         """
         Saves the optimizer to the redis
+
+        :param interval: iteration at the end of which the state is saved, the current one by default
         """
         job_id = self.args._job_id
         func_id = self.args._func_id
@@ -191,11 +310,18 @@ class KubeModel(ABC):
         self.logger.debug("Saving optimizer to the redis")
 
         weight_key = f'{job_id}:optimizer:{func_id}' 
-        pickled_val  = pickle.dumps(self.optimizer.state_dict())
+        encoded_val = encode_optimizer_state(self.optimizer.state_dict())
 
-        #self.logger.debug(f"Saving optimizer value: {pickled_val}")
+        # save the state tagged with the epoch and iteration, and keep
+        # it in the process in case the next invocation is served here
+        version = f'{self.epoch}/{self._interval if interval is None else interval}'
+        pipe = self._redis_client.pipeline(transaction=True)
+        pipe.set(weight_key, encoded_val)
+        pipe.set(optimizer_version_key(job_id, func_id), version)
+        pipe.execute()
 
-        self._redis_client.set(weight_key, pickled_val)
+        optimizer_cache.put(job_id, func_id, version, encoded_val)
+        optimizer_cache.evict_finished_jobs(self._redis_client, job_id)
 
 
     def _load_optimizer_redis(self):
@@ -210,15 +336,17 @@ class KubeModel(ABC):
 
         weight_key = f'{job_id}:optimizer:{func_id}' 
 
-        if  self._redis_client.exists(weight_key):
-            # used for testing redis
-            # epoch = self.args.epoch
-            # weight_key_print = f'{job_id}:print:{func_id}' 
-            # value = f'{job_id}:print:{func_id}/{epoch}' 
-            # self._redis_client.set(weight_key_print, value)
+        # use the state cached in the process if it is the latest one saved
+        version = self._redis_client.get(optimizer_version_key(job_id, func_id))
+        encoded_val = optimizer_cache.get(job_id, func_id, version.decode() if version else None)
+        if encoded_val is None:
+            optimizer_cache.remove(job_id, func_id)
+            encoded_val = self._redis_client.get(weight_key)
+        else:
+            self.logger.debug("Loaded optimizer from the process cache")
 
-            pickled_val = self._redis_client.get(weight_key)
-            opt_states = pickle.loads(pickled_val)  
+        if encoded_val is not None:
+            opt_states = decode_optimizer_state(encoded_val)
             self.optimizer.load_state_dict(opt_states)
 
 
@@ -272,8 +400,8 @@ class KubeModel(ABC):
             return jsonify(layers), 200
 
         elif self.task == "train":
-            loss = self.__train()
-            return jsonify(loss=loss), 200
+            loss, iterations = self.__train()
+            return jsonify(loss=loss, iterations=iterations), 200
 
         elif self.task == "val":
             acc, loss, length = self.__validate()
@@ -284,7 +412,6 @@ class KubeModel(ABC):
             return jsonify(predictions=preds), 200
 
         else:
-            self._redis_client.close()
             raise KubeMLException(f"Task {self.task} not recognized", 400)
 
     def __initialize(self) -> List[str]:
@@ -297,12 +424,15 @@ class KubeModel(ABC):
             self.init()
             # according to the comments, it is nothing to do with the training process.
             self.__save_model()
+            self._redis_client.incr(version_key(self.args._job_id))
 
         except RedisError as re:
+            reset_redis(re)
             raise StorageError(re)
-        finally:
-            self._redis_client.close()
 
+        # with the flat layout the parameter server merges the segments of the flat buffer
+        if self.layout == LAYOUT_FLAT:
+            return self.__get_flat_index().segment_names
         return [name for name in self._network.state_dict()]
 
     def _on_train_start(self):
@@ -336,9 +466,9 @@ class KubeModel(ABC):
         startModelLoading = datetime.now()
         self.__load_model()
         self.logger.debug(f"Model loading Time, {datetime.now() - startModelLoading}")
-        startOptimizerLoading = datetime.now()
-        self._load_optimizer_redis()
-        self.logger.debug(f"Optimizer loading Time, {datetime.now() - startOptimizerLoading}")
+        if not self._optimizer_loaded:
+            self._optimizer_loaded = True
+            self.__load_optimizer()
 
         # self._load_redis_test()
         # self._load_file_test()
@@ -351,18 +481,126 @@ class KubeModel(ABC):
     def _on_iteration_end(self):
         """
         Called at the end of each iteration
+
+        Publishes the model and the optimizer state and notifies the train job if this
+        is not the last iteration. With async commit the weights are copied to a snapshot
+        and published in the background
         :return:
         """
-        startModelSaving = datetime.now()
-        self.__save_model()
-        self.logger.debug(f"Model saving Time, {datetime.now() - startModelSaving}")
-        startoptimizerSaving = datetime.now()
-        self._save_optimizer_redis()
-        self.logger.debug(f"Optimizer saving Time, {datetime.now() - startoptimizerSaving}")
+        # decide now what to publish, the iteration
+        # counters change while the commit runs
+        save_optimizer = self.__should_save_optimizer()
+        if not self.async_commit:
+            self.__commit_iteration(self._network.state_dict(), save_optimizer, self._interval, self._last_interval)
+            return
+
+        if self._commit_executor is None:
+            self._commit_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kubeml-commit')
+
+        state = self.__snapshot_model()
+        self._commit = self._commit_executor.submit(self.__commit_iteration, state, save_optimizer,
+                                               self._interval, self._last_interval)
         # self._save_redis_test()
         # self._save_file_test()
         # self._save_optimizer_state()
 
+    def __commit_iteration(self, state: Dict[str, torch.Tensor], save_optimizer: bool, interval: int, last: bool):
+        """
+        Publishes the model trained in an iteration and the optimizer state, and
+        sends the finish signal to the train job if it is not the last iteration
+
+        :param state: the weights to publish
+        :param save_optimizer: whether to save the optimizer state
+        :param interval: index of the iteration
+        :param last: whether it is the last iteration of the invocation
+        """
+        startModelSaving = datetime.now()
+        self.__save_model(state)
+        self.__cache_published_model(state)
+        self.logger.debug(f"Model saving Time, {datetime.now() - startModelSaving}")
+        if save_optimizer:
+            startoptimizerSaving = datetime.now()
+            self._save_optimizer_redis(interval)
+            self.logger.debug(f"Optimizer saving Time, {datetime.now() - startoptimizerSaving}")
+
+        # send notification to the train job to refresh the model if not
+        # the last interval
+        if not last:
+            self.__send_finish_signal()
+
+    def __snapshot_model(self) -> Dict[str, torch.Tensor]:
+        """
+        Copies the weights of the network to buffers in the cpu, pinned if the network
+        is in the gpu, that are reused across iterations and invocations
+
+        :return: the state dict with the copied weights
+        """
+        state = self._network.state_dict()
+        pin = self.device is not None and self.device.type == 'cuda'
+
+        with torch.no_grad():
+            for name, t in state.items():
+                buf = self._snapshot.get(name)
+                if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+                    buf = torch.empty(t.shape, dtype=t.dtype, pin_memory=pin)
+                    self._snapshot[name] = buf
+                buf.copy_(t, non_blocking=pin)
+
+        if pin:
+            torch.cuda.synchronize(self.device)
+        return {name: self._snapshot[name] for name in state}
+
+    def __wait_commit(self):
+        """
+        Waits for the commit of the previous iteration. If the train job was notified
+        this also waits for the parameter server to merge the models, so the next
+        reference model is only loaded after the merge
+        """
+        if self._commit is None:
+            return
+
+        commit, self._commit = self._commit, None
+        startWaiting = datetime.now()
+        try:
+            commit.result()
+        except RedisError as re:
+            reset_redis(re)
+            raise StorageError(re)
+        self.logger.debug(f"Commit waiting Time, {datetime.now() - startWaiting}")
+
+    def __stop_commits(self):
+        """Stops the commit thread of the invocation, without waiting for a failed commit"""
+        if self._commit_executor is not None:
+            self._commit_executor.shutdown(wait=False)
+            self._commit_executor = None
+
+    def __load_optimizer(self):
+        """
+        Loads the optimizer state saved by this function in a previous invocation,
+        either now or right before the first optimizer step
+        """
+        def load():
+            startOptimizerLoading = datetime.now()
+            self._load_optimizer_redis()
+            self._optimizer_pending = False
+            self.logger.debug(f"Optimizer loading Time, {datetime.now() - startOptimizerLoading}")
+
+        if self.lazy_optimizer_load:
+            self._optimizer_pending = True
+            lazy_load(self.optimizer, load)
+        else:
+            load()
+
+    def __should_save_optimizer(self) -> bool:
+        """
+        The optimizer state is saved every optimizer_save_every iterations and at the end
+        of the last one. If the saved state was never loaded because the optimizer did not
+        step, the state in the storage is still the latest one
+        """
+        if self._optimizer_pending:
+            return False
+        return self._last_interval or (self._interval + 1) % self.optimizer_save_every == 0
+
     def _batch_to_device(self, batch: Union[torch.Tensor, Iterable[torch.Tensor]]):
         """
         Moves the batch fetched from the dataloader to the in use device. This allows to
@@ -389,80 +627,179 @@ class KubeModel(ABC):
         else:
             return batch
 
-    def __train(self) -> float:
+    def __train(self) -> Tuple[float, int]:
         """
         Function called to train the network. Loads the reference model from the database,
         trains with the method provided by the user and saves the model after training to the database
 
-        :return: The loss of the epoch, as returned by the user function
+        :return: The mean loss of the epoch, as returned by the user function, and the number of batches trained
         """
         self.logger.debug(f"----------------------Epoch: {self.epoch} Starts---------------------------")
         self._on_train_start()
 
 
 
-        # Determine the batches that we need to train on and the first subset id
-        assigned_subsets = split_minibatches(range(self._dataset.num_docs),
-                                             self.args._N)[self.args._func_id]
-
-        # calculate the number of subsets that we need to train on
-        # per epoch
-
         startDataLPrepartion = datetime.now()
 
-        subsets_per_iter = get_subset_period(self.args._K,
-                                             self.args.batch_size,
-                                             assigned_subsets)
-        self.logger.debug(f"Subsets per iteration: {subsets_per_iter}")
-        intervals = range(assigned_subsets.start, assigned_subsets.stop, subsets_per_iter)
+        # Determine the samples that we need to train on, either the same contiguous
+        # range every epoch or the samples of a different shuffle of the subsets. Unless the
+        # partition is none all the functions get the same number of samples and batches
+        num_samples, subset_size = self._dataset.num_samples, self._dataset.subset_size
+        assignment = None
+        if self.shuffle:
+            assignment = shuffle_subsets(self._dataset.num_docs, self.args._N, self.epoch,
+                                         seed=zlib.crc32(self.args._job_id.encode()),
+                                         block_size=self.shuffle_block_size,
+                                         locality=self.shuffle_locality)
+
+        plan = plan_partitions(num_samples, self.args._N, self.args._K, self.batch_size,
+                               subset_size, assignment, self.partition)
+        self.logger.debug(f"Partition plan {plan}")
+        intervals = plan[self.args._func_id]
+
+        # fetches the data of the next interval while the current one trains
+        prefetcher = IntervalPrefetcher(self._dataset, [i.subsets for i in intervals], self.prefetch_memory_bytes)
 
         self.logger.debug(f"Data prepartion Time, {datetime.now() - startDataLPrepartion}")
 
+        try:
+            loss, num_iterations = self.__train_intervals(plan, intervals, prefetcher)
+        finally:
+            self.__stop_commits()
+
+        return loss / max(num_iterations, 1), num_iterations
+
+    def __train_intervals(self, plan: PartitionPlan, intervals: List[IntervalPlan],
+                          prefetcher: IntervalPrefetcher) -> Tuple[float, int]:
+        """
+        Trains the intervals of the function, merging the model after each one
+
+        :param plan: the partition plan of the epoch
+        :param intervals: the intervals of this function
+        :param prefetcher: the prefetcher of the data of the intervals
+        :return: the sum of the losses and the number of batches trained
+        """
         # the loss will be added cross intervals, each interval will have one loader, whose length
         # will determine the number of losses added.
         loss = 0
         num_iterations = 0
-        for i in intervals:
-
-            startDataLoading = datetime.now()
-
-            self.logger.debug(f"Starting iteration {i}")
-            self._dataset._load_train_data(start=i, end=min(assigned_subsets.stop, i + subsets_per_iter))
-
-            # create the loader that will be used
-            loader = DataLoader(self._dataset, batch_size=self.batch_size, shuffle= True)
-            num_iterations += len(loader)
-
-            self.logger.debug(f"Data Loading Time, {datetime.now() - startDataLoading}")
-
-            # load the reference model, train and save
-            try:
-                self._on_iteration_start()
-
-                startTraining = datetime.now()
-
-                for idx, batch in enumerate(loader):
-                    # send the batch to the appropriate device
-                    batch = self._batch_to_device(batch)
-                    loss += self.train(batch, idx)
-                    # self.logger.debug(f'loss is {loss}, iterations are {num_iterations}')
-
-                self.logger.debug(f"Training Time, {datetime.now() - startTraining}")
-
-                self._on_iteration_end()
-            except RedisError as re:
-                raise StorageError(re)
-            finally:
-                self._redis_client.close()
-
-            # send notification to the train job to refresh the model if not
-            # the last interval
-            if i != intervals[-1]:
-                self.__send_finish_signal()
+        try:
+            for interval, samples in enumerate(intervals):
+                self._interval, self._last_interval = interval, interval == len(intervals) - 1
+
+                startDataLoading = datetime.now()
+
+                self.logger.debug(f"Starting iteration {interval}, {samples}")
+                data, labels = prefetcher.load(interval)
+
+                # create the loader of the planned samples of the loaded subsets, the workers
+                # are kept across intervals and invocations. When stealing work each claimed
+                # chunk of samples gets its own loader
+                loader = None
+                if not self.steal:
+                    loader = train_loader(self._dataset, data, labels, self.batch_size,
+                                          self.num_workers, self.pin_memory, self.prefetch_factor,
+                                          rows=samples.rows())
+                    num_iterations += len(loader)
+
+                self.logger.debug(f"Data Loading Time, {datetime.now() - startDataLoading}")
+
+                # wait for the merge of the previous iteration, then
+                # load the reference model, train and save
+                try:
+                    self.__wait_commit()
+                    self._on_iteration_start()
+
+                    startTraining = datetime.now()
+
+                    if loader is None:
+                        interval_loss, steps = self.__train_claimed(plan, interval, data, labels)
+                        loss += interval_loss
+                        num_iterations += steps
+
+                    else:
+                        for idx, batch in enumerate(loader):
+                            # send the batch to the appropriate device
+                            batch = self._batch_to_device(batch)
+                            loss += self.train(batch, idx)
+                            # self.logger.debug(f'loss is {loss}, iterations are {num_iterations}')
+
+                    self.logger.debug(f"Training Time, {datetime.now() - startTraining}")
+
+                    self._on_iteration_end()
+                except RedisError as re:
+                    reset_redis(re)
+                    raise StorageError(re)
+        finally:
+            # the next interval may be loading in the background if the training failed
+            prefetcher.close()
 
+        self.__wait_commit()
         self._on_train_end()
 
-        return loss / num_iterations
+        return loss, num_iterations
+
+    def __train_claimed(self, plan: PartitionPlan, interval: int,
+                        data: np.ndarray, labels: np.ndarray) -> Tuple[float, int]:
+        """
+        Trains the chunks of samples of the interval claimed from the work queue, first the
+        ones planned for this function, whose data is already loaded, and then the ones
+        left by the other functions, whose subsets are read from the storage
+
+        :param plan: the partition plan of the epoch
+        :param interval: the current interval
+        :param data: the features loaded for the interval of this function
+        :param labels: the labels loaded for the interval of this function
+        :return: the sum of the losses and the number of batches trained
+        """
+        func_id, N = self.args._func_id, self.args._N
+        queue = WorkQueue(self._redis_client, self.args._job_id, self.epoch, interval)
+        size = self.steal_batches * self.batch_size
+        rows = plan[func_id][interval].rows()
+
+        # the data of the interval is loaded once, each chunk only changes the sampled rows. The
+        # subsets of a stolen chunk are kept for the following stolen chunks they hold, and the
+        # workers are given room for the subsets of any chunk so stealing doesn't restart them
+        own_loader, stolen_loader, stolen_subsets = None, None, None
+        capacity = (-(-size // self._dataset.subset_size) + 1) * self._dataset.subset_size
+
+        loss, steps = 0, 0
+        for owner in [(func_id + i) % N for i in range(N)]:
+            # without equalizing the partitions some functions may have fewer intervals
+            if interval >= len(plan[owner]):
+                continue
+            chunks = plan[owner][interval].chunks(size)
+            while True:
+                chunk = queue.claim(owner)
+                if chunk >= len(chunks):
+                    break
+
+                if owner == func_id:
+                    chunk_rows = rows[chunk * size:(chunk + 1) * size]
+                    if own_loader is None:
+                        own_loader = train_loader(self._dataset, data, labels, self.batch_size,
+                                                  self.num_workers, self.pin_memory, self.prefetch_factor,
+                                                  rows=chunk_rows, capacity=capacity)
+                    loader = sample_rows(own_loader, chunk_rows)
+                else:
+                    start = datetime.now()
+                    stolen = chunks[chunk]
+                    reused = stolen_subsets is not None and set(stolen.subsets).issubset(stolen_subsets)
+                    if not reused:
+                        stolen_subsets = stolen.subsets
+                        stolen_data, stolen_labels = self._dataset._fetch_train_subsets(stolen_subsets)
+                        stolen_loader = train_loader(self._dataset, stolen_data, stolen_labels, self.batch_size,
+                                                     self.num_workers, self.pin_memory, self.prefetch_factor,
+                                                     capacity=capacity)
+                    loader = sample_rows(stolen_loader, stolen.rows(stolen_subsets))
+                    self.logger.debug(f"Stole chunk {chunk} of function {owner}, {stolen}, reused data {reused}, "
+                                      f"Data Loading Time, {datetime.now() - start}")
+
+                for batch in loader:
+                    loss += self.train(self._batch_to_device(batch), steps)
+                    steps += 1
+
+        return loss, steps
 
     def _on_validation_start(self):
         """
@@ -494,7 +831,7 @@ class KubeModel(ABC):
                                             end=assigned_subsets.stop)
 
         # create the loader that will be used
-        loader = DataLoader(self._dataset, batch_size=self.batch_size)
+        loader = make_loader(self._dataset, self.batch_size)
 
         acc, loss = 0, 0
         try:
@@ -508,9 +845,8 @@ class KubeModel(ABC):
                     acc += _acc
                     loss += _loss
         except RedisError as re:
+            reset_redis(re)
             raise StorageError(re)
-        finally:
-            self._redis_client.close()
 
         return acc / len(loader), loss / len(loader), len(self._dataset)
 
@@ -572,49 +908,138 @@ class KubeModel(ABC):
         """
         Loads the model from redis ai and applies it to the network
         """
-        state_dict = self.__get_model_dict()
+        job_id = self.args._job_id
+
+        # check the version of the reference model, if it is the
+        # one cached in the process there is no need to fetch it
+        state_dict, version = None, None
+        if self.cache_model:
+            version = parse_version(self._redis_client.get(version_key(job_id)))
+            state_dict = model_cache.get(job_id, version)
+
+        if state_dict is None:
+            state_dict = self.__get_model_dict()
+            if self.cache_model:
+                model_cache.put(job_id, version, state_dict)
+            self.logger.debug("Loaded state dict from redis")
+        else:
+            self.logger.debug(f"Loaded state dict from the model cache, version {version}")
+
         self._network.load_state_dict(state_dict)
-        self.logger.debug("Loaded state dict from redis")
+        self._model_version = version
+
+        # keep the reference model to compute the deltas
+        if self._delta is not None:
+            self._reference_state = state_dict
+
+    def __cache_published_model(self, state: Dict[str, torch.Tensor]):
+        """
+        With a single function the merged model is the model that the function just
+        published, so cache it with the version that the parameter server will
+        give it after merging. The next iteration then only checks the version.
+        """
+        if not self.cache_model or self._model_version is None or self.args._N != 1:
+            return
+        if self._delta is not None:
+            return
+
+        model_cache.put(self.args._job_id, self._model_version + 1, state)
 
     def __get_model_dict(self) -> Dict[str, torch.Tensor]:
         """
-        Fetches the model weights from the tensor storage
+        Fetches the model weights from the tensor storage. All the layers
+        are requested in pipelines so the model is loaded in a few round trips
 
         :return: The state dict of the reference model
         """
         job_id = self.args._job_id
 
-        state = dict()
-        for name in self._network.state_dict():
-            # load each of the layers in the statedict
-            weight_key = f'{job_id}:{name}'
-            w = self._redis_client.tensorget(weight_key)
-            # set the weight
-            state[weight_key[len(job_id) + 1:]] = torch.from_numpy(w)
+        if self.layout == LAYOUT_FLAT:
+            return read_model(self._redis_client, job_id, index=self.__get_flat_index())
+
+        local_state = self._network.state_dict()
+        names = list(local_state)
+        keys = [f'{job_id}:{name}' for name in names]
+        sizes = [t.numel() * t.element_size() for t in local_state.values()]
+
+        weights = fetch_tensors(self._redis_client, keys, sizes, self.pipeline_chunk_bytes)
+        state = {name: torch.from_numpy(w) for name, w in zip(names, weights)}
 
         #self.logger.debug(f'Layers are {state.keys()}')
 
         return state
 
-    def __save_model(self):
+    def __get_flat_index(self) -> FlatIndex:
+        """
+        Returns the index of the network in the flat layout. The index only depends
+        on the network so it is built once and reused by the following invocations
         """
-        Saves the model to the tensor storage
+        if self._flat_index is None:
+            self._flat_index = FlatIndex.from_state_dict(self._network.state_dict())
+        return self._flat_index
+
+    def __save_model(self, state: Dict[str, torch.Tensor] = None):
+        """
+        Saves the model to the tensor storage. All the layers are published
+        in pipelines so the model is saved in a few round trips
+
+        :param state: the weights to save, the ones of the network by default
         """
+        if state is None:
+            state = self._network.state_dict()
+
         job_id = self.args._job_id
         task = self.args._task
         func_id = self.args._func_id
 
         self.logger.debug("Saving model to the database")
+        if self._delta is not None and self._reference_state is not None and task != 'init':
+            self.__save_delta(state)
+            return
+
+        if self.layout == LAYOUT_FLAT:
+            self._flat_buffer = write_model(self._redis_client, job_id, state,
+                                            func_id=-1 if task == 'init' else func_id,
+                                            index=self.__get_flat_index(),
+                                            out=self._flat_buffer)
+            self.logger.debug('Saved flat model to the database')
+            return
+
+        keys, arrays = [], []
         with torch.no_grad():
-            for name, layer in self._network.state_dict().items():
+            for name, layer in state.items():
                 # Save the weights
                 weight_key = f'{job_id}:{name}' \
                     if task == 'init' \
                     else f'{job_id}:{name}/{func_id}'
-                self._redis_client.tensorset(weight_key, layer.cpu().detach().numpy(), dtype='float32')
+                keys.append(weight_key)
+                arrays.append(tensor_to_numpy(layer))
+
+            publish_tensors(self._redis_client, keys, arrays, self.pipeline_chunk_bytes)
 
         self.logger.debug('Saved model to the database')
 
+    def __save_delta(self, state: Dict[str, torch.Tensor]):
+        """
+        Publishes the encoded difference between the trained model and
+        the reference model loaded at the start of the iteration
+
+        :param state: the weights of the trained model
+        """
+        job_id = self.args._job_id
+        func_id = self.args._func_id
+
+        encoder = delta_encoder(job_id, func_id, self._delta)
+        encoded = encoder.encode(state, self._reference_state)
+
+        pipe = self._redis_client.pipeline(transaction=False)
+        for name, blob in encoded.items():
+            pipe.set(delta_key(job_id, name, func_id), blob)
+        pipe.execute()
+
+        self.logger.debug(f'Saved model delta to the database, '
+                          f'{sum(len(b) for b in encoded.values())} bytes')
+
     def configure_optimizers(self) -> torch.optim.Optimizer:
         pass
 
@@ -0,0 +1,149 @@
+import json
+import logging
+import struct
+from typing import Any, Callable, Dict
+
+import numpy as np
+import torch
+
+# The encoded optimizer state is a small header followed by a json document with the
+# param groups and the description of the state entries, and the raw bytes of the
+# state tensors (i.e the momentum buffers of SGD or the moments of Adam) one after the other.
+# No pickle is involved, so loading a state can't execute code
+_MAGIC = b'KOPT'
+_VERSION = 1
+_HEADER = struct.Struct('<4sBI')
+
+# tensors are aligned so they can be viewed in place
+_ALIGNMENT = 8
+
+# key of the placeholders of the tensors in the param groups (i.e a tensor lr),
+# whose value is the position of the tensor in the group tensors
+_TENSOR_REF = '__tensor__'
+
+
+def _align(n: int) -> int:
+    return (n + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def encode_optimizer_state(state_dict: Dict[str, Any]) -> bytes:
+    """
+    Encodes the state dict of an optimizer
+
+    :param state_dict: the state dict returned by optimizer.state_dict()
+    :return: the encoded state
+    """
+    tensors, offset = [], 0
+
+    def add_tensor(value: torch.Tensor) -> list:
+        nonlocal offset
+        t = value.detach().cpu().contiguous()
+        tensors.append((offset, t))
+        description = [str(t.dtype).replace('torch.', ''), list(t.shape), offset]
+        offset = _align(offset + t.numel() * t.element_size())
+        return description
+
+    entries = []
+    for param_id, param_state in state_dict['state'].items():
+        for key, value in param_state.items():
+            if isinstance(value, torch.Tensor):
+                entries.append([param_id, key, *add_tensor(value)])
+            else:
+                # python scalars like the step counter of older torch versions
+                entries.append([param_id, key, None, None, value])
+
+    # hyperparameters of the groups can be tensors as well
+    group_tensors = []
+
+    def replace_tensors(value):
+        if isinstance(value, torch.Tensor):
+            group_tensors.append(add_tensor(value))
+            return {_TENSOR_REF: len(group_tensors) - 1}
+        if isinstance(value, (list, tuple)):
+            return [replace_tensors(v) for v in value]
+        return value
+
+    param_groups = [{key: replace_tensors(value) for key, value in group.items()}
+                    for group in state_dict['param_groups']]
+
+    meta = json.dumps({'param_groups': param_groups, 'state': entries, 'group_tensors': group_tensors},
+                      separators=(',', ':')).encode()
+    data_start = _align(_HEADER.size + len(meta))
+
+    blob = bytearray(data_start + offset)
+    _HEADER.pack_into(blob, 0, _MAGIC, _VERSION, len(meta))
+    blob[_HEADER.size:_HEADER.size + len(meta)] = meta
+
+    buffer = np.frombuffer(blob, dtype=np.uint8)
+    for off, t in tensors:
+        if t.numel() > 0:
+            buffer[data_start + off:data_start + off + t.numel() * t.element_size()] = \
+                t.reshape(-1).numpy().view(np.uint8)
+
+    return bytes(blob)
+
+
+def decode_optimizer_state(blob: bytes) -> Dict[str, Any]:
+    """
+    Decodes an optimizer state encoded with encode_optimizer_state. The blob is copied
+    once into a writable buffer and the state tensors are views of that buffer
+
+    :param blob: the encoded state
+    :return: the state dict to be passed to optimizer.load_state_dict
+    """
+    magic, version, meta_size = _HEADER.unpack_from(blob)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError(f'Unknown optimizer state format {magic}:{version}')
+
+    meta = json.loads(bytes(blob[_HEADER.size:_HEADER.size + meta_size]))
+    data_start = _align(_HEADER.size + meta_size)
+    buffer = bytearray(blob)
+
+    def read_tensor(dtype: str, shape: list, offset: int) -> torch.Tensor:
+        dtype = getattr(torch, dtype)
+        numel = int(np.prod(shape, dtype=np.int64))
+        t = torch.empty(0, dtype=dtype)
+        if numel > 0:
+            arr = np.frombuffer(buffer, dtype=t.numpy().dtype, count=numel, offset=data_start + offset)
+            t = torch.from_numpy(arr)
+        return t.view(shape)
+
+    state = {}
+    for param_id, key, dtype, shape, value in meta['state']:
+        if dtype is not None:
+            value = read_tensor(dtype, shape, value)
+        state.setdefault(param_id, {})[key] = value
+
+    group_tensors = [read_tensor(*t) for t in meta.get('group_tensors', [])]
+
+    def restore_tensors(value):
+        if isinstance(value, dict) and _TENSOR_REF in value:
+            return group_tensors[value[_TENSOR_REF]]
+        if isinstance(value, list):
+            return [restore_tensors(v) for v in value]
+        return value
+
+    param_groups = [{key: restore_tensors(value) for key, value in group.items()}
+                    for group in meta['param_groups']]
+
+    return {'state': state, 'param_groups': param_groups}
+
+
+def lazy_load(optimizer: torch.optim.Optimizer, load: Callable[[], None]):
+    """
+    Defers loading the state of the optimizer until its first step. The load function
+    is called once, right before the first call to optimizer.step()
+
+    :param optimizer: the optimizer
+    :param load: function that loads the state in the optimizer
+    """
+    step = optimizer.step
+
+    def step_and_load(*args, **kwargs):
+        # restore the original step before loading in case the load fails
+        optimizer.step = step
+        logging.debug('Loading optimizer state before the first step')
+        load()
+        return step(*args, **kwargs)
+
+    optimizer.step = step_and_load
@@ -0,0 +1,95 @@
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Max bytes of training data held by a function while prefetching, that is the
+# data of the interval being trained plus the data of the next one
+PREFETCH_MEMORY_BYTES = int(os.environ.get('PREFETCH_MEMORY_BYTES', 1024 * 1024 * 1024))
+
+# background thread shared by all the invocations served by this process
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kubeml-prefetch')
+
+Arrays = Tuple[np.ndarray, np.ndarray]
+
+
+class IntervalPrefetcher:
+    """
+    IntervalPrefetcher loads the training data of the intervals of an invocation,
+    fetching and decoding the subsets of the next interval in a background thread
+    while the current one trains.
+
+    The arrays are double buffered: the next interval is decoded into the arrays of the
+    interval before the current one, which are no longer used, so at most two intervals
+    are held in memory. If they don't fit in the memory budget the next interval is
+    loaded synchronously when it is needed.
+    """
+
+    def __init__(self, dataset, intervals: List[Sequence[int]], max_bytes: int = PREFETCH_MEMORY_BYTES):
+        """
+        :param dataset: the KubeDataset the data is loaded from
+        :param intervals: the subsets loaded in each interval
+        :param max_bytes: memory budget for the data of the current and next intervals,
+            if 0 the data is never prefetched
+        """
+        self.dataset = dataset
+        self.intervals = intervals
+        self.max_bytes = max_bytes
+
+        self._current: Optional[Arrays] = None
+        self._future: Optional[Future] = None
+        self._next = None
+
+    def load(self, idx: int) -> Arrays:
+        """
+        Returns the data of an interval, waiting for it if it is being prefetched, and
+        starts prefetching the data of the following interval
+
+        :param idx: index of the interval
+        :return: the features and labels of the interval
+        """
+        spare, self._current = self._current, None
+
+        if self._future is not None and self._next == idx:
+            arrays = self._future.result()
+            logging.debug(f'Using prefetched data of interval {idx}')
+        else:
+            self.close()
+            arrays = self._fetch(idx, spare)
+            spare = None
+
+        self._future, self._next = None, None
+        self._current = arrays
+        self._prefetch(idx + 1, spare)
+        return arrays
+
+    def close(self):
+        """
+        Drops the interval being prefetched, if any. If the background thread already
+        started loading it, waits for it to finish so it no longer writes to the arrays
+        """
+        future, self._future, self._next = self._future, None, None
+        if future is not None and not future.cancel():
+            try:
+                future.result()
+            except Exception as e:
+                logging.debug(f'Dropped prefetched interval failed: {e}')
+
+    def _prefetch(self, idx: int, spare: Optional[Arrays]):
+        if idx >= len(self.intervals):
+            return
+
+        current = sum(arr.nbytes for arr in self._current)
+        estimate = self.dataset._estimate_bytes(len(self.intervals[idx])) or current
+        if current + estimate > self.max_bytes:
+            logging.debug(f'Interval {idx} does not fit in the prefetch budget, '
+                          f'{current + estimate} > {self.max_bytes} bytes')
+            return
+
+        self._next = idx
+        self._future = _executor.submit(self._fetch, idx, spare)
+
+    def _fetch(self, idx: int, out: Optional[Arrays]) -> Arrays:
+        return self.dataset._fetch_train_subsets(self.intervals[idx], out)
@@ -0,0 +1,46 @@
+import os
+
+import redis
+
+# Seconds the claim counters of an interval are kept in redis after the last claim
+STEAL_KEY_SECONDS = int(os.environ.get('STEAL_KEY_SECONDS', 24 * 3600))
+
+
+def claims_key(job_id: str, epoch: int, interval: int, func_id: int) -> str:
+    """
+    Returns the key holding the number of chunks claimed from the samples
+    planned for a function in an interval of an epoch
+    """
+    return f'{job_id}:claims:{epoch}:{interval}:{func_id}'
+
+
+class WorkQueue:
+    """
+    WorkQueue hands out the chunks of the samples planned for the functions in an interval.
+
+    Each function has a counter in redis with the number of chunks claimed from its samples.
+    A function claims its own chunks one at a time before training them, and once it runs out
+    it claims the chunks left by the slower functions, so every chunk is trained exactly once,
+    either by the function it was planned for or by a faster one
+    """
+
+    def __init__(self, client: redis.Redis, job_id: str, epoch: int, interval: int):
+        self.client = client
+        self.job_id = job_id
+        self.epoch = epoch
+        self.interval = interval
+
+    def claim(self, func_id: int) -> int:
+        """
+        Claims the next chunk of the samples of a function
+
+        :param func_id: the function the chunk is claimed from
+        :return: the index of the chunk, if it is not lower than the number of chunks
+            of the function all of them were already claimed
+        """
+        key = claims_key(self.job_id, self.epoch, self.interval, func_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.expire(key, STEAL_KEY_SECONDS)
+        claimed, _ = pipe.execute()
+        return claimed - 1
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Directory of the node local cache of the dataset subsets, shared by the function pods
+# of the node through a host path, and max bytes it may hold. If 0 the cache is disabled
+DATASET_CACHE_DIR = os.environ.get('DATASET_CACHE_DIR', '/output/kubeml-datasets')
+DATASET_CACHE_BYTES = int(os.environ.get('DATASET_CACHE_BYTES', 4 * 1024 * 1024 * 1024))
+
+# The size of the cache is tracked from the files saved by this process, and the
+# directory is scanned again to account for the other pods when it grows over its size
+# or after this many seconds since the last scan
+DATASET_CACHE_SCAN_SECONDS = int(os.environ.get('DATASET_CACHE_SCAN_SECONDS', 60))
+
+# temporary files older than this were left by writers that died and are removed
+_STALE_SECONDS = 3600
+
+_DATA_SUFFIX, _LABELS_SUFFIX = '.data.npy', '.labels.npy'
+
+Arrays = Tuple[np.ndarray, np.ndarray]
+
+
+def metadata_version(metadata: dict) -> str:
+    """
+    Returns the version of a dataset used to key its subsets in the cache, a digest of its
+    metadata, which includes the id of the upload, so a dataset deleted and uploaded again
+    with the same name doesn't read the subsets of the previous one
+    """
+    encoded = json.dumps(metadata, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+class SubsetCache:
+    """
+    SubsetCache keeps the subsets of the datasets read by the functions in a directory
+    of the node, so following epochs memory map them instead of reading them from the storage.
+
+    Each subset is saved as two .npy files, features and labels, under the dataset,
+    the version of its metadata and the collection. The files are written to a temporary
+    file and renamed, so the pods of the node sharing the directory never read partial files,
+    and the length of both files is checked when they are read. The recency of a subset is the
+    modification time of its files, updated when they are read, and the least recently used
+    subsets are removed, both files at once, when the cache grows over its size.
+    """
+
+    def __init__(self, root: str = DATASET_CACHE_DIR, max_bytes: int = DATASET_CACHE_BYTES,
+                 scan_seconds: int = DATASET_CACHE_SCAN_SECONDS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.scan_seconds = scan_seconds
+
+        # bytes in the cache as of the last scan plus the ones saved since then
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._scanned = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, dataset: str, version: str, collection: str, subset: int,
+            samples: Optional[int] = None) -> Optional[Arrays]:
+        """
+        Returns the memory mapped features and labels of a subset, None if it is not cached
+        or its files don't hold the same number of samples, in which case they are removed
+
+        :param dataset: name of the dataset
+        :param version: version of the dataset, see metadata_version
+        :param collection: train or test
+        :param subset: id of the subset
+        :param samples: number of samples the subset must hold, if known
+        """
+        data_path, labels_path = self._paths(dataset, version, collection, subset)
+        try:
+            data = np.load(data_path, mmap_mode='r')
+            labels = np.load(labels_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        if len(data) != len(labels) or (samples is not None and len(data) != samples):
+            logging.warning(f'Subset {subset} of {dataset} in the cache holds {len(data)} samples '
+                            f'and {len(labels)} labels, removing it')
+            self._remove(data_path, labels_path)
+            return None
+
+        try:
+            os.utime(data_path)
+            os.utime(labels_path)
+        except OSError:
+            return None
+        return data, labels
+
+    def put(self, dataset: str, version: str, collection: str, subset: int, data: np.ndarray, labels: np.ndarray):
+        """
+        Saves a subset in the cache. Errors are logged and ignored, the cache is only
+        an optimization
+
+        :param dataset: name of the dataset
+        :param version: version of the dataset, see metadata_version
+        :param collection: train or test
+        :param subset: id of the subset
+        :param data: the features
+        :param labels: the labels
+        """
+        data_path, labels_path = self._paths(dataset, version, collection, subset)
+        try:
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            # the labels go first, a subset is only read once its features exist
+            written = self._write(labels_path, labels) + self._write(data_path, data)
+        except OSError as e:
+            logging.warning(f'Could not save subset {subset} of {dataset} in the cache: {e}')
+            return
+
+        with self._lock:
+            self._bytes += written
+
+    def evict(self):
+        """
+        Removes the least recently used subsets until the cache fits in its size. The
+        directory is only scanned if the size tracked goes over the limit or the last
+        scan is older than scan_seconds
+        """
+        with self._lock:
+            if self._scanned is not None and self._bytes <= self.max_bytes \
+                    and time.time() - self._scanned < self.scan_seconds:
+                return
+
+            subsets, total = self._scan()
+            removed = 0
+            if total > self.max_bytes:
+                # least recently used first, a subset was used when either of its files was
+                for _, size, files in sorted(subsets.values()):
+                    if total <= self.max_bytes:
+                        break
+                    self._remove(*files)
+                    total -= size
+                    removed += 1
+                logging.debug(f'Evicted {removed} subsets from the dataset cache, {total} bytes left')
+
+            self._bytes, self._scanned = total, time.time()
+
+    def _scan(self):
+        """Returns the last use, bytes and files of every subset in the cache, and the bytes of all of them"""
+        subsets, total, now = {}, 0, time.time()
+        for path, _, files in os.walk(self.root):
+            for name in files:
+                file = os.path.join(path, name)
+                try:
+                    stat = os.stat(file)
+                    if name.endswith('.tmp'):
+                        if now - stat.st_mtime > _STALE_SECONDS:
+                            os.remove(file)
+                        continue
+                except OSError:
+                    continue
+
+                base = file
+                for suffix in (_DATA_SUFFIX, _LABELS_SUFFIX):
+                    if file.endswith(suffix):
+                        base = file[:-len(suffix)]
+                used, size, paths = subsets.get(base, (0, 0, []))
+                subsets[base] = (max(used, stat.st_mtime), size + stat.st_size, paths + [file])
+                total += stat.st_size
+
+        return subsets, total
+
+    def _paths(self, dataset: str, version: str, collection: str, subset: int) -> Tuple[str, str]:
+        base = os.path.join(self.root, dataset, version, collection, str(subset))
+        return f'{base}{_DATA_SUFFIX}', f'{base}{_LABELS_SUFFIX}'
+
+    @staticmethod
+    def _remove(*files: str):
+        for file in files:
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _write(path: str, arr: np.ndarray) -> int:
+        """Writes an array to a temporary file renamed to the path, returns its bytes"""
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(arr))
+                size = f.tell()
+            os.replace(tmp, path)
+            return size
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+# cache of the subsets read by the functions of this node
+subset_cache = SubsetCache()
@@ -0,0 +1,123 @@
+import logging
+from typing import List, Sequence, Optional
+
+import numpy as np
+import redisai as rai
+import torch
+
+# Default upper bound on the number of bytes requested in a single
+# pipeline. Pipelines are flushed in one round trip, so the whole reply
+# is buffered by the client before it is parsed. Bounding it keeps the
+# memory peak of huge models (i.e VGG with its 400MB classifier) under control
+PIPELINE_CHUNK_BYTES = 64 * 1024 * 1024
+
+# Types of the tensors as saved in RedisAI. The parameter server is able to
+# merge float32 and int64 layers, so those are the types used when publishing
+REDISAI_DTYPES = {
+    np.dtype('float32'): 'FLOAT',
+    np.dtype('int64'): 'INT64',
+}
+
+
+def chunk_keys(keys: Sequence[str],
+               sizes: Optional[Sequence[int]] = None,
+               chunk_bytes: Optional[int] = PIPELINE_CHUNK_BYTES) -> List[List[str]]:
+    """
+    Groups the keys in chunks whose expected size in bytes is below
+    the given limit. A key bigger than the limit is placed in its own chunk.
+
+    :param keys: names of the tensors in the storage
+    :param sizes: expected size in bytes of each of the tensors
+    :param chunk_bytes: max bytes per chunk, if None or 0 all keys go in the same chunk
+    :return: the list of chunks of keys
+    """
+    if not keys:
+        return []
+
+    if not chunk_bytes or sizes is None:
+        return [list(keys)]
+
+    chunks, current, current_bytes = [], [], 0
+    for key, size in zip(keys, sizes):
+        if current and current_bytes + size > chunk_bytes:
+            chunks.append(current)
+            current, current_bytes = [], 0
+        current.append(key)
+        current_bytes += size
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+def fetch_tensors(client: rai.Client,
+                  keys: Sequence[str],
+                  sizes: Optional[Sequence[int]] = None,
+                  chunk_bytes: Optional[int] = PIPELINE_CHUNK_BYTES) -> List[np.ndarray]:
+    """
+    Fetches a group of tensors from RedisAI using pipelines, so that the
+    whole model is retrieved in one (or a few if chunked) round trips instead
+    of one round trip per tensor.
+
+    :param client: redisai client used to query the tensors
+    :param keys: names of the tensors to fetch
+    :param sizes: expected size in bytes of each tensor, used to chunk the pipelines
+    :param chunk_bytes: max bytes requested per pipeline
+    :return: the numpy arrays in the same order as the keys
+    """
+    tensors = []
+    for chunk in chunk_keys(keys, sizes, chunk_bytes):
+        pipe = client.pipeline(transaction=False)
+        for key in chunk:
+            pipe.tensorget(key)
+        tensors.extend(pipe.execute())
+
+    logging.debug(f'Fetched {len(tensors)} tensors')
+    return tensors
+
+
+def tensor_to_numpy(tensor: torch.Tensor) -> np.ndarray:
+    """
+    Returns the tensor as a numpy array in the type used to publish it, which is
+    float32 for floating point tensors and int64 for the rest (like the num_batches_tracked
+    buffers of the batch normalization layers).
+
+    If the tensor is already a contiguous cpu tensor of that type no copy is made,
+    the array shares the memory with the tensor
+
+    :param tensor: the tensor to convert
+    :return: numpy array with the contents of the tensor
+    """
+    dtype = torch.float32 if tensor.is_floating_point() else torch.int64
+    return tensor.detach().to(device='cpu', dtype=dtype).contiguous().numpy()
+
+
+def publish_tensors(client: rai.Client,
+                    keys: Sequence[str],
+                    arrays: Sequence[np.ndarray],
+                    chunk_bytes: Optional[int] = PIPELINE_CHUNK_BYTES):
+    """
+    Saves a group of tensors to RedisAI using pipelines so the whole model is
+    published in one (or a few if chunked) round trips.
+
+    The tensors are sent as a view of the array memory, so unlike the redisai
+    tensorset no intermediate copy of the weights is done.
+
+    :param client: redisai client used to save the tensors
+    :param keys: names of the tensors to save
+    :param arrays: contiguous arrays with the values, must be float32 or int64
+    :param chunk_bytes: max bytes sent per pipeline
+    """
+    values = dict(zip(keys, arrays))
+    sizes = [a.nbytes for a in arrays]
+
+    for chunk in chunk_keys(keys, sizes, chunk_bytes):
+        pipe = client.pipeline(transaction=False)
+        for key in chunk:
+            arr = values[key]
+            pipe.execute_command('AI.TENSORSET', key, REDISAI_DTYPES[arr.dtype], *arr.shape,
+                                 'BLOB', arr.reshape(-1).view(np.uint8).data)
+        pipe.execute()
+
+    logging.debug(f'Published {len(values)} tensors')
@@ -0,0 +1,71 @@
+from typing import Sequence
+
+import torch
+import torch.nn.functional as F
+
+# Vectorized versions of the usual per sample image transforms, applied to a whole
+# minibatch at once from KubeDataset.transform_batch. The images are (N, C, H, W) tensors
+# except for the input of to_tensor, which takes the (N, H, W, C) uint8 arrays as stored
+
+
+def to_tensor(x: torch.Tensor) -> torch.Tensor:
+    """
+    Converts a batch of (N, H, W, C) uint8 images to (N, C, H, W) floats in [0, 1],
+    like ToTensor does for a single image
+
+    :param x: the images
+    :return: the converted images
+    """
+    return x.permute(0, 3, 1, 2).float().div_(255)
+
+
+def random_crop(x: torch.Tensor, size: int, padding: int = 0) -> torch.Tensor:
+    """
+    Crops each image of the batch at a random position after zero padding it, like RandomCrop.
+    The crops are taken with a single indexing operation over the padded batch
+
+    :param x: the images
+    :param size: height and width of the crops
+    :param padding: padding added to each side of the images
+    :return: the cropped images
+    """
+    if padding > 0:
+        x = F.pad(x, (padding, padding, padding, padding))
+
+    n, c, h, w = x.shape
+    top = torch.randint(0, h - size + 1, (n, 1))
+    left = torch.randint(0, w - size + 1, (n, 1))
+    rows = top + torch.arange(size)
+    cols = left + torch.arange(size)
+
+    return x[torch.arange(n)[:, None, None, None],
+             torch.arange(c)[None, :, None, None],
+             rows[:, None, :, None],
+             cols[:, None, None, :]]
+
+
+def random_horizontal_flip(x: torch.Tensor, p: float = 0.5) -> torch.Tensor:
+    """
+    Flips horizontally each image of the batch with probability p, like RandomHorizontalFlip
+
+    :param x: the images
+    :param p: probability of flipping an image
+    :return: the images
+    """
+    mask = torch.rand(len(x)) < p
+    return torch.where(mask[:, None, None, None], x.flip(-1), x)
+
+
+def normalize(x: torch.Tensor, mean: Sequence[float], std: Sequence[float]) -> torch.Tensor:
+    """
+    Normalizes each channel of the batch with the mean and std given, like Normalize,
+    as a single fused multiply add
+
+    :param x: the images
+    :param mean: mean of each channel
+    :param std: std of each channel
+    :return: the normalized images
+    """
+    scale = 1 / torch.tensor(std, dtype=x.dtype)
+    shift = -torch.tensor(mean, dtype=x.dtype) * scale
+    return torch.addcmul(shift[None, :, None, None], x, scale[None, :, None, None])
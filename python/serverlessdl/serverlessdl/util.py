@@ -1,12 +1,14 @@
 import logging
 import math
 import os
-from typing import List
+from typing import List, Optional, Sequence
 
+import numpy as np
 import torch
 import torch.nn as nn
 
-# Number of datapoints in storage on average
+# Number of datapoints in storage on average, used
+# for the datasets uploaded without metadata
 STORAGE_SUBSET_SIZE = 64
 
 
@@ -56,26 +58,256 @@ def split_minibatches(a: range, n: int) -> List[range]:
     return [a[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
 
 
-def get_subset_period(K: int, batch_size: int, assigned_subsets: range) -> int:
+def shuffle_subsets(num_subsets: int, n: int, epoch: int, seed: int = 0,
+                    block_size: int = 1, locality: float = 0.0) -> List[List[int]]:
     """
-    Calculates the number of subsets that will be evaluated per iteration
-    to fulfill the K-avg sync.
+    Assigns the subsets of the dataset to the functions so that each one trains on
+    a different part of the dataset every epoch. The assignment only depends on the
+    arguments, so all the functions of an epoch compute the same one.
 
-    Calculates the number of datapoints before sync, and from there calculates
-    the number of subsets for those
+    The subsets are shuffled in blocks of consecutive subsets, which are read from the
+    storage with a single cursor. The blocks are randomly split among the functions in
+    the first epoch, and in every following epoch each function keeps a fraction of its
+    blocks, likely already in the cache of its node, while the rest are shuffled among all
+    the functions. With locality 0 the assignment is a new permutation every epoch,
+    with locality 1 it is fixed after the first one.
 
-    :param K: Number of forward passes to be done
-    :param batch_size: size of the batch
-    :param assigned_subsets: the data subsets assigned to this function
+    :param num_subsets: number of subsets of the dataset
+    :param n: number of functions
+    :param epoch: the epoch
+    :param seed: seed of the permutations, the same for all the epochs of a job
+    :param block_size: number of consecutive subsets shuffled together
+    :param locality: fraction of the blocks kept by each function from the previous epoch
+    :return: the subsets assigned to each function, indexed by the funcId
+    """
+    blocks = [range(i, min(i + block_size, num_subsets)) for i in range(0, num_subsets, block_size)]
+
+    rng = np.random.RandomState([seed, 0])
+    order = rng.permutation(len(blocks)).tolist()
+    assigned = [order[r.start:r.stop] for r in split_minibatches(range(len(blocks)), n)]
+
+    for e in range(1, epoch + 1):
+        rng = np.random.RandomState([seed, e])
+
+        # each function releases every block with probability 1 - locality, the
+        # released blocks are shuffled and given back to fill the released positions
+        released = [np.flatnonzero(rng.random_sample(len(owned)) >= locality).tolist() for owned in assigned]
+
+        pool = [owned[i] for owned, positions in zip(assigned, released) for i in positions]
+        rng.shuffle(pool)
+        for owned, positions in zip(assigned, released):
+            for i in positions:
+                owned[i] = pool.pop()
+
+        # change the order of the blocks so the intervals mix different blocks
+        for owned in assigned:
+            rng.shuffle(owned)
+
+    return [[i for b in owned for i in blocks[b]] for owned in assigned]
+
+
+# How the planner splits the samples between the functions, either training every function on all
+# the samples of its subsets, or splitting the samples evenly and equalizing them, repeating some of
+# the samples of the functions with fewer of them or dropping the extra samples of the functions with more
+PARTITION_NONE = 'none'
+PARTITION_PAD = 'pad'
+PARTITION_DROP = 'drop'
+PARTITION_MODES = [PARTITION_NONE, PARTITION_PAD, PARTITION_DROP]
+
+
+class IntervalPlan:
+    """
+    Samples trained by a function in an interval, as ranges of ids of the samples of the dataset.
+    The function loads the subsets holding them, in ascending order, and trains on the rows of
+    the loaded data that hold the samples
+    """
+
+    def __init__(self, samples: List[range], subset_size: int, num_samples: int):
+        self.samples = samples
+        self.subset_size = subset_size
+        self.num_samples = num_samples
+
+    @property
+    def subsets(self) -> List[int]:
+        """The ids of the subsets that hold the samples, in ascending order"""
+        ids = set()
+        for r in self.samples:
+            ids.update(range(r.start // self.subset_size, -(-r.stop // self.subset_size)))
+        return sorted(ids)
+
+    def rows(self, subsets: Optional[Sequence[int]] = None) -> np.ndarray:
+        """
+        The positions of the samples in the concatenation of the subsets
+
+        :param subsets: the subsets loaded, in ascending order, which must hold the samples.
+            By default the subsets of the plan
+        """
+        subsets = np.array(self.subsets if subsets is None else subsets, dtype=np.int64)
+        sizes = np.minimum(self.subset_size, self.num_samples - subsets * self.subset_size)
+        offsets = np.cumsum(sizes) - sizes
+
+        samples = np.concatenate([np.arange(r.start, r.stop) for r in self.samples]) \
+            if self.samples else np.empty(0, dtype=np.int64)
+        first = offsets[np.searchsorted(subsets, samples // self.subset_size)]
+        return first + samples % self.subset_size
+
+    def chunks(self, size: int) -> List['IntervalPlan']:
+        """Splits the samples in consecutive chunks of the given number of samples"""
+        return [IntervalPlan(_slice(self.samples, start, start + size), self.subset_size, self.num_samples)
+                for start in range(0, len(self), size)]
+
+    def __len__(self):
+        return sum(len(r) for r in self.samples)
+
+    def __repr__(self):
+        return f'IntervalPlan(samples={len(self)}, ranges={[(r.start, r.stop) for r in self.samples]})'
+
+
+class PartitionPlan:
+    """
+    Samples trained by each function in each interval of an epoch. Unless the mode is none, all the
+    functions train on the same number of samples split in the same intervals, so they run the same
+    number of optimizer steps in each interval and none of them waits for the others in the merges
+    """
+
+    def __init__(self, intervals: List[List[IntervalPlan]], batch_size: int, mode: str):
+        self.intervals = intervals
+        self.batch_size = batch_size
+        self.mode = mode
 
-    :return: the number of subsets that must be loaded per iteration
+    def steps(self, func_id: int) -> List[int]:
+        """Returns the optimizer steps run by a function in each of its intervals"""
+        return [-(-len(interval) // self.batch_size) for interval in self.intervals[func_id]]
+
+    def __getitem__(self, func_id: int) -> List[IntervalPlan]:
+        return self.intervals[func_id]
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __repr__(self):
+        samples = [sum(len(i) for i in intervals) for intervals in self.intervals] or [0]
+        steps = [sum(self.steps(f)) for f in range(len(self))] or [0]
+        intervals = [len(i) for i in self.intervals] or [0]
+        return f'PartitionPlan(functions={len(self)}, mode={self.mode}, ' \
+               f'samples per function={_spread(samples)}, intervals={_spread(intervals)}, ' \
+               f'steps per function={_spread(steps)})'
+
+
+def _spread(values: List[int]) -> str:
+    lo, hi = min(values), max(values)
+    return str(lo) if lo == hi else f'{lo}-{hi}'
+
+
+def subset_samples(subsets: Sequence[int], subset_size: int, num_samples: int) -> List[range]:
     """
+    Returns the ranges of ids of the samples held by the given subsets
+
+    :param subsets: ids of the subsets
+    :param subset_size: number of samples per subset
+    :param num_samples: number of samples of the dataset
+    :return: the sample ranges, joining those of consecutive subsets
+    """
+    ranges = []
+    for s in subsets:
+        r = range(s * subset_size, min((s + 1) * subset_size, num_samples))
+        if len(r) == 0:
+            continue
+        if ranges and ranges[-1].stop == r.start:
+            ranges[-1] = range(ranges[-1].start, r.stop)
+        else:
+            ranges.append(r)
+    return ranges
+
+
+def plan_partitions(num_samples: int, n: int, K: int, batch_size: int,
+                    subset_size: int = STORAGE_SUBSET_SIZE,
+                    assignment: List[List[int]] = None,
+                    mode: str = PARTITION_NONE) -> PartitionPlan:
+    """
+    Plans the samples trained by each function in each interval of an epoch.
+
+    The subsets of the dataset are split in contiguous ranges across the functions, or taken
+    from the given assignment. With none every function trains on all the samples of its subsets,
+    in intervals of the subsets holding K batches, or a single interval if K is -1, so the
+    functions may train a different number of batches.
+
+    Otherwise the samples of the subsets, in the order of the assignment, are split evenly across
+    the functions. The samples of each function are then equalized, repeating the first samples of
+    the functions with fewer samples (pad) or dropping the last samples of the functions with more
+    (drop), and split in intervals of exactly K batches, or a single interval if K is -1. If there
+    are more functions than samples dropping would leave all of them without samples, so they are
+    padded instead
+
+    :param num_samples: number of samples of the dataset
+    :param n: number of functions
+    :param K: number of batches per interval, -1 to train on all the samples before merging
+    :param batch_size: size of the batch
+    :param subset_size: number of samples per subset of the dataset
+    :param assignment: the subsets of each function, see shuffle_subsets
+    :param mode: none, pad or drop
+    :return: the plan
+    """
+    if mode not in PARTITION_MODES:
+        raise ValueError(f'Partition mode {mode} not recognized, must be one of {PARTITION_MODES}')
+
+    if assignment is None:
+        num_subsets = -(-num_samples // subset_size)
+        assignment = [list(r) for r in split_minibatches(range(num_subsets), n)]
+
+    if mode == PARTITION_NONE:
+        intervals = []
+        for subsets in assignment:
+            period = len(subsets) if K == -1 else int(math.ceil((batch_size * K) / subset_size))
+            intervals.append([IntervalPlan(subset_samples(subsets[i:i + period], subset_size, num_samples),
+                                           subset_size, num_samples)
+                              for i in range(0, len(subsets), max(period, 1))])
+        return PartitionPlan(intervals, batch_size, mode)
+
+    # the samples of all the subsets, in the order they are assigned, split evenly
+    # so the functions keep most of their subsets and differ in at most one sample
+    sequence = subset_samples([s for subsets in assignment for s in subsets], subset_size, num_samples)
+    total = sum(len(r) for r in sequence)
+    partitions = [_slice(sequence, r.start, r.stop) for r in split_minibatches(range(total), n)]
+
+    counts = [sum(len(r) for r in ranges) for ranges in partitions]
+    target = max(counts) if mode == PARTITION_PAD else min(counts)
+    if target == 0 and total > 0:
+        logging.warning(f'Cannot drop samples to equalize {n} functions with {total} samples, padding them instead')
+        mode, target = PARTITION_PAD, max(counts)
+
+    intervals = []
+    for ranges, count in zip(partitions, counts):
+        # functions left without samples, when there are more functions than samples, pad from the dataset
+        if count == 0 and mode == PARTITION_PAD:
+            ranges, count = [range(num_samples)], num_samples
+        samples = _take(ranges, target) if count >= target or count == 0 else ranges + _cycle(ranges, target - count)
+        size = target if K == -1 else K * batch_size
+        intervals.append([IntervalPlan(_slice(samples, start, start + size), subset_size, num_samples)
+                          for start in range(0, target, max(size, 1))])
+
+    return PartitionPlan(intervals, batch_size, mode)
+
+
+def _take(ranges: List[range], count: int) -> List[range]:
+    return _slice(ranges, 0, count)
+
+
+def _cycle(ranges: List[range], count: int) -> List[range]:
+    """Repeats the ranges from the start until they hold count samples"""
+    out, total = [], sum(len(r) for r in ranges)
+    while count > 0:
+        out.extend(_take(ranges, min(count, total)))
+        count -= total
+    return out
 
-    # if K is -1, it means that we process all the data
-    # assigned to us before syncing after a full epoch, so
-    # return the length of the subsets
-    if K == -1:
-        return len(assigned_subsets)
 
-    # calculate number of datapoints in K passes and divide to get the number of subsets
-    return int(math.ceil((batch_size * K) / STORAGE_SUBSET_SIZE))
+def _slice(ranges: List[range], start: int, stop: int) -> List[range]:
+    """Returns the samples between the positions start and stop of the concatenation of the ranges"""
+    out, pos = [], 0
+    for r in ranges:
+        lo, hi = max(start - pos, 0), min(stop - pos, len(r))
+        if lo < hi:
+            out.append(r[lo:hi])
+        pos += len(r)
+    return out
@@ -22,5 +22,9 @@ setup(
         'pymongo>=3.11.1',
         'flask>=1.1.2'
     ],
+    extras_require={
+        'lz4': ['lz4'],
+        'zstd': ['zstandard'],
+    },
     license="MIT",
 )
@@ -0,0 +1,64 @@
+import os
+import sys
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pytest
+import torch
+
+# the tests run against the package of this directory, and the in-process
+# stand-in of the tensor storage lives with the benchmarks
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+from standin import LocalRedisAI  # noqa: E402
+from serverlessdl.dataset import KubeDataset  # noqa: E402
+
+
+class SubsetDataset(KubeDataset):
+    """
+    Dataset generated in memory instead of read from the storage. The first two features
+    of every sample hold the id of its subset and its position in it, and the fetched
+    subsets are recorded
+    """
+
+    def __init__(self, num_docs: int = 10, subset_size: int = 64, features: int = 4):
+        # the storage is not used, so the init of KubeDataset is skipped
+        self.dataset = 'test'
+        self.read_shards = 1
+        self._mode = None
+        self._args = None
+        self.data, self.labels = None, None
+        self.metadata = None
+        self.preprocessing = None
+        self.subset_size = subset_size
+        self.features = features
+        self.num_docs = num_docs
+        self.num_val_docs = 1
+        self.num_samples = num_docs * subset_size
+        self.fetched: List[List[int]] = []
+
+    def _fetch_train_subsets(self, subsets: Sequence[int],
+                             out: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        self.fetched.append(list(subsets))
+        data = np.zeros((len(subsets) * self.subset_size, self.features), dtype=np.float32)
+        data[:, 0] = np.repeat(subsets, self.subset_size)
+        data[:, 1] = np.tile(np.arange(self.subset_size), len(subsets))
+        return data, np.zeros(len(data), dtype=np.int64)
+
+    def __getitem__(self, index: int):
+        return torch.from_numpy(self.data[index]), int(self.labels[index])
+
+    def __len__(self):
+        return len(self.data)
+
+
+@pytest.fixture
+def redis_client() -> LocalRedisAI:
+    return LocalRedisAI(rtt=0)
+
+
+@pytest.fixture
+def dataset() -> SubsetDataset:
+    return SubsetDataset()
@@ -0,0 +1,45 @@
+import torch
+
+from serverlessdl.cache import ModelCache, parse_version
+
+
+def _state(value: float):
+    return {'weight': torch.full((4, 2), value), 'bias': torch.full((2,), value)}
+
+
+def test_hit():
+    cache = ModelCache()
+    cache.put('job', 1, _state(1.0))
+
+    cached = cache.get('job', 1)
+    assert cached is not None
+    assert all(torch.equal(cached[name], t) for name, t in _state(1.0).items())
+
+
+def test_miss_on_version_bump():
+    cache = ModelCache()
+    assert cache.get('job', 1) is None
+
+    cache.put('job', 1, _state(1.0))
+    assert cache.get('job', 2) is None
+    assert cache.get('job', None) is None
+
+    # the buffer is reused by the next version
+    buffer = cache._buffer
+    cache.put('job', 2, _state(2.0))
+    assert cache._buffer is buffer
+    assert torch.equal(cache.get('job', 2)['weight'], _state(2.0)['weight'])
+
+
+def test_job_switch():
+    cache = ModelCache()
+    cache.put('a', 3, _state(1.0))
+    assert cache.get('b', 3) is None
+
+    cache.put('b', 3, _state(2.0))
+    assert cache.get('a', 3) is None
+    assert torch.equal(cache.get('b', 3)['bias'], _state(2.0)['bias'])
+
+    # a job without version clears the cache
+    cache.put('c', parse_version(None), _state(3.0))
+    assert cache.get('b', 3) is None
@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from serverlessdl.delta import DeltaConfig, DeltaEncoder, decode_delta, delta_encoder, encode_delta, \
+    SPARSIFY_THRESHOLD, SPARSIFY_TOPK
+
+
+@pytest.mark.parametrize('config', [
+    DeltaConfig(),
+    DeltaConfig(fp16=True),
+    DeltaConfig(SPARSIFY_TOPK, ratio=0.05),
+    DeltaConfig(SPARSIFY_THRESHOLD, threshold=0.15, fp16=True),
+])
+def test_encode_decode(config):
+    delta = torch.randn(10, 20, generator=torch.Generator().manual_seed(0)) * 0.1
+    blob, sent = encode_delta(delta, config)
+    assert torch.equal(decode_delta(blob, delta.shape), sent)
+
+
+def test_int_delta_is_exact():
+    delta = torch.tensor([3, -5, 7])
+    blob, sent = encode_delta(delta, DeltaConfig(SPARSIFY_TOPK, fp16=True))
+    assert torch.equal(decode_delta(blob, delta.shape), delta)
+
+
+def test_error_feedback():
+    config = DeltaConfig(SPARSIFY_TOPK, ratio=0.1)
+    encoder = DeltaEncoder(config)
+    reference = {'w': torch.zeros(100)}
+    state = {'w': torch.randn(100, generator=torch.Generator().manual_seed(0))}
+
+    blob = encoder.encode(state, reference)['w']
+    # the entries that were not sent are kept for the next iteration
+    assert torch.allclose(decode_delta(blob, (100,)) + encoder.residuals['w'], state['w'])
+
+
+def test_encoder_kept_by_process():
+    config = DeltaConfig(SPARSIFY_TOPK)
+    encoder = delta_encoder('job', 0, config)
+    assert delta_encoder('job', 0, DeltaConfig(SPARSIFY_TOPK)) is encoder
+    assert delta_encoder('job', 1, config) is not encoder
+
+    # other options start from new residuals
+    assert delta_encoder('job', 0, DeltaConfig()) is not encoder
+
+    # the encoders of a job are dropped when the process serves another one
+    encoder = delta_encoder('job', 0, config)
+    delta_encoder('other', 0, config)
+    assert delta_encoder('job', 0, config) is not encoder
@@ -0,0 +1,54 @@
+import importlib.util
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from serverlessdl import encoding
+
+
+def _storage_utils():
+    # the storage service is not a package, load its utils by path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'storage', 'utils.py')
+    spec = importlib.util.spec_from_file_location('storage_utils', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+storage = _storage_utils()
+
+
+def test_codecs_match():
+    assert storage.CODECS == encoding.CODECS
+    assert (storage.CODEC_RAW, storage.CODEC_LZ4, storage.CODEC_ZSTD) == \
+           (encoding.CODEC_RAW, encoding.CODEC_LZ4, encoding.CODEC_ZSTD)
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'float16', 'float32', 'int64'])
+def test_storage_round_trip(dtype):
+    arr = (np.random.RandomState(0).rand(5, 3, 4) * 100).astype(dtype)
+    for codec in storage.available_codecs():
+        decoded = encoding.decode_array(storage.encode_array(arr, codec))
+        assert decoded.dtype == arr.dtype
+        assert np.array_equal(decoded, arr)
+
+        # both modules produce the same documents
+        assert storage.encode_array(arr, codec)['bytes'] == encoding.encode_array(arr, codec)['bytes']
+
+
+def test_storage_rejects_unknown_codec(monkeypatch):
+    arr = np.arange(4)
+    with pytest.raises(ValueError):
+        storage.encode_array(arr, 'gzip')
+
+    # codecs whose library is not installed are rejected instead of saved uncompressed
+    monkeypatch.setattr(storage, 'zstandard', None)
+    with pytest.raises(ValueError):
+        storage.encode_array(arr, storage.CODEC_ZSTD)
+
+
+def test_pickled_arrays():
+    arr = np.arange(6).reshape(2, 3)
+    assert np.array_equal(encoding.decode_array(pickle.dumps(arr)), arr)
@@ -0,0 +1,109 @@
+from typing import Dict
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from serverlessdl.flat import flat_key, FlatIndex, index_key, read_model, write_model
+
+
+def random_state(seed: int) -> Dict[str, torch.Tensor]:
+    """State dict of a small network with float layers and the int64 counter of a batch norm"""
+    net = nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4), nn.Flatten(), nn.Linear(4, 2))
+    g = torch.Generator().manual_seed(seed)
+    state = {}
+    for name, t in net.state_dict().items():
+        if t.is_floating_point():
+            state[name] = torch.randn(t.shape, generator=g)
+        else:
+            state[name] = torch.randint(0, 1000, t.shape, generator=g, dtype=t.dtype)
+    return state
+
+
+def assert_state_equal(expected: Dict[str, torch.Tensor], actual: Dict[str, torch.Tensor]):
+    assert list(expected) == list(actual)
+    for name in expected:
+        assert actual[name].dtype == expected[name].dtype, name
+        assert torch.equal(actual[name], expected[name]), name
+
+
+def test_index_serialization():
+    index = FlatIndex.from_state_dict(random_state(0))
+    assert FlatIndex.loads(index.dumps()) == index
+    assert index.numel == sum(t.numel() for t in random_state(0).values())
+
+
+def test_pack_unpack():
+    state = random_state(0)
+    index = FlatIndex.from_state_dict(state)
+
+    buffer = index.pack(state)
+    assert buffer.dtype == np.float32 and buffer.shape == (index.numel,)
+    assert_state_equal(state, index.unpack(buffer))
+
+    # the preallocated buffer is reused
+    out = np.empty(index.numel, dtype=np.float32)
+    assert index.pack(random_state(1), out) is out
+    assert_state_equal(random_state(1), index.unpack(out))
+
+
+def test_unpack_size_mismatch():
+    index = FlatIndex.from_state_dict(random_state(0))
+    with pytest.raises(ValueError):
+        index.unpack(np.zeros(index.numel + 1, dtype=np.float32))
+
+
+def test_read_write_model(redis_client):
+    state = random_state(0)
+    index = FlatIndex.from_state_dict(state)
+
+    # the reference model saves its index
+    buffer = write_model(redis_client, 'job', state)
+    assert FlatIndex.loads(redis_client.get(index_key('job'))) == index
+    assert_state_equal(state, read_model(redis_client, 'job'))
+
+    # the models of the functions are read with the known index
+    write_model(redis_client, 'job', random_state(1), func_id=0, index=index, out=buffer)
+    assert_state_equal(random_state(1), read_model(redis_client, 'job', func_id=0, index=index))
+    assert_state_equal(state, read_model(redis_client, 'job'))
+
+
+def test_segments(redis_client):
+    state = random_state(0)
+    index = FlatIndex.from_state_dict(state, segment_size=10)
+    assert FlatIndex.loads(index.dumps()) == index
+    assert index != FlatIndex.from_state_dict(state)
+
+    # the buffer is split in segments of at most segment_size elements, the last one shorter
+    segments = index.segments
+    assert [len(r) for r in segments[:-1]] == [10] * (len(segments) - 1)
+    assert segments[0].start == 0 and segments[-1].stop == index.numel and 0 < len(segments[-1]) <= 10
+    assert index.segment_names == [f'__flat__:{i}' for i in range(len(segments))]
+
+    write_model(redis_client, 'job', state, index=index)
+    write_model(redis_client, 'job', random_state(1), func_id=2, index=index)
+    for i, r in enumerate(segments):
+        assert redis_client.tensorget(flat_key('job', i)).shape == (len(r),)
+        assert redis_client.tensorget(flat_key('job', i, 2)).shape == (len(r),)
+
+    assert_state_equal(state, read_model(redis_client, 'job'))
+    assert_state_equal(random_state(1), read_model(redis_client, 'job', func_id=2, index=index))
+
+
+def test_average():
+    a, b = random_state(0), random_state(1)
+    index = FlatIndex.from_state_dict(a)
+
+    # the parameter server sums the flat models and divides by their number
+    avg = index.pack(a)
+    avg += index.pack(b)
+    avg /= 2
+
+    merged = index.unpack(avg)
+    for name in a:
+        if a[name].is_floating_point():
+            assert torch.allclose(merged[name], (a[name] + b[name]) / 2, atol=1e-6), name
+        else:
+            assert merged[name].dtype == a[name].dtype
+            assert torch.equal(merged[name], ((a[name] + b[name]) / 2).round().long()), name
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+
+from serverlessdl import clients, loader
+from serverlessdl.loader import train_loader
+
+from conftest import SubsetDataset
+
+
+class ClientDataset(SubsetDataset):
+    """Labels each sample with whether the process reading it has a redis client"""
+
+    def __getitem__(self, index: int):
+        return torch.from_numpy(self.data[index]), int(clients._redis is not None)
+
+
+@pytest.fixture(autouse=True)
+def pool():
+    yield
+    loader._pool = None
+
+
+def _interval(start: int, samples: int = 64):
+    data = np.arange(start, start + samples, dtype=np.float32)[:, None].repeat(4, axis=1)
+    return data, np.zeros(samples, dtype=np.int64)
+
+
+def _rows(dl) -> list:
+    return sorted(int(x[0]) for batch, _ in dl for x in batch)
+
+
+def test_pool_is_reused_across_invocations():
+    first = train_loader(SubsetDataset(), *_interval(0), batch_size=16, num_workers=2, capacity=128)
+    assert _rows(first) == list(range(64))
+    pool = loader._pool
+
+    # the dataset of the next invocation reuses the workers, which read its rows
+    dataset = SubsetDataset()
+    second = train_loader(dataset, *_interval(1000, 48), batch_size=16, num_workers=2)
+    assert second is first and loader._pool is pool
+    assert _rows(second) == list(range(1000, 1048))
+    assert len(dataset) == 48
+
+    # a dataset configured differently starts new workers
+    train_loader(SubsetDataset(features=8), *_interval(0), batch_size=16, num_workers=2)
+    assert loader._pool is not pool
+
+
+def test_workers_drop_the_clients(monkeypatch):
+    monkeypatch.setattr(clients, '_redis', object())
+    dl = train_loader(ClientDataset(), *_interval(0), batch_size=16, num_workers=2)
+    assert all(not labels.any() for _, labels in dl)
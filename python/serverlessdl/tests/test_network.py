@@ -0,0 +1,214 @@
+import time
+from typing import List
+
+import flask
+import pytest
+import torch
+import torch.nn as nn
+
+from serverlessdl import network
+from serverlessdl.cache import model_cache, version_key
+from serverlessdl.delta import DeltaConfig
+from serverlessdl.exceptions import KubeMLException
+from serverlessdl.flat import LAYOUT_FLAT, LAYOUT_LAYERS
+from serverlessdl.network import KubeModel
+
+from conftest import SubsetDataset
+
+
+class Model(KubeModel):
+
+    def configure_optimizers(self) -> torch.optim.Optimizer:
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+    def train(self, batch, batch_index: int) -> float:
+        x, y = batch
+        self.optimizer.zero_grad()
+        loss = ((self(x).sum(1) - y.float()) ** 2).mean()
+        loss.backward()
+        self.optimizer.step()
+        return loss.item()
+
+    def validate(self, batch, batch_index: int):
+        return 0.0, 0.0
+
+
+_app = flask.Flask(__name__)
+
+
+def run(model: KubeModel, task: str, job_id: str = 'job', N: int = 1, K: int = 2, func_id: int = 0,
+        batch_size: int = 32, epoch: int = 1):
+    """Invokes the function with the given arguments and returns the body of the response"""
+    url = f'/?jobId={job_id}&N={N}&K={K}&task={task}&funcId={func_id}&lr=0.1&batchSize={batch_size}&epoch={epoch}'
+    with _app.test_request_context(url):
+        resp, code = model.start()
+    assert code == 200
+    return resp.json
+
+
+class _Response:
+    ok = True
+
+
+@pytest.fixture
+def merges(monkeypatch, redis_client) -> List[str]:
+    """
+    Replaces the train job by one that merges the model as soon as a function
+    notifies the end of an iteration. Like Model.Save in the parameter server,
+    each merge increases the version of the reference model once
+    """
+    urls = []
+
+    def post(url):
+        urls.append(url)
+        job_id = url.split('job-')[1].split('.kubeml')[0]
+        redis_client.incr(version_key(job_id))
+        return _Response()
+
+    monkeypatch.setattr(network.requests, 'post', post)
+    return urls
+
+
+@pytest.fixture
+def model(redis_client, dataset) -> Model:
+    model_cache.clear()
+    m = Model(nn.Linear(4, 1), dataset)
+    m._redis_client = redis_client
+    return m
+
+
+def count_fetches(model: KubeModel) -> List[int]:
+    """Records the fetches of the reference model from the storage"""
+    fetches = []
+    fetch = model._KubeModel__get_model_dict
+
+    def counted():
+        fetches.append(1)
+        return fetch()
+
+    model._KubeModel__get_model_dict = counted
+    return fetches
+
+
+def test_init_increments_version_once(model, redis_client):
+    run(model, 'init')
+    assert redis_client.get(version_key('job')) == b'1'
+
+
+def test_model_cache_follows_merges(model, redis_client, merges):
+    run(model, 'init')
+    fetches = count_fetches(model)
+
+    # a single function publishes the model the parameter server merges, so after
+    # the first load every iteration takes the published model from the cache
+    run(model, 'train')
+    intervals = len(merges) + 1
+    assert intervals > 1
+    assert len(fetches) == 1
+    assert redis_client.get(version_key('job')) == str(1 + len(merges)).encode()
+    assert model_cache.version == 1 + intervals
+
+    # the parameter server merges the last iteration after the function returns
+    redis_client.incr(version_key('job'))
+    run(model, 'train', epoch=2)
+    assert len(fetches) == 1
+
+    # another writer bumps the version after the merge, so the model is fetched again
+    redis_client.incr(version_key('job'))
+    redis_client.incr(version_key('job'))
+    run(model, 'train', epoch=3)
+    assert len(fetches) == 2
+
+
+class RecordingModel(Model):
+    """Records the subset and position of the samples it trains on"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.samples = []
+
+    def train(self, batch, batch_index: int) -> float:
+        x, _ = batch
+        self.samples.extend((int(s), int(p)) for s, p in x[:, :2].tolist())
+        return super().train(batch, batch_index)
+
+
+def test_steal(redis_client, merges):
+    N, batch_size = 2, 16
+    functions = []
+    for func_id in range(N):
+        dataset = SubsetDataset()
+        m = RecordingModel(nn.Linear(4, 1), dataset, steal=True, steal_batches=1)
+        m._redis_client = redis_client
+        functions.append(m)
+    run(functions[0], 'init', N=N)
+
+    # the second function runs before the first one starts, so it trains its
+    # samples and steals all the chunks planned for the first one
+    run(functions[1], 'train', N=N, K=8, func_id=1, batch_size=batch_size)
+    run(functions[0], 'train', N=N, K=8, func_id=0, batch_size=batch_size)
+
+    # every sample is trained exactly once, all of them by the second function
+    samples = functions[0].samples + functions[1].samples
+    assert sorted(samples) == [(s, p) for s in range(10) for p in range(64)]
+    assert not functions[0].samples
+
+    # the chunks hold a quarter of a subset, and the stolen subsets are read once
+    # for all their chunks instead of once per chunk
+    first = set(s for subsets in functions[0]._dataset.fetched for s in subsets)
+    stolen = [subsets for subsets in functions[1]._dataset.fetched if first.issuperset(subsets)]
+    assert sorted(s for subsets in stolen for s in subsets) == sorted(first)
+
+
+class SlowDataset(SubsetDataset):
+    """Records the fetches that finished, which take a while"""
+
+    def __init__(self):
+        super().__init__()
+        self.finished = []
+
+    def _fetch_train_subsets(self, subsets, out=None):
+        arrays = super()._fetch_train_subsets(subsets, out)
+        time.sleep(0.2)
+        self.finished.append(list(subsets))
+        return arrays
+
+
+class FailingModel(Model):
+
+    def train(self, batch, batch_index: int) -> float:
+        raise RuntimeError('train failed')
+
+
+def test_failed_train_waits_for_prefetch(redis_client, merges):
+    dataset = SlowDataset()
+    m = FailingModel(nn.Linear(4, 1), dataset)
+    m._redis_client = redis_client
+    run(m, 'init')
+
+    # the data of the second interval is being prefetched when the training fails
+    with pytest.raises(RuntimeError):
+        run(m, 'train')
+    assert len(dataset.fetched) == 2
+    assert dataset.finished == dataset.fetched
+
+
+def test_model_cache_job_switch(model, redis_client, merges):
+    run(model, 'init', job_id='a')
+    run(model, 'train', job_id='a')
+    run(model, 'init', job_id='b')
+    fetches = count_fetches(model)
+
+    # both jobs are at the same version, but the cached model is the one of the first job
+    redis_client.set(version_key('b'), str(model_cache.version))
+    run(model, 'train', job_id='b')
+    assert len(fetches) == 1
+    assert model_cache.job_id == 'b'
+
+
+def test_delta_requires_layers_layout():
+    with pytest.raises(KubeMLException) as e:
+        Model(nn.Linear(4, 1), None, layout=LAYOUT_FLAT, delta=DeltaConfig())
+    assert e.value.status_code == 400
+
+    Model(nn.Linear(4, 1), None, layout=LAYOUT_LAYERS, delta=DeltaConfig())
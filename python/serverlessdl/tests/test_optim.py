@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from serverlessdl.optim import decode_optimizer_state, encode_optimizer_state
+
+
+def trained_optimizer(make) -> torch.optim.Optimizer:
+    torch.manual_seed(0)
+    net = torch.nn.Linear(3, 2)
+    optimizer = make(net.parameters())
+    net(torch.randn(4, 3)).sum().backward()
+    optimizer.step()
+    return optimizer
+
+
+@pytest.mark.parametrize('make', [
+    lambda params: torch.optim.SGD(params, lr=0.1, momentum=0.9),
+    lambda params: torch.optim.Adam(params, lr=1e-3),
+    lambda params: torch.optim.Adam(params, lr=torch.tensor(1e-3)),
+])
+def test_round_trip(make):
+    state = trained_optimizer(make).state_dict()
+    decoded = decode_optimizer_state(encode_optimizer_state(state))
+
+    assert decoded['state'].keys() == state['state'].keys()
+    for param_id, entries in state['state'].items():
+        for key, value in entries.items():
+            assert torch.equal(torch.as_tensor(decoded['state'][param_id][key]), torch.as_tensor(value))
+
+    for group, decoded_group in zip(state['param_groups'], decoded['param_groups']):
+        assert type(decoded_group['lr']) is type(group['lr'])
+        assert torch.equal(torch.as_tensor(decoded_group['lr']), torch.as_tensor(group['lr']))
+
+    # the decoded state can be loaded by a new optimizer
+    make(torch.nn.Linear(3, 2).parameters()).load_state_dict(decoded)
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        decode_optimizer_state(b'XXXX' + bytes(16))
@@ -0,0 +1,68 @@
+import math
+from collections import Counter
+
+import pytest
+
+from serverlessdl.util import plan_partitions, shuffle_subsets, split_minibatches, PARTITION_DROP, \
+    PARTITION_NONE, PARTITION_PAD
+
+
+def _samples(intervals):
+    return [s for interval in intervals for r in interval.samples for s in r]
+
+
+@pytest.mark.parametrize('K', [-1, 1, 3])
+def test_none_trains_every_subset(K):
+    num_samples, n, batch_size, subset_size = 1000, 3, 32, 64
+    plan = plan_partitions(num_samples, n, K, batch_size, subset_size)
+    assert plan.mode == PARTITION_NONE
+
+    # the subsets are split in contiguous ranges and the intervals hold the subsets of K batches
+    period = math.ceil(K * batch_size / subset_size)
+    for f, subsets in enumerate(split_minibatches(range(16), n)):
+        expected = [subsets] if K == -1 else [subsets[i:i + period] for i in range(0, len(subsets), period)]
+        assert [i.subsets for i in plan[f]] == [list(s) for s in expected]
+
+    assert sorted(s for f in range(n) for s in _samples(plan[f])) == list(range(num_samples))
+
+
+def test_single_subset():
+    plan = plan_partitions(40, 2, 1, 8, 64)
+    assert _samples(plan[0]) == list(range(40))
+    assert plan[1] == []
+
+
+@pytest.mark.parametrize('mode', [PARTITION_PAD, PARTITION_DROP])
+def test_shuffled_samples_are_split_evenly(mode):
+    num_samples, n, batch_size, subset_size = 1000, 3, 16, 64
+    assignment = shuffle_subsets(16, n, epoch=2, seed=7, block_size=4, locality=0.5)
+    plan = plan_partitions(num_samples, n, 2, batch_size, subset_size, assignment, mode)
+
+    target = 334 if mode == PARTITION_PAD else 333
+    counts = Counter()
+    for f in range(n):
+        samples = _samples(plan[f])
+        assert len(samples) == target
+        assert plan.steps(f) == plan.steps(0)
+        counts.update(samples)
+
+    # every sample is trained, at most one repeated or dropped per function
+    assert set(counts) >= set(range(num_samples)) if mode == PARTITION_PAD else len(counts) == 999
+    assert sum(counts.values()) - num_samples == (2 if mode == PARTITION_PAD else -1)
+
+
+def test_drop_with_more_functions_than_samples(caplog):
+    # dropping would leave every function without samples
+    plan = plan_partitions(3, 5, 1, 2, 64, mode=PARTITION_DROP)
+    assert plan.mode == PARTITION_PAD
+    assert 'padding' in caplog.text
+    assert [_samples(plan[f]) for f in range(5)] == [[0], [1], [2], [0], [0]]
+    assert all(plan.steps(f) == [1] for f in range(5))
+
+
+def test_interval_rows():
+    plan = plan_partitions(1000, 2, 1, 100, 64, [[15, 3], [0]], PARTITION_PAD)
+    interval = plan[0][0]
+    assert interval.subsets == [3, 15]
+    # half of the 168 samples, the 40 of subset 15, placed after the 64 of subset 3, and 44 of subset 3
+    assert interval.rows().tolist() == list(range(64, 104)) + list(range(44))
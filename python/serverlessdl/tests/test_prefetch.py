@@ -0,0 +1,82 @@
+import threading
+
+import numpy as np
+
+from serverlessdl.prefetch import IntervalPrefetcher
+
+
+class Dataset:
+    """
+    Decodes the subsets into the given arrays like assemble_subsets and records the arrays
+    used. The fetch of the blocked subsets waits until they are released
+    """
+
+    def __init__(self, subset_size: int = 4, blocked=()):
+        self.subset_size = subset_size
+        self.blocked = list(blocked)
+        self.outputs = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _estimate_bytes(self, num_subsets: int):
+        return None
+
+    def _fetch_train_subsets(self, subsets, out=None):
+        if list(subsets) == self.blocked:
+            self.started.set()
+            self.release.wait()
+
+        n = len(subsets) * self.subset_size
+        if out is None or len(out[0]) < n:
+            out = np.empty((n, 2), dtype=np.float32), np.empty(n, dtype=np.int64)
+        self.outputs.append(out)
+        data, labels = out[0][:n], out[1][:n]
+        data[:] = np.repeat(subsets, self.subset_size)[:, None]
+        labels[:] = np.repeat(subsets, self.subset_size)
+        return data, labels
+
+
+def _same(a, b) -> bool:
+    return np.shares_memory(a[0], b[0]) and np.shares_memory(a[1], b[1])
+
+
+def test_double_buffer_swap():
+    dataset = Dataset()
+    prefetcher = IntervalPrefetcher(dataset, [[0, 1], [2, 3], [4, 5], [6]], max_bytes=1 << 20)
+
+    loaded = [prefetcher.load(i) for i in range(4)]
+    assert [labels.tolist() for _, labels in loaded[2:]] == [[4] * 4 + [5] * 4, [6] * 4]
+
+    # the first two intervals get new arrays, the following ones are decoded into
+    # the arrays of the interval before the previous one, no longer in use
+    first, second, third, fourth = dataset.outputs
+    assert not _same(first, second)
+    assert _same(third, first) and _same(fourth, second)
+
+
+def test_load_without_budget():
+    dataset = Dataset()
+    prefetcher = IntervalPrefetcher(dataset, [[0], [1], [2]], max_bytes=0)
+    for i in range(3):
+        assert prefetcher.load(i)[1].tolist() == [i] * 4
+
+    # nothing is prefetched, each interval is loaded into the arrays of the previous one
+    assert all(_same(out, dataset.outputs[0]) for out in dataset.outputs)
+
+
+def test_close_waits_for_the_running_prefetch():
+    dataset = Dataset(blocked=[1])
+    prefetcher = IntervalPrefetcher(dataset, [[0], [1]], max_bytes=1 << 20)
+    prefetcher.load(0)
+    assert dataset.started.wait(5)
+
+    # the prefetch already started, so closing waits until it no longer uses the arrays
+    closer = threading.Thread(target=prefetcher.close)
+    closer.start()
+    closer.join(0.1)
+    assert closer.is_alive()
+
+    dataset.release.set()
+    closer.join(5)
+    assert not closer.is_alive()
+    assert len(dataset.outputs) == 2
@@ -0,0 +1,37 @@
+import threading
+
+from serverlessdl.steal import WorkQueue, claims_key
+
+
+def test_claims_are_unique(redis_client):
+    chunks, owners = 200, [0, 1]
+    claimed = {owner: [] for owner in owners}
+    start = threading.Barrier(4)
+
+    def claim(func_id: int):
+        # every function claims from both owners, its own first
+        queue = WorkQueue(redis_client, 'job', 1, 0)
+        start.wait()
+        for owner in [func_id % 2, (func_id + 1) % 2]:
+            while True:
+                chunk = queue.claim(owner)
+                if chunk >= chunks:
+                    break
+                claimed[owner].append(chunk)
+
+    threads = [threading.Thread(target=claim, args=(f,)) for f in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # every chunk is claimed exactly once
+    for owner in owners:
+        assert sorted(claimed[owner]) == list(range(chunks))
+
+
+def test_queues_are_per_interval(redis_client):
+    first, second = WorkQueue(redis_client, 'job', 1, 0), WorkQueue(redis_client, 'job', 1, 1)
+    assert [first.claim(0) for _ in range(3)] == [0, 1, 2]
+    assert second.claim(0) == 0
+    assert redis_client.get(claims_key('job', 1, 0, 0)) == b'3'
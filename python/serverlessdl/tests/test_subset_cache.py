@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+
+from serverlessdl.subset_cache import SubsetCache
+
+
+def _subset(samples: int, seed: int = 0):
+    rng = np.random.RandomState(seed)
+    return rng.rand(samples, 8).astype(np.float32), np.arange(samples)
+
+
+def test_put_get(tmp_path):
+    cache = SubsetCache(str(tmp_path), max_bytes=1 << 20)
+    data, labels = _subset(16)
+    assert cache.get('ds', 'v1', 'train', 0) is None
+
+    cache.put('ds', 'v1', 'train', 0, data, labels)
+    cached = cache.get('ds', 'v1', 'train', 0, samples=16)
+    assert np.array_equal(cached[0], data) and np.array_equal(cached[1], labels)
+    assert cache.get('ds', 'v2', 'train', 0) is None
+
+
+def test_mismatched_subset_is_removed(tmp_path):
+    cache = SubsetCache(str(tmp_path), max_bytes=1 << 20)
+    data, labels = _subset(16)
+    cache.put('ds', 'v1', 'train', 0, data, labels[:10])
+
+    assert cache.get('ds', 'v1', 'train', 0) is None
+    assert not any(files for _, _, files in os.walk(str(tmp_path)))
+
+
+def test_evicts_least_recently_used_pairs(tmp_path):
+    data, labels = _subset(64)
+    subset_bytes = data.nbytes + labels.nbytes + 256
+    cache = SubsetCache(str(tmp_path), max_bytes=3 * subset_bytes, scan_seconds=3600)
+
+    for i in range(3):
+        cache.put('ds', 'v1', 'train', i, data, labels)
+        data_path, labels_path = cache._paths('ds', 'v1', 'train', i)
+        os.utime(data_path, (i, i))
+        os.utime(labels_path, (i, i))
+    cache.evict()
+
+    # subset 0 is read so subset 1 is the least recently used
+    assert cache.get('ds', 'v1', 'train', 0) is not None
+    cache.put('ds', 'v1', 'train', 3, data, labels)
+    cache.evict()
+
+    cached = [i for i in range(4) if cache.get('ds', 'v1', 'train', i) is not None]
+    assert cached == [0, 2, 3]
+    assert not any(os.path.exists(p) for p in cache._paths('ds', 'v1', 'train', 1))
+
+
+def test_evict_skips_scan_under_size(tmp_path, monkeypatch):
+    cache = SubsetCache(str(tmp_path), max_bytes=1 << 20, scan_seconds=3600)
+    cache.evict()
+
+    scans = []
+    monkeypatch.setattr(cache, '_scan', lambda: scans.append(1) or ({}, 0))
+    data, labels = _subset(16)
+    cache.put('ds', 'v1', 'train', 0, data, labels)
+    cache.evict()
+    assert not scans
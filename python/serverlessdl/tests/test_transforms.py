@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
+
+from serverlessdl import transforms as T
+
+MEAN, STD = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+
+def _images(n: int = 6, size: int = 8) -> np.ndarray:
+    return np.random.RandomState(0).randint(0, 256, (n, size, size, 3), dtype=np.uint8)
+
+
+def _per_sample(transform, images) -> torch.Tensor:
+    return torch.stack([transform(img) for img in images])
+
+
+def test_to_tensor():
+    images = _images()
+    expected = _per_sample(transforms.ToTensor(), images)
+    assert torch.allclose(T.to_tensor(torch.from_numpy(images)), expected)
+
+
+def test_normalize():
+    x = T.to_tensor(torch.from_numpy(_images()))
+    expected = _per_sample(transforms.Normalize(MEAN, STD), x)
+    assert torch.allclose(T.normalize(x, MEAN, STD), expected, atol=1e-6)
+
+
+def test_random_crop():
+    torch.manual_seed(0)
+    x = T.to_tensor(torch.from_numpy(_images(n=32)))
+    size, padding = 6, 2
+    crops = T.random_crop(x, size, padding)
+    assert crops.shape == (32, 3, size, size)
+
+    # every crop is one of the crops RandomCrop can take from the padded image
+    positions = set()
+    for img, crop in zip(x, crops):
+        padded = TF.pad(img, padding)
+        matches = [(top, left) for top in range(padded.shape[1] - size + 1)
+                   for left in range(padded.shape[2] - size + 1)
+                   if torch.equal(TF.crop(padded, top, left, size, size), crop)]
+        assert matches
+        positions.update(matches)
+    assert len(positions) > 1
+
+    assert torch.equal(T.random_crop(x, 8), x)
+
+
+def test_random_horizontal_flip():
+    torch.manual_seed(0)
+    x = T.to_tensor(torch.from_numpy(_images(n=32)))
+    flipped = _per_sample(TF.hflip, x)
+    assert torch.equal(T.random_horizontal_flip(x, p=1), flipped)
+    assert torch.equal(T.random_horizontal_flip(x, p=0), x)
+
+    out = T.random_horizontal_flip(x)
+    is_flipped = [torch.equal(o, f) for o, f in zip(out, flipped)]
+    assert all(f or torch.equal(o, img) for o, img, f in zip(out, x, is_flipped))
+    assert 0 < sum(is_flipped) < len(x)
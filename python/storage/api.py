@@ -1,11 +1,14 @@
+import json
 import logging
 import os
 import pickle
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pymongo
 from flask import Flask, request, jsonify
+from pymongo.errors import DuplicateKeyError
 from utils import *
 
 app = Flask(__name__)
@@ -26,6 +29,20 @@ else:
 
 app.config['UPLOAD_FOLDER'] = 'uploads'
 
+# files that make up a dataset, uploaded at once or in chunks
+UPLOAD_FILES = ['x-train', 'y-train', 'x-test', 'y-test']
+EXTENSIONS = ['npy', 'pkl']
+
+# size of the blocks in which the chunks of the uploads are written to disk
+CHUNK_BLOCK_BYTES = 1024 * 1024
+
+# pickled files are loaded whole in memory to be processed, unlike npy files,
+# so bigger ones are rejected and must be uploaded as npy
+MAX_PKL_BYTES = int(os.environ.get('MAX_PKL_BYTES', 1024 * 1024 * 1024))
+
+# number of uploads processed at the same time by each worker of the service
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 2))
+
 # set some basic logging params
 FORMAT = '[%(asctime)s] %(levelname)-8s %(message)s'
 logging.basicConfig(level=logging.DEBUG, format=FORMAT)
@@ -33,6 +50,10 @@ logging.basicConfig(level=logging.DEBUG, format=FORMAT)
 # mongo connection
 client = pymongo.MongoClient(app.config['MONGO_ADDRESS'], app.config['MONGO_PORT'])
 
+# uploads are saved to the database in the background, the requests
+# return the id of the upload, used to query its progress
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+
 
 @app.route('/health')
 def health():
@@ -53,8 +74,20 @@ def handle_dataset(name: str):
 
 # Handles the upload of a dataset
 # Sees if the file has an npy or pkl extension
-# and according to that it divides the dataset in batches
-# of constant size and saves them to the mongo database
+# and according to that it divides the dataset in batches.
+# npy files are read from disk as they are saved, while pkl files
+# are unpickled in memory and rejected if bigger than MAX_PKL_BYTES
+# of constant size and saves them to the mongo database.
+# The number of samples per batch is set with the optional subset_size
+# query parameter, and the batches can be compressed with the optional
+# compression query parameter (raw, lz4 or zstd).
+# The samples can also be preprocessed once at upload, saving them channels first
+# (layout=chw), as floats (dtype=float16 or float32) and normalized (mean and std
+# of each channel as comma separated lists). float16 samples are cast back to float32
+# by the functions when building the minibatches.
+# The train and test sets must have at least one sample and a label for each one.
+# The dataset is saved in the background, its progress is returned by
+# GET /dataset/<name>/status
 def upload_dataset(dataset_name: str):
 
     # TODO move this below so we check before if dataset exists
@@ -62,10 +95,17 @@ def upload_dataset(dataset_name: str):
         logging.error('Request does not include a file')
         return jsonify(error='Request does not include a file'), 400
 
+    try:
+        codec, subset_size, transform = _parse_upload_options()
+    except ValueError as e:
+        logging.error(str(e))
+        return jsonify(error=str(e)), 400
+
     logging.debug(f'handling dataset creation for dataset {dataset_name}')
 
     # save the file in the server and then split it and save
     # it in the database
+    _fail_stale_uploads()
     db_names = set(client.list_database_names())
     logging.debug(f'Db names {db_names}')
     if dataset_name in db_names:
@@ -75,6 +115,11 @@ def upload_dataset(dataset_name: str):
     file_names = list(request.files.keys())
     logging.debug(f'Files {file_names}')
 
+    extension = request.files['x-train'].filename.split('.')[-1]
+    logging.debug(f'Extension is {extension}')
+    if extension not in EXTENSIONS:
+        return jsonify(error=f'File extension not supported, must be one of {EXTENSIONS}'), 400
+
     # create the unique identifier for the upload task
     # this prevents multiple concurrent uploads from overwriting each other
     upload_id = str(uuid.uuid4())[:8]
@@ -89,8 +134,6 @@ def upload_dataset(dataset_name: str):
         # Load the features and the labels
         x = request.files[f'x-{datatype}']
         y = request.files[f'y-{datatype}']
-        extension = x.filename.split('.')[-1]
-        logging.debug(f'Extension is {extension}')
 
         # save the files to disk
         # save the data as x-train.ext, y-train.ext and so on
@@ -99,23 +142,269 @@ def upload_dataset(dataset_name: str):
         logging.debug(f'Saved the {datatype} datasets to internal storage')
 
     # Process the datasets
-    return _process_datasets(dataset_name, extension, upload_id)
+    return _start_upload(dataset_name, upload_id, extension, codec, subset_size, transform)
+
+
+def _parse_upload_options():
+    """Parses the options of an upload from the query parameters, returns the codec,
+    the subset size and the preprocessing or raises ValueError if they are not valid"""
+    codec = request.args.get('compression', CODEC_RAW)
+    if codec not in available_codecs():
+        raise ValueError(f'Compression not supported, must be one of {available_codecs()}')
+
+    subset_size = request.args.get('subset_size', DEFAULT_SUBSET_SIZE, type=int)
+    if subset_size <= 0:
+        raise ValueError('Subset size must be a positive integer')
+
+    try:
+        transform = parse_transform(request.args)
+    except ValueError as e:
+        raise ValueError(f'Invalid preprocessing options: {e}')
+
+    return codec, subset_size, transform
+
+
+# Chunked uploads allow sending big datasets in parts and resuming
+# them after a failure. The upload is created with the same options as a
+# normal upload, then each of the files is sent in chunks written at their offset,
+# and once all of them are received the dataset is processed as usual:
+#
+# POST /dataset/<name>/upload                        -> creates the upload, returns its id
+# PUT  /dataset/<name>/upload/<id>/<file>?offset=N   -> writes a chunk of x-train.npy, y-train.npy...
+# GET  /dataset/<name>/upload/<id>                   -> bytes received of each file, to resume
+# POST /dataset/<name>/upload/<id>/complete          -> processes the dataset
+# DELETE /dataset/<name>/upload/<id>                 -> aborts the upload
+#
+# The state of the upload is kept in the upload folder so any of the
+# workers of the service can handle its requests
+def _upload_path(name: str) -> str:
+    return os.path.join(app.config['UPLOAD_FOLDER'], name)
+
+
+def _load_upload(dataset_name: str, upload_id: str):
+    """Returns the options of a chunked upload, None if it doesn't exist"""
+    try:
+        with open(_upload_path(f'{upload_id}.json')) as f:
+            upload = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return upload if upload['dataset'] == dataset_name else None
+
+
+def _uploaded_files(upload_id: str):
+    """Returns the bytes received of each file of a chunked upload"""
+    received = {}
+    for name in UPLOAD_FILES:
+        for extension in EXTENSIONS:
+            path = _upload_path(f'{name}-{upload_id}.{extension}')
+            if os.path.exists(path):
+                received[f'{name}.{extension}'] = os.path.getsize(path)
+    return received
+
+
+@app.route('/dataset/<string:name>/upload', methods=['POST'])
+def create_upload(name: str):
+    try:
+        codec, subset_size, transform = _parse_upload_options()
+    except ValueError as e:
+        logging.error(str(e))
+        return jsonify(error=str(e)), 400
+
+    _fail_stale_uploads()
+    if name in set(client.list_database_names()):
+        logging.error(f"Dataset {name} already exists")
+        return jsonify(error=f'Dataset {name} already exists'), 400
+
+    upload_id = str(uuid.uuid4())[:8]
+    with open(_upload_path(f'{upload_id}.json'), 'w') as f:
+        json.dump({'dataset': name, 'codec': codec, 'subset_size': subset_size, 'transform': transform}, f)
+
+    logging.debug(f'Created chunked upload {upload_id} for dataset {name}')
+    return jsonify(upload_id=upload_id), 200
+
+
+@app.route('/dataset/<string:name>/upload/<string:upload_id>', methods=['GET', 'DELETE'])
+def handle_upload(name: str, upload_id: str):
+    if _load_upload(name, upload_id) is None:
+        return jsonify(error='Upload does not exist'), 404
+
+    if request.method == 'GET':
+        return jsonify(upload_id=upload_id, files=_uploaded_files(upload_id)), 200
+
+    logging.debug(f'Aborting upload {upload_id}')
+    _remove_upload_files(upload_id)
+    os.remove(_upload_path(f'{upload_id}.json'))
+    return jsonify(result='Upload deleted'), 200
+
+
+def _remove_upload_files(upload_id: str):
+    for file_name in _uploaded_files(upload_id):
+        name, extension = file_name.rsplit('.', 1)
+        os.remove(_upload_path(f'{name}-{upload_id}.{extension}'))
+
+
+@app.route('/dataset/<string:name>/upload/<string:upload_id>/<string:file_name>', methods=['PUT'])
+def upload_chunk(name: str, upload_id: str, file_name: str):
+    if _load_upload(name, upload_id) is None:
+        return jsonify(error='Upload does not exist'), 404
+
+    base, _, extension = file_name.partition('.')
+    if base not in UPLOAD_FILES or extension not in EXTENSIONS:
+        return jsonify(error=f'File must be one of {UPLOAD_FILES} with extension in {EXTENSIONS}'), 400
+
+    # chunks can be sent again, but not past the end of the bytes received,
+    # in that case the client must resume from the size returned
+    path = _upload_path(f'{base}-{upload_id}.{extension}')
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    offset = request.args.get('offset', size, type=int)
+    if offset < 0 or offset > size:
+        return jsonify(error='Offset must be between 0 and the bytes received', size=size), 409
+
+    # write the body in blocks as it is received
+    # instead of reading the whole chunk in memory
+    with open(path, 'r+b' if size else 'wb') as f:
+        f.seek(offset)
+        while True:
+            block = request.stream.read(CHUNK_BLOCK_BYTES)
+            if not block:
+                break
+            f.write(block)
+        size = max(size, f.tell())
+
+    return jsonify(file=file_name, size=size), 200
+
+
+@app.route('/dataset/<string:name>/upload/<string:upload_id>/complete', methods=['POST'])
+def complete_upload(name: str, upload_id: str):
+    upload = _load_upload(name, upload_id)
+    if upload is None:
+        return jsonify(error='Upload does not exist'), 404
+
+    received = _uploaded_files(upload_id)
+    extensions = {file_name.rsplit('.', 1)[1] for file_name in received}
+    if len(received) != len(UPLOAD_FILES) or len(extensions) != 1:
+        return jsonify(error=f'Upload must include the files {UPLOAD_FILES} with the same extension',
+                       files=received), 400
+
+    _fail_stale_uploads()
+    if name in set(client.list_database_names()):
+        logging.error(f"Dataset {name} already exists")
+        return jsonify(error=f'Dataset {name} already exists'), 400
+
+    resp = _start_upload(name, upload_id, extensions.pop(),
+                         upload['codec'], upload['subset_size'], upload['transform'])
+    os.remove(_upload_path(f'{upload_id}.json'))
+    return resp
+
+
+# Uploads are processed by a pool of threads. The dataset is reserved before
+# submitting the job, with its metadata marked as not ready until all the subsets
+# are saved, so concurrent uploads of the same dataset are rejected and the
+# functions don't train on it. The progress of the job is saved in the database
+# under the upload id, and a failed upload leaves no dataset behind. The jobs
+# interrupted by a restart stop being refreshed and are failed the next time
+# the service starts or receives an upload, dropping their datasets
+def _start_upload(dataset_name: str, upload_id: str, extension: str, codec: str, subset_size: int, transform):
+    error = _check_upload_files(upload_id, extension)
+    if error is not None:
+        logging.error(f'Invalid upload {upload_id} of dataset {dataset_name}: {error}')
+        _remove_upload_files(upload_id)
+        return jsonify(error=error), 400
+
+    try:
+        reserve_dataset(client[dataset_name], upload_id)
+    except DuplicateKeyError:
+        logging.error(f"Dataset {dataset_name} already exists")
+        _remove_upload_files(upload_id)
+        return jsonify(error=f'Dataset {dataset_name} already exists'), 400
+
+    job = UploadJob(client, upload_id, dataset_name)
+    job.create()
+    upload_executor.submit(_run_upload, job, extension, codec, subset_size, transform)
+
+    logging.debug(f'Started upload {upload_id} of dataset {dataset_name}')
+    return jsonify(result=f'Dataset upload started with id {upload_id}', upload_id=upload_id), 200
 
 
-def _process_datasets(dataset_name: str, extension: str, upload_id: str):
-    if extension not in ['npy', 'pkl']:
-        return jsonify(error='File extension not supported, must be one of [npy, pkl]'), 400
+def _check_upload_files(upload_id: str, extension: str):
+    """Checks that the train and test sets of an upload are not empty and have a label
+    per sample, returns the error or None if they are valid. Only the headers of the npy
+    files are read, pickled files are checked by collection_metadata when processed and
+    here only their size is checked, since they are fully loaded in memory"""
+    if extension == 'pkl':
+        for name in UPLOAD_FILES:
+            size = os.path.getsize(_upload_path(f'{name}-{upload_id}.pkl'))
+            if size > MAX_PKL_BYTES:
+                return f'File {name}.pkl has {size} bytes, pkl files are limited to {MAX_PKL_BYTES} bytes, ' \
+                       f'upload the dataset as npy files instead'
+        return None
 
+    for datatype in ['train', 'test']:
+        try:
+            x = np.load(_upload_path(f'x-{datatype}-{upload_id}.npy'), mmap_mode='r')
+            y = np.load(_upload_path(f'y-{datatype}-{upload_id}.npy'), mmap_mode='r')
+        except (OSError, ValueError) as e:
+            return f'Could not read the {datatype} files: {e}'
+
+        if x.ndim == 0 or y.ndim == 0 or len(x) == 0:
+            return f'The {datatype} set must have at least one sample'
+        if len(x) != len(y):
+            return f'The {datatype} set has {len(x)} samples but {len(y)} labels'
+
+    return None
+
+
+def _run_upload(job: UploadJob, extension: str, codec: str, subset_size: int, transform):
+    try:
+        job.start()
+        stats = _process_datasets(job, extension, codec, subset_size, transform)
+        job.finish()
+        logging.debug(f'Finished upload {job.upload_id} of dataset {job.dataset}, {stats}')
+    except Exception as e:
+        logging.exception(f'Upload {job.upload_id} of dataset {job.dataset} failed')
+        client.drop_database(job.dataset)
+        job.fail(e)
+    finally:
+        _remove_upload_files(job.upload_id)
+
+
+def _fail_stale_uploads():
+    """Fails the uploads interrupted by a restart, so their datasets can be uploaded again"""
+    for upload_id in fail_stale_uploads(client):
+        _remove_upload_files(upload_id)
+
+
+@app.route('/dataset/<string:name>/status', methods=['GET'])
+def upload_status(name: str):
+    """Returns the progress of the given upload_id, or of the last upload of the dataset"""
+    _fail_stale_uploads()
+    query = {'dataset': name}
+    if 'upload_id' in request.args:
+        query['_id'] = request.args['upload_id']
+
+    jobs = client[JOBS_DATABASE][JOBS_COLLECTION]
+    job = jobs.find_one(query, sort=[('created', pymongo.DESCENDING)])
+    if job is None:
+        return jsonify(error='Upload does not exist'), 404
+
+    job['upload_id'] = job.pop('_id')
+    return jsonify(job), 200
+
+
+def _process_datasets(job: UploadJob, extension: str, codec: str, subset_size: int, transform):
     data, targets = None, None
+    metadata, stats = {}, {}
 
     for datatype in ['train', 'test']:
 
-        x_path = os.path.join(app.config['UPLOAD_FOLDER'], f'x-{datatype}-{upload_id}.{extension}')
-        y_path = os.path.join(app.config['UPLOAD_FOLDER'], f'y-{datatype}-{upload_id}.{extension}')
+        x_path = os.path.join(app.config['UPLOAD_FOLDER'], f'x-{datatype}-{job.upload_id}.{extension}')
+        y_path = os.path.join(app.config['UPLOAD_FOLDER'], f'y-{datatype}-{job.upload_id}.{extension}')
 
+        # npy files are memory mapped so the subsets are read from
+        # disk as they are saved instead of loading the whole arrays
         if extension == 'npy':
             logging.debug('Loading npy files')
-            data, targets = np.load(x_path), np.load(y_path)
+            data, targets = np.load(x_path, mmap_mode='r'), np.load(y_path, mmap_mode='r')
 
         elif extension == 'pkl':
             logging.debug('Loading pickle files')
@@ -129,17 +418,22 @@ def _process_datasets(dataset_name: str, extension: str, upload_id: str):
         # generate the splits of constant size that will be used in the dataset
         # save the splits to the collection
         logging.debug(f'Saving the collection for {datatype} data')
-        db = client[dataset_name]
+        db = client[job.dataset]
         db.create_collection(datatype)
 
-        splits = dataset_splits(data, targets, 64)
-        save_batches(db[datatype], splits)
+        metadata[datatype] = collection_metadata(data, targets, subset_size, transform)
+        job.add_subsets(metadata[datatype]['subsets'])
+
+        splits = dataset_splits(data, targets, subset_size)
+        stats[datatype] = save_batches(db[datatype], splits, codec, transform, progress=job.progress)
 
         # delete the documents from the server
+        data, targets = None, None
         os.remove(x_path)
         os.remove(y_path)
 
-    return jsonify(result='Dataset created'), 200
+    save_metadata(client[job.dataset], subset_size, codec, transform, metadata, job.upload_id)
+    return stats
 
 
 def delete_dataset(dataset_name: str):
@@ -156,5 +450,12 @@ def delete_dataset(dataset_name: str):
     return jsonify(error='Dataset does not exist'), 404
 
 
+# uploads left unfinished by a previous run of the service, also
+# checked before every upload in case the database is not up yet
+try:
+    _fail_stale_uploads()
+except pymongo.errors.PyMongoError:
+    logging.exception('Could not check the uploads interrupted by a restart')
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,7 +1,71 @@
-import pickle
 import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from pymongo import collection
 
+# Optional compression of the subsets, both are installed in
+# the storage image but the service works without them
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encodings of the arrays saved in each document. The service runs apart from the
+# functions, so they are also defined in serverlessdl.encoding, which decodes them
+# and whose tests check that both modules match
+CODEC_RAW = 'raw'
+CODEC_LZ4 = 'lz4'
+CODEC_ZSTD = 'zstd'
+CODECS = [CODEC_RAW, CODEC_LZ4, CODEC_ZSTD]
+
+# Default number of samples saved in each document
+DEFAULT_SUBSET_SIZE = 64
+
+# Max bytes of the documents sent in a single insert, so the
+# memory used while saving a dataset doesn't depend on its size
+INSERT_BATCH_BYTES = 16 * 1024 * 1024
+
+# Processes encoding the subsets and connections inserting them in parallel
+ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', os.cpu_count() or 1))
+INSERT_CONNECTIONS = int(os.environ.get('INSERT_CONNECTIONS', 4))
+
+# Uploads are processed in the background and their progress
+# is saved in this collection, out of the datasets
+JOBS_DATABASE = 'kubeml'
+JOBS_COLLECTION = 'uploads'
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# The jobs of a worker are refreshed every few seconds while it processes them, a
+# pending or running job not refreshed for a while was interrupted by a restart
+UPLOAD_HEARTBEAT_SECONDS = int(os.environ.get('UPLOAD_HEARTBEAT_SECONDS', 10))
+UPLOAD_STALE_SECONDS = int(os.environ.get('UPLOAD_STALE_SECONDS', 60))
+
+# The metadata of each dataset is saved as a single
+# document in this collection of the dataset database
+METADATA_COLLECTION = 'metadata'
+METADATA_ID = 'dataset'
+
+# Layout of the samples, channels last as uploaded or channels first
+# as expected by the networks, and types the samples can be converted to
+LAYOUT_HWC = 'hwc'
+LAYOUT_CHW = 'chw'
+LAYOUTS = [LAYOUT_HWC, LAYOUT_CHW]
+FLOAT_TYPES = ['float16', 'float32']
+
 
 def dataset_splits(data, labels, batch_size):
     """ Given the data, return constantly sized
@@ -11,15 +75,314 @@ def dataset_splits(data, labels, batch_size):
         yield data[i:i + batch_size], labels[i:i + batch_size]
 
 
-def save_batches(col: collection.Collection, batches):
+def parse_transform(args):
+    """Parses the preprocessing options of an upload, the layout
+    (hwc or chw), the float type (float16 or float32) and the mean and std
+    of each channel as comma separated lists. Returns None if the data
+    is saved as uploaded, raises ValueError if the options are not valid"""
+    layout, dtype = args.get('layout', LAYOUT_HWC), args.get('dtype')
+    mean, std = args.get('mean'), args.get('std')
+
+    if layout not in LAYOUTS:
+        raise ValueError(f'Layout must be one of {LAYOUTS}')
+    if dtype is not None and dtype not in FLOAT_TYPES:
+        raise ValueError(f'Type must be one of {FLOAT_TYPES}')
+    if (mean is None) != (std is None):
+        raise ValueError('Mean and std must be given together')
+
+    if mean is not None:
+        mean = [float(v) for v in mean.split(',')]
+        std = [float(v) for v in std.split(',')]
+        if len(mean) != len(std) or any(s <= 0 for s in std):
+            raise ValueError('Mean and std must have the same length and std must be positive')
+        dtype = dtype or 'float32'
+
+    if layout == LAYOUT_HWC and dtype is None:
+        return None
+    return {'layout': layout, 'dtype': dtype, 'mean': mean, 'std': std}
+
+
+def transform_subset(data, transform):
+    """Applies the preprocessing of the upload to a subset of (N, H, W, C)
+    or (N, H, W) samples. When converted to float, uint8 samples are scaled
+    to [0, 1] like ToTensor does before normalizing them"""
+    if transform is None:
+        return data
+
+    data = np.asarray(data)
+    channels = None
+    if transform['layout'] == LAYOUT_CHW:
+        data = data[:, None] if data.ndim == 3 else np.moveaxis(data, -1, 1)
+        channels = 1
+    elif data.ndim > 3:
+        channels = data.ndim - 1
+
+    if transform['dtype'] is not None:
+        scaled = data.dtype == np.uint8
+        data = data.astype(np.float32)
+        if scaled:
+            data /= 255
+
+        if transform['mean'] is not None:
+            shape = [1] * data.ndim
+            if channels is not None:
+                shape[channels] = -1
+            data -= np.asarray(transform['mean'], dtype=np.float32).reshape(shape)
+            data /= np.asarray(transform['std'], dtype=np.float32).reshape(shape)
+
+        data = data.astype(transform['dtype'])
+
+    return np.ascontiguousarray(data)
+
+
+def collection_metadata(data, labels, subset_size: int, transform=None):
+    """Returns the metadata of the train or test set of
+    a dataset, with the number of samples and subsets and the
+    shape and type of each sample as saved. Raises ValueError if
+    there are no samples or not as many labels as samples"""
+    try:
+        samples, num_labels = len(data), len(labels)
+    except TypeError:
+        raise ValueError('The samples and the labels must be arrays')
+    if samples == 0:
+        raise ValueError('The dataset must have at least one sample')
+    if samples != num_labels:
+        raise ValueError(f'The dataset has {samples} samples but {num_labels} labels')
+
+    source, label = np.asarray(data[:1]), np.asarray(labels[0])
+    sample = transform_subset(source, transform)[0]
+    return {
+        'samples': len(data),
+        'subsets': -(-len(data) // subset_size),
+        'shape': list(sample.shape),
+        'dtype': sample.dtype.str,
+        'source_dtype': source.dtype.str,
+        'label_dtype': label.dtype.str,
+    }
+
+
+def reserve_dataset(db, upload_id: str):
+    """Creates the metadata document of a dataset being uploaded, marked as
+    not ready. Raises DuplicateKeyError if the dataset already exists"""
+    db[METADATA_COLLECTION].insert_one({'_id': METADATA_ID, 'ready': False, 'upload_id': upload_id})
+
+
+def save_metadata(db, subset_size: int, codec: str, transform, collections: dict, upload_id: str = None):
+    """Saves the metadata document of a dataset, which
+    is read by the functions and the controller. The upload id
+    tells apart the datasets uploaded again with the same name"""
+    logging.debug(f'Saving metadata of dataset {db.name}')
+    db[METADATA_COLLECTION].replace_one(
+        {'_id': METADATA_ID},
+        {'_id': METADATA_ID, 'ready': True, 'upload_id': upload_id, 'subset_size': subset_size, 'codec': codec,
+         'transform': transform, **collections},
+        upsert=True)
+
+
+class UploadJob:
+    """Progress of an upload processed in the background. It is saved in
+    the database so any worker of the service can report it"""
+
+    def __init__(self, client, upload_id: str, dataset: str):
+        self.col = client[JOBS_DATABASE][JOBS_COLLECTION]
+        self.upload_id = upload_id
+        self.dataset = dataset
+        self.started = None
+        self.subsets, self.nbytes = 0, 0
+        self._done = threading.Event()
+
+    def create(self):
+        now = time.time()
+        self.col.insert_one({'_id': self.upload_id, 'dataset': self.dataset, 'state': JOB_PENDING,
+                             'created': now, 'updated': now, 'subsets_total': 0, 'subsets_written': 0,
+                             'bytes_written': 0, 'docs_per_sec': 0, 'mb_per_sec': 0, 'error': None})
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def start(self):
+        self.started = time.time()
+        self._update(state=JOB_RUNNING)
+
+    def add_subsets(self, subsets: int):
+        """Adds to the total the subsets of a collection about to be saved"""
+        self.col.update_one({'_id': self.upload_id}, {'$inc': {'subsets_total': subsets}})
+
+    def progress(self, subsets: int, nbytes: int):
+        """Records a group of subsets written, used as progress callback of save_batches"""
+        self.subsets += subsets
+        self.nbytes += nbytes
+        elapsed = max(time.time() - self.started, 1e-9)
+        self._update(subsets_written=self.subsets, bytes_written=self.nbytes,
+                     docs_per_sec=round(self.subsets / elapsed, 1),
+                     mb_per_sec=round(self.nbytes / elapsed / 1e6, 2))
+
+    def finish(self):
+        self._done.set()
+        self._update(state=JOB_DONE)
+
+    def fail(self, error: Exception):
+        self._done.set()
+        self._update(state=JOB_FAILED, error=str(error))
+
+    def _heartbeat(self):
+        """Refreshes the job until it ends, so it is not taken as interrupted"""
+        while not self._done.wait(UPLOAD_HEARTBEAT_SECONDS):
+            try:
+                self._update()
+            except Exception:
+                logging.exception(f'Could not refresh upload {self.upload_id}')
+
+    def _update(self, **fields):
+        self.col.update_one({'_id': self.upload_id}, {'$set': {'updated': time.time(), **fields}})
+
+
+def fail_stale_uploads(client):
+    """Marks as failed the uploads left pending or running by a worker that
+    was restarted, and drops the datasets they left not ready so their names
+    can be uploaded again. Returns the ids of the uploads marked as failed"""
+    jobs = client[JOBS_DATABASE][JOBS_COLLECTION]
+    query = {'state': {'$in': [JOB_PENDING, JOB_RUNNING]}, 'updated': {'$lt': time.time() - UPLOAD_STALE_SECONDS}}
+
+    failed = []
+    for job in jobs.find(query):
+        # only one worker takes over each job, the one that marks it
+        res = jobs.update_one({'_id': job['_id'], 'state': job['state'], 'updated': job['updated']},
+                              {'$set': {'state': JOB_FAILED, 'updated': time.time(),
+                                        'error': 'upload interrupted by a restart of the storage service'}})
+        if res.modified_count == 0:
+            continue
+
+        logging.warning(f'Upload {job["_id"]} of dataset {job["dataset"]} was interrupted, marked as failed')
+        metadata = client[job['dataset']][METADATA_COLLECTION].find_one({'_id': METADATA_ID})
+        if metadata is not None and not metadata.get('ready', True) and metadata.get('upload_id') == job['_id']:
+            client.drop_database(job['dataset'])
+        failed.append(job['_id'])
+
+    return failed
+
+
+def available_codecs():
+    """Returns the codecs that can be used with the
+    libraries installed in the service"""
+    return [c for c, lib in [(CODEC_RAW, True), (CODEC_LZ4, lz4_frame), (CODEC_ZSTD, zstandard)] if lib]
+
+
+def encode_array(arr, codec: str = CODEC_RAW):
+    """Encodes an array as a document with its type, shape
+    and raw bytes, so the functions can decode it without pickle"""
+    if codec not in available_codecs():
+        raise ValueError(f'Codec {codec} not supported, must be one of {available_codecs()}')
+
+    arr = np.ascontiguousarray(arr)
+    payload = arr.tobytes()
+
+    if codec == CODEC_LZ4:
+        payload = lz4_frame.compress(payload)
+    elif codec == CODEC_ZSTD:
+        payload = zstandard.ZstdCompressor().compress(payload)
+
+    return {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'codec': codec, 'bytes': payload}
+
+
+def _encode_subset(task):
+    """Preprocesses and encodes a subset as a document, run in the encoding processes"""
+    i, data, labels, codec, transform = task
+    return {'_id': i,
+            'data': encode_array(transform_subset(data, transform), codec),
+            'labels': encode_array(labels, codec)
+            }
+
+
+# Pool of processes encoding the subsets, shared by all the uploads of the service
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+
+def encode_pool(workers: int = ENCODE_WORKERS):
+    """Returns the pool of processes encoding the subsets, created on
+    the first call and reused afterwards. The processes are spawned
+    instead of forked, since the pool is created from the upload threads
+    of a process holding open connections to the database"""
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            _encode_pool = multiprocessing.get_context('spawn').Pool(workers)
+        return _encode_pool
+
+
+def _needs_encoding(codec: str, transform) -> bool:
+    """Whether encoding the subsets is CPU bound, otherwise sending
+    them to other processes only adds copies of the data"""
+    return codec != CODEC_RAW or transform is not None
+
+
+def _encode_subsets(tasks, pool, max_pending: int):
+    """Encodes the subsets in the pool keeping at most max_pending
+    of them in flight, so the subsets are consumed as they are encoded"""
+    if pool is None:
+        yield from map(_encode_subset, tasks)
+        return
+
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(_encode_subset, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def save_batches(col: collection.Collection, batches, codec: str = CODEC_RAW, transform=None,
+                 max_bytes: int = INSERT_BATCH_BYTES,
+                 workers: int = ENCODE_WORKERS,
+                 connections: int = INSERT_CONNECTIONS,
+                 progress=None):
     """Saves the batches to the specified collection
-    in the database"""
-    logging.debug(f'Saving documents to the {col.full_name} collection')
-    ids = col.insert_many([
-        {'_id': i,
-         'data': pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
-         'labels': pickle.dumps(labels, pickle.HIGHEST_PROTOCOL)
-         }
-        for i, (data, labels) in enumerate(batches)
-    ]).inserted_ids
-    logging.debug(f'Inserted {len(ids)} documents')
+    in the database. The batches are preprocessed and encoded
+    in the shared pool of processes as they are consumed, or in this
+    process if there is no transform and the codec is raw, and inserted
+    unordered in groups of up to max_bytes from several connections,
+    so only a few groups are in memory at any time. If given, progress
+    is called with the documents and bytes of each group inserted.
+    Returns the documents and bytes saved and the throughput"""
+    encoder = encode_pool(workers) if workers > 0 and _needs_encoding(codec, transform) else None
+    logging.debug(f'Saving documents to the {col.full_name} collection with codec {codec}, '
+                  f'{workers if encoder is not None else 0} encoding workers and {connections} connections')
+    start = time.time()
+    tasks = ((i, data, labels, codec, transform) for i, (data, labels) in enumerate(batches))
+    inserter = ThreadPoolExecutor(max(1, connections))
+
+    docs, size, total, nbytes, inserts = [], 0, 0, 0, deque()
+
+    def wait_insert():
+        insert, group_bytes = inserts.popleft()
+        written = len(insert.result().inserted_ids)
+        if progress is not None:
+            progress(written, group_bytes)
+        return written
+
+    try:
+        for doc in _encode_subsets(tasks, encoder, 2 * max(1, workers)):
+            docs.append(doc)
+            size += len(doc['data']['bytes']) + len(doc['labels']['bytes'])
+            if size < max_bytes:
+                continue
+
+            # wait for a free connection before sending the group
+            if len(inserts) >= connections:
+                total += wait_insert()
+            inserts.append((inserter.submit(col.insert_many, docs, ordered=False), size))
+            docs, nbytes, size = [], nbytes + size, 0
+
+        if docs:
+            inserts.append((inserter.submit(col.insert_many, docs, ordered=False), size))
+            nbytes += size
+        while inserts:
+            total += wait_insert()
+    finally:
+        inserter.shutdown()
+
+    elapsed = max(time.time() - start, 1e-9)
+    stats = {'docs': total, 'bytes': nbytes, 'seconds': round(elapsed, 3),
+             'docs_per_sec': round(total / elapsed, 1), 'mb_per_sec': round(nbytes / elapsed / 1e6, 2)}
+    logging.debug(f'Inserted {total} documents, {stats["docs_per_sec"]} docs/s, {stats["mb_per_sec"]} MB/s')
+    return stats